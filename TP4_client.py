@@ -7,184 +7,166 @@ Noms et numéros étudiants: Louis-Etienne Messier (537 131 157), Jose Andres Ch
 """
 
 import argparse
+import asyncio
 import getpass
-import json
 import socket
 import sys
 import re
+from typing import Any, Coroutine, TypeVar
 
-import glosocket
+import gloclient
 import gloutils
 
+_T = TypeVar("_T")
+
 
 class Client:
     """Client pour le serveur mail @glo2000.ca."""
 
     def __init__(self, destination: str) -> None:
         """
-        Prépare et connecte le socket du client `_socket`.
+        Prépare la boucle d'événements `_loop` et connecte le client
+        asynchrone `_client`, qui négocie le codec et la compression des
+        messages avec le serveur.
 
-        Prépare un attribut `_username` pour stocker le nom d'utilisateur
-        courant. Laissé vide quand l'utilisateur n'est pas connecté.
+        Le nom de l'utilisateur courant est `_client.username`, vide quand
+        l'utilisateur n'est pas connecté.
         """
-        port = gloutils.APP_PORT
-        
-        self._client_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._username = ""
+        self._loop = asyncio.new_event_loop()
+        self._client = gloclient.GloClient(destination, gloutils.APP_PORT)
 
         try:
-            self._client_soc.connect((destination, port))
-        except OverflowError:
-            sys.exit("Port has bad value")
-        except socket.gaierror:
-            sys.exit("Temporary failure in name resolution of the destination")
-        except ConnectionRefusedError:
-            sys.exit("Port's connection is refused")
+            self._loop.run_until_complete(self._client.connect())
+        except gloclient.GLOClientError as ex:
+            if isinstance(ex.__cause__, OverflowError):
+                sys.exit("Port has bad value")
+            if isinstance(ex.__cause__, socket.gaierror):
+                sys.exit("Temporary failure in name resolution of the destination")
+            if isinstance(ex.__cause__, ConnectionRefusedError):
+                sys.exit("Port's connection is refused")
+            sys.exit(str(ex))
+
+    @property
+    def _username(self) -> str:
+        return self._client.username or ""
+
+    def _run(self, coroutine: Coroutine[Any, Any, _T]) -> _T:
+        """
+        Exécute une requête du client asynchrone et retourne son résultat.
 
+        Les erreurs du serveur sont levées en ServerError; une connexion
+        perdue termine le programme.
+        """
+        try:
+            return self._loop.run_until_complete(coroutine)
+        except gloclient.ServerError:
+            raise
+        except gloclient.GLOClientError:
+            sys.exit("Lost connection with the server")
 
     def _register(self) -> None:
         """
-        Demande un nom d'utilisateur et un mot de passe et les transmet au
-        serveur avec l'entête `AUTH_REGISTER`.
+        Demande un nom d'utilisateur et un mot de passe et crée le compte.
 
-        Si la création du compte s'est effectuée avec succès, l'attribut
-        `_username` est mis à jour, sinon l'erreur est affichée.
+        Si la création du compte s'est effectuée avec succès, l'utilisateur
+        est connecté, sinon l'erreur est affichée.
         """
         _username = input("Entrez un nom d'utilisateur: ")
         _password = getpass.getpass("Entrez un mot de passe: ")
-        
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.AUTH_REGISTER,
-            payload=gloutils.AuthPayload(
-                username=_username,
-                password=_password
-            )
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-        
-        
-        reply_data = self._try_recv_mesg(self._client_soc)
-        reply  : gloutils.GloMessage = json.loads(reply_data)
 
-        if reply["header"] ==  gloutils.Headers.OK:
-            self._username = _username # utilisateur authentifie
-        elif reply["header"] == gloutils.Headers.ERROR:
-            payload : gloutils.ErrorPayload = reply['payload']
-            print(payload["error_message"]) # affiche erreur
+        try:
+            self._run(self._client.register(_username, _password))
+        except gloclient.ServerError as ex:
+            print(ex.error_message) # affiche erreur
 
     def _login(self) -> None:
         """
-        Demande un nom d'utilisateur et un mot de passe et les transmet au
-        serveur avec l'entête `AUTH_LOGIN`.
+        Demande un nom d'utilisateur et un mot de passe et connecte
+        l'utilisateur.
 
-        Si la connexion est effectuée avec succès, l'attribut `_username`
-        est mis à jour, sinon l'erreur est affichée.
+        Si la connexion est effectuée avec succès, l'utilisateur est salué,
+        sinon l'erreur est affichée.
         """
         _username = input("Entrez un nom d'utilisateur: ")
         _password = getpass.getpass("Entrez un mot de passe: ")
-        
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.AUTH_LOGIN,
-            payload=gloutils.AuthPayload(
-                username=_username,
-                password=_password
-            )
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-        
-        reply_data = self._try_recv_mesg(self._client_soc)
-        reply  : gloutils.GloMessage = json.loads(reply_data)
-
-        if reply["header"] ==  gloutils.Headers.OK:
-            print()
-            print("Connexion avec succès!")
-            print(f"Bonjour {_username}")
-            self._username = _username # utilisateur authentifie
-        elif reply["header"] == gloutils.Headers.ERROR:
-            payload : gloutils.ErrorPayload = reply['payload']
-            print(payload["error_message"]) # affiche erreur
 
+        try:
+            self._run(self._client.login(_username, _password))
+        except gloclient.ServerError as ex:
+            print(ex.error_message) # affiche erreur
+            return
+        print()
+        print("Connexion avec succès!")
+        print(f"Bonjour {_username}")
 
     def _quit(self) -> None:
         """
-        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
-        socket du client.
+        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme la
+        connexion.
         """
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.BYE,
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-        
-        self._client_soc.close()
+        self._loop.run_until_complete(self._client.close())
+        self._loop.close()
 
     def _read_email(self) -> None:
         """
-        Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        Demande au serveur la liste de ses courriels, une page de
+        `CLIENT_PAGE_SIZE` courriels à la fois.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
+        Affiche chaque page puis demande le courriel choisi par son
+        identifiant, ou demande la page suivante. Le choix ne dépend donc
+        pas des courriels arrivés depuis.
 
         Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.INBOX_READING_REQUEST,
-            payload=None,
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-
-        reply_data = self._try_recv_mesg(self._client_soc)
-        reply  : gloutils.GloMessage = json.loads(reply_data)
-
-        if reply["header"] == gloutils.Headers.OK:
-            list_email : list[str] = reply["payload"]["email_list"]
-            amount_emails = len(list_email)
-
-            for email in list_email:
-                print(email) # affiche les emails 
-
-            if amount_emails > 0:
-                good_choix = False
-                while(not good_choix): # loop pour avoir un digit valide
-                    choix = input(f"Entrez votre choix [1-{amount_emails}] : ")
-                    if re.search(r"^[0-9]{1,10}$", choix):
-                        choix_int = int(choix)
-                        if choix_int <= amount_emails and choix_int >= 1:
-                            good_choix = True
-                    if not good_choix:
-                        print("Choix invalide")
-            
-                # request pour avoir le email specifie
-                message = gloutils.GloMessage(
-                header=gloutils.Headers.INBOX_READING_CHOICE,
-                    payload=gloutils.EmailChoicePayload(
-                        choice=choix_int
-                    ),
-                )
-                message_data = json.dumps(message)
-                self._try_send_mesg(self._client_soc, message_data)
-
-                reply_data =self._try_recv_mesg(self._client_soc)
-                reply  : gloutils.GloMessage = json.loads(reply_data)
-
-                if reply["header"] == gloutils.Headers.OK: # received the body of the email
-                    reply_payload : gloutils.EmailContentPayload = reply["payload"]
-
-                    print(gloutils.EMAIL_DISPLAY.format(
-                        sender=reply_payload["sender"],
-                        to=reply_payload["destination"],
-                        subject=reply_payload["subject"],
-                        date=reply_payload["date"],
-                        body=reply_payload["content"]
-                    ))
-                
+        cursor = None
+        email_ids = []
+        choix_int = 0
+        while not choix_int:
+            try:
+                page = self._run(self._client.list(gloutils.CLIENT_PAGE_SIZE, cursor))
+            except gloclient.ServerError:
+                return
+
+            for email in page.emails:
+                print(gloutils.SUBJECT_DISPLAY.format(**email)) # affiche les emails
+                email_ids.append(email["id"])
+            amount_emails = len(email_ids)
+            cursor = page.next_cursor
+
+            if amount_emails == 0:
+                print("Aucun courriel à lire.")
+                return
+
+            suite = " ou 's' pour la page suivante" if cursor else ""
+            good_choix = False
+            while(not good_choix): # loop pour avoir un digit valide
+                choix = input(f"Entrez votre choix [1-{amount_emails}]{suite} : ")
+                if cursor and choix.lower() == "s":
+                    good_choix = True
+                elif re.search(r"^[0-9]{1,10}$", choix):
+                    choix_int = int(choix)
+                    if choix_int <= amount_emails and choix_int >= 1:
+                        good_choix = True
+                if not good_choix:
+                    choix_int = 0
+                    print("Choix invalide")
+
+        # request pour avoir le email specifie
+        try:
+            email = self._run(self._client.fetch(email_ids[choix_int - 1]))
+        except gloclient.ServerError:
+            return
+
+        print(gloutils.EMAIL_DISPLAY.format(
+            sender=email["sender"],
+            to=email["destination"],
+            subject=email["subject"],
+            date=email["date"],
+            body=email["content"]
+        ))
 
     def _send_email(self) -> None:
         """
@@ -195,7 +177,7 @@ class Client:
 
         La saisie du corps se termine par un point seul sur une ligne.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Transmet ces informations au serveur.
         """
         destinataire = input("Entrez l'adresse du destinataire: ")
         sujet = input("Entrez le sujet: ")
@@ -205,79 +187,33 @@ class Client:
         while buffer != ".\n":
             contenu += buffer
             buffer = input() + "\n"
-            
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.EMAIL_SENDING,
-            payload=gloutils.EmailContentPayload(
-                sender=f"{self._username}@{gloutils.SERVER_DOMAIN}",
-                destination=destinataire,
-                subject=sujet,
-                content=contenu,
-                date=gloutils.get_current_utc_time(),
-            )
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-
-        reply_data = self._try_recv_mesg(self._client_soc)
-        reply  : gloutils.GloMessage = json.loads(reply_data)
-
-        if reply["header"] ==  gloutils.Headers.OK:
-            print()
-            print("Le message a été envoyé avec succès!")
-            
-        elif reply["header"] == gloutils.Headers.ERROR:
-            payload : gloutils.ErrorPayload = reply['payload']
-            print(payload["error_message"]) # affiche erreur
+
+        try:
+            self._run(self._client.send(destinataire, sujet, contenu))
+        except gloclient.ServerError as ex:
+            print(ex.error_message) # affiche erreur
+            return
+        print()
+        print("Le message a été envoyé avec succès!")
 
     def _check_stats(self) -> None:
         """
-        Demande les statistiques au serveur avec l'entête `STATS_REQUEST`.
+        Demande les statistiques au serveur.
 
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.STATS_REQUEST,
-            payload=None,
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-
-        reply_data = self._try_recv_mesg(self._client_soc)
-        reply  : gloutils.GloMessage = json.loads(reply_data)
-
-        if reply["header"] == gloutils.Headers.OK:
-            reply_payload : gloutils.StatsPayload = reply["payload"]
-            print(gloutils.STATS_DISPLAY.format(
-                count=reply_payload["count"],
-                size=reply_payload["size"]
-            ))
+        try:
+            stats = self._run(self._client.stats())
+        except gloclient.ServerError:
+            return
+        print(gloutils.STATS_DISPLAY.format(
+            count=stats["count"],
+            size=stats["size"]
+        ))
 
     def _logout(self) -> None:
-        """
-        Préviens le serveur avec l'entête `AUTH_LOGOUT`.
-
-        Met à jour l'attribut `_username`.
-        """
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.AUTH_LOGOUT,
-            payload=None,
-        )
-        message_data = json.dumps(message)
-        self._try_send_mesg(self._client_soc, message_data)
-        self._username = ""
-
-    def _try_send_mesg(self, client_soc: socket.socket, message_data:str)-> None:
-        try:
-            glosocket.snd_mesg(client_soc, message_data)
-        except glosocket.GLOSocketError:
-            sys.exit("Lost connection with the server")
-            
-    def _try_recv_mesg(self, client_soc:socket.socket)->str:
-        try:
-            return glosocket.recv_mesg(client_soc)
-        except glosocket.GLOSocketError:
-            sys.exit("Lost connection with the server")
+        """Préviens le serveur avec l'entête `AUTH_LOGOUT`."""
+        self._run(self._client.logout())
 
     def _menu_principal(self) -> bool:
         """
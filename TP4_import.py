@@ -0,0 +1,336 @@
+"""\
+Importation en masse de courriels dans les boîtes du serveur TP4.
+
+Lit des fichiers mbox et des dossiers Maildir au fil de l'eau, un courriel
+à la fois, et écrit les courriels directement dans les segments des
+utilisateurs (glostore), par lots de `--batch-size`. Chaque source est
+importée par un processus de `--processes`. À la fin, les segments et
+les compteurs de chaque boîte importée sont vérifiés et corrigés au
+besoin, leur index de recherche (glosearch) est mis à jour, puis le
+débit est affiché.
+
+Les comptes doivent déjà exister. Le serveur doit être arrêté pendant
+l'importation, sauf s'il est lancé avec plusieurs processus (--workers):
+ceux-ci relisent les segments écrits par les autres.
+
+Une source est `utilisateur=chemin`, où le chemin est un fichier mbox ou
+un dossier Maildir (avec `cur` et `new`). Un dossier qui n'est pas un
+Maildir contient une source par utilisateur: `<utilisateur>.mbox` ou
+un dossier Maildir `<utilisateur>`.
+
+Utilisation:
+    python TP4_import.py alice=alice.mbox bob=Maildir/bob --processes 4
+    python TP4_import.py equipe/ --data-dir glo_server_data
+"""
+import argparse
+import concurrent.futures
+import datetime
+import email.errors
+import email.header
+import email.message
+import email.parser
+import email.utils
+import os
+import re
+import sys
+import time
+from typing import Iterator, NamedTuple, Optional, Union
+
+import glosearch
+import glostore
+import gloutils
+
+DEFAULT_BATCH_SIZE = 1000
+
+_MBOX_SUFFIX = ".mbox"
+_MAILDIR_SUBDIRS = ("cur", "new")
+# Ligne « From » du corps échappée par un « > » (mboxrd)
+_ESCAPED_FROM = re.compile(rb"^>+From ")
+
+_PARSER = email.parser.BytesParser()
+
+
+class Source(NamedTuple):
+    """Fichier mbox ou dossier Maildir à importer dans la boîte de `username`."""
+    username: str
+    path: str
+
+
+class ImportResult(NamedTuple):
+    source: Source
+    imported: int
+    skipped: int
+    size: int
+
+
+def read_mbox(path: str) -> Iterator[bytes]:
+    """
+    Retourne un à un les courriels bruts d'un fichier mbox, sans lire tout
+    le fichier. Les lignes « >From » du corps sont déséchappées.
+    """
+    with open(path, 'rb') as file:
+        lines: list[bytes] = []
+        started = False
+        for line in file:
+            if line.startswith(b"From "):
+                if started:
+                    yield _join_mbox_lines(lines)
+                lines = []
+                started = True
+            elif started:
+                lines.append(line[1:] if _ESCAPED_FROM.match(line) else line)
+        if started:
+            yield _join_mbox_lines(lines)
+
+
+def _join_mbox_lines(lines: list[bytes]) -> bytes:
+    # La ligne vide qui précède le séparateur « From » suivant
+    if lines and lines[-1] in (b"\n", b"\r\n"):
+        lines.pop()
+    return b"".join(lines)
+
+
+def read_maildir(path: str) -> Iterator[bytes]:
+    """
+    Retourne un à un les courriels bruts d'un dossier Maildir, dans
+    l'ordre de leurs noms de fichiers (qui commencent par l'heure de
+    livraison).
+    """
+    for subdir in _MAILDIR_SUBDIRS:
+        subdir_path = os.path.join(path, subdir)
+        if not os.path.isdir(subdir_path):
+            continue
+        with os.scandir(subdir_path) as entries:
+            names = sorted(entry.name for entry in entries
+                           if entry.is_file() and not entry.name.startswith("."))
+        for name in names:
+            with open(os.path.join(subdir_path, name), 'rb') as file:
+                yield file.read()
+
+
+def is_maildir(path: str) -> bool:
+    return os.path.isdir(path) and all(
+        os.path.isdir(os.path.join(path, subdir)) for subdir in _MAILDIR_SUBDIRS)
+
+
+def to_payload(data: bytes, username: str) -> gloutils.EmailContentPayload:
+    """
+    Convertit un courriel brut en courriel du serveur livré à `username`.
+    La date est convertie au format de `get_current_utc_time`; une date
+    absente ou illisible est remplacée par l'heure courante.
+    """
+    # compat32 plutôt que email.policy.default, dont l'analyse des entêtes
+    # prenait 80 % du temps de l'importation
+    message = _PARSER.parsebytes(data)
+    sender = _decode_header(message.get("From"))
+    sender = email.utils.parseaddr(sender)[1] or sender
+    return gloutils.EmailContentPayload(
+        sender=sender,
+        destination=f"{username}@{gloutils.SERVER_DOMAIN}",
+        subject=_decode_header(message.get("Subject")),
+        date=_normalize_date(message.get("Date")),
+        content=_get_text(message),
+    )
+
+
+def _decode_header(value: Union[str, email.header.Header, None]) -> str:
+    """
+    Décode les mots encodés (RFC 2047) d'une entête. Une entête qui
+    contient des octets non ASCII bruts est lue comme un Header, dont les
+    octets sont décodés en UTF-8, sinon en Latin-1.
+    """
+    if not value:
+        return ""
+    if isinstance(value, email.header.Header):
+        text = "".join(_decode_bytes(data, charset) if isinstance(data, bytes) else data
+                       for data, charset in email.header.decode_header(value))
+        return " ".join(text.split())
+    if "=?" not in value:
+        return " ".join(value.split())
+    return str(email.header.make_header(email.header.decode_header(value)))
+
+
+def _decode_bytes(data: bytes, charset: Optional[str]) -> str:
+    if charset in (None, "unknown-8bit"):
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data.decode('latin-1')
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def _normalize_date(value: Optional[str]) -> str:
+    """
+    Date du courriel au format du serveur, ou l'heure actuelle si elle est
+    absente, invalide ou hors des années à quatre chiffres que le serveur
+    sait lire.
+    """
+    if value:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+            if date.tzinfo is not None:
+                date = date.astimezone(datetime.timezone.utc)
+            if 1000 <= date.year <= 9999:
+                return gloutils.format_utc_time(date)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return gloutils.get_current_utc_time()
+
+
+def _get_text(message: email.message.Message) -> str:
+    """Texte du courriel: sa première partie text/plain, sinon text/html."""
+    parts = [part for part in message.walk()
+             if part.get_content_maintype() == "text" and not part.is_multipart()]
+    for subtype in ("plain", "html"):
+        for part in parts:
+            if part.get_content_subtype() == subtype and not part.get_filename():
+                payload = part.get_payload(decode=True) or b""
+                charset = part.get_content_charset() or "us-ascii"
+                try:
+                    return payload.decode(charset, errors='replace')
+                except LookupError:
+                    # Jeu de caractères inconnu
+                    return payload.decode('utf-8', errors='replace')
+    return ""
+
+
+def import_source(data_dir: str, source: Source,
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> ImportResult:
+    """
+    Importe les courriels de la source dans la boîte de l'utilisateur, par
+    lots de `batch_size`, puis force leur écriture sur le disque.
+
+    Un courriel illisible est ignoré et compté dans `skipped`.
+    """
+    store = glostore.MailboxStore(data_dir, shared=True)
+    reader = read_maildir(source.path) if is_maildir(source.path) else read_mbox(source.path)
+    imported = skipped = size = 0
+    batch: list[gloutils.EmailContentPayload] = []
+    segments: dict[int, glostore.Segment] = {}
+    for data in reader:
+        try:
+            batch.append(to_payload(data, source.username))
+        except (ValueError, LookupError, UnicodeError, email.errors.MessageError) as ex:
+            print(f"{source.path}: courriel ignoré ({ex})", file=sys.stderr)
+            skipped += 1
+            continue
+        if len(batch) >= batch_size:
+            size += _write_batch(store, source.username, batch, segments)
+            imported += len(batch)
+            batch = []
+    if batch:
+        size += _write_batch(store, source.username, batch, segments)
+        imported += len(batch)
+    for segment in segments.values():
+        segment.sync()
+    return ImportResult(source, imported, skipped, size)
+
+
+def _write_batch(store: glostore.MailboxStore, username: str,
+                 batch: list[gloutils.EmailContentPayload],
+                 segments: dict[int, glostore.Segment]) -> int:
+    """Écrit le lot, note les segments écrits et retourne les octets écrits."""
+    stored = store.append_many(username, batch)
+    for item in stored:
+        segments[item.location.segment.number] = item.location.segment
+    return sum(item.location.size for item in stored)
+
+
+def check_mailbox(data_dir: str, username: str) -> list[str]:
+    """Vérifie la boîte importée et corrige ses compteurs au besoin."""
+    return glostore.MailboxStore(data_dir, shared=True).check(username, repair=True)
+
+
+def index_mailbox(data_dir: str, username: str) -> int:
+    """Ajoute les courriels importés à l'index de recherche de la boîte."""
+    return glosearch.update_index(glostore.MailboxStore(data_dir, shared=True),
+                                  data_dir, username)
+
+
+def find_sources(paths: list[str]) -> list[Source]:
+    """
+    Retourne les sources désignées par les arguments `utilisateur=chemin`
+    ou par un dossier contenant une source par utilisateur.
+    """
+    sources: list[Source] = []
+    for arg in paths:
+        if "=" in arg:
+            username, path = arg.split("=", 1)
+            sources.append(Source(username.lower(), path))
+            continue
+        with os.scandir(arg) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.name.endswith(_MBOX_SUFFIX) and entry.is_file():
+                    sources.append(Source(entry.name[:-len(_MBOX_SUFFIX)].lower(), entry.path))
+                elif is_maildir(entry.path):
+                    sources.append(Source(entry.name.lower(), entry.path))
+    return sources
+
+
+def run(data_dir: str, sources: list[Source], processes: int,
+        batch_size: int = DEFAULT_BATCH_SIZE) -> list[ImportResult]:
+    """
+    Importe les sources en parallèle dans `processes` processus, puis
+    vérifie et indexe les boîtes importées. Les sources des utilisateurs
+    sans compte sont ignorées.
+    """
+    known = []
+    for source in sources:
+        if os.path.isfile(os.path.join(data_dir, source.username, gloutils.PASSWORD_FILENAME)):
+            known.append(source)
+        else:
+            print(f"{source.path}: l'utilisateur {source.username} n'existe pas", file=sys.stderr)
+
+    results: list[ImportResult] = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(import_source, data_dir, source, batch_size): source
+                   for source in known}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            print(f"{result.source.username} <- {result.source.path}: "
+                  f"{result.imported} courriels, {result.skipped} ignorés")
+            results.append(result)
+
+        usernames = sorted({result.source.username for result in results if result.imported})
+        for username, problems in zip(usernames, executor.map(
+                check_mailbox, [data_dir] * len(usernames), usernames)):
+            for problem in problems:
+                print(f"{username}: {problem}", file=sys.stderr)
+        for username, indexed in zip(usernames, executor.map(
+                index_mailbox, [data_dir] * len(usernames), usernames)):
+            print(f"{username}: {indexed} courriels indexés pour la recherche")
+    return results
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+",
+                        help="Sources utilisateur=chemin (mbox ou Maildir), ou dossiers "
+                             "contenant <utilisateur>.mbox et des Maildir <utilisateur>.")
+    parser.add_argument("--data-dir", action="store", dest="data_dir",
+                        default=gloutils.SERVER_DATA_DIR,
+                        help="Dossier de données du serveur.")
+    parser.add_argument("--processes", action="store", dest="processes", type=int,
+                        default=os.cpu_count(),
+                        help="Nombre de processus qui se partagent les sources.")
+    parser.add_argument("--batch-size", action="store", dest="batch_size", type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help="Nombre de courriels écrits à la fois dans une boîte.")
+    args = parser.parse_args(sys.argv[1:])
+
+    start = time.perf_counter()
+    results = run(args.data_dir, find_sources(args.sources), args.processes, args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    imported = sum(result.imported for result in results)
+    size = sum(result.size for result in results)
+    print(f"{imported} courriels ({size} octets) importés en {elapsed:.1f} s: "
+          f"{imported / elapsed:.0f} courriels/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,547 @@
+"""\
+Générateur de charge pour le serveur TP4.
+
+Simule des utilisateurs concurrents, chacun sur sa propre connexion, qui
+enchaînent des requêtes tirées au hasard selon une répartition
+configurable: création de compte, connexion, envoi, liste, consultation
+et statistiques. Avant la mesure, chaque utilisateur crée son compte et
+remplit sa boîte de courriel. La taille des boîtes suit une loi
+exponentielle tirée d'un générateur initialisé avec `--seed`: deux
+exécutions produisent les mêmes données et la même suite de requêtes.
+
+Une consultation utilise un identifiant reçu avec la dernière liste; sans
+liste, le premier courriel est demandé par sa position, ce qui est compté
+comme une erreur si la boîte est vide.
+
+Le débit et les percentiles de latence de chaque entête sont affichés et
+peuvent être sauvegardés en JSON (`--output`) pour comparer deux
+versions du serveur (`--baseline`).
+
+Utilisation:
+    python TP4_loadgen.py --spawn --users 1000 --duration 30 --output avant.json
+    python TP4_loadgen.py --spawn --users 1000 --duration 30 --baseline avant.json
+
+Pour mesurer une version antérieure, extraire son arbre et lancer son
+serveur avec `--server` (le protocole de base n'a pas changé):
+    git worktree add /tmp/avant <commit>
+    python TP4_loadgen.py --spawn --server /tmp/avant/TP4_server.py --output avant.json
+
+Scénarios utilisés pour comparer les versions du serveur:
+- boucle d'événements: --users 1000 --mix list=1,stats=1
+- bassin de fils: --users 200 --mix send=1,list=1
+- trames et sendfile: --users 50 --content-size 200000 --mailbox-mean 5 --mix fetch=1
+- registre des comptes: --users 200 --mix login=1
+- durabilité: --users 50 --mix send=1 --server-args "--durability message",
+    puis "--durability batched"
+"""
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import random
+import selectors
+import shlex
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from typing import NamedTuple, Optional
+
+import glosocket
+import gloutils
+
+OPERATIONS = ("register", "login", "send", "list", "fetch", "stats")
+DEFAULT_MIX = "register=1,login=4,send=20,list=30,fetch=40,stats=5"
+PERCENTILES = (50, 90, 99, 99.9)
+PASSWORD = "Password123"  # nosec:B105
+# Temps laissé aux dernières requêtes après la fin de la mesure
+DRAIN_TIMEOUT = 10.0
+_BODY_POOL_SIZE = 64
+
+
+class Workload(NamedTuple):
+    """Paramètres de la charge, identiques pour tous les processus."""
+    users: int
+    mix: dict[str, float]
+    duration: float
+    seed: int
+    mailbox_mean: float
+    mailbox_max: int
+    content_size: int
+    prefix: str
+    codec: str
+    compression: Optional[str]
+
+
+class _Stats:
+    """Latences (secondes) et erreurs mesurées pour chaque entête."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+        self.errors: collections.Counter[str] = collections.Counter()
+        self.disconnects = 0
+
+    def merge(self, other: "_Stats") -> None:
+        for name, latencies in other.latencies.items():
+            self.latencies[name].extend(latencies)
+        self.errors.update(other.errors)
+        self.disconnects += other.disconnects
+
+
+class _Session:
+    """
+    Un utilisateur simulé: sa connexion, ses files de messages et la
+    requête en attente de réponse.
+    """
+
+    def __init__(self, index: int, workload: Workload, bodies: list[str]) -> None:
+        self.index = index
+        self.username = f"{workload.prefix}{index}"
+        self.workload = workload
+        self.bodies = bodies
+        self.rng = random.Random(f"{workload.seed}:{index}")
+        self.soc = socket.create_connection(("127.0.0.1", gloutils.APP_PORT))
+        self.soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.soc.setblocking(False)
+        self.decoder = glosocket.FrameDecoder()
+        self.writer = glosocket.FrameWriter()
+        self.codec = glosocket.CODEC_JSON
+        self.compression: Optional[str] = None
+        # Requêtes à envoyer avant d'en tirer une nouvelle
+        self.queue: collections.deque[gloutils.GloMessage] = collections.deque()
+        self.request: Optional[gloutils.GloMessage] = None
+        self.sent_at = 0.0
+        self.registered = 0
+        self.email_ids: list[int] = []
+
+        if workload.codec != glosocket.CODEC_JSON or workload.compression:
+            self.queue.append(gloutils.GloMessage(
+                header=gloutils.Headers.HELLO,
+                payload=gloutils.HelloPayload(
+                    codecs=[workload.codec],
+                    compressions=[workload.compression] if workload.compression else [],
+                ),
+            ))
+        self.queue.append(gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_REGISTER,
+            payload=gloutils.AuthPayload(username=self.username, password=PASSWORD),
+        ))
+        mailbox_size = min(int(self.rng.expovariate(1 / workload.mailbox_mean)),
+                           workload.mailbox_max) if workload.mailbox_mean else 0
+        for _ in range(mailbox_size):
+            self.queue.append(self._email_to(self.username))
+
+    def send(self, message: gloutils.GloMessage) -> None:
+        self.request = message
+        self.writer.append(glosocket.encode_message(message, self.codec), self.compression)
+        self.sent_at = time.perf_counter()
+        self.writer.write_to(self.soc)
+
+    def next_request(self) -> gloutils.GloMessage:
+        """Retourne la prochaine requête en file ou en tire une selon la répartition."""
+        if self.queue:
+            return self.queue.popleft()
+        operation = self.rng.choices(list(self.workload.mix),
+                                     weights=list(self.workload.mix.values()))[0]
+        if operation == "register":
+            # Le nouveau compte devient celui de la session: on revient au sien
+            self.registered += 1
+            self.queue.append(self._login())
+            return gloutils.GloMessage(
+                header=gloutils.Headers.AUTH_REGISTER,
+                payload=gloutils.AuthPayload(
+                    username=f"{self.username}r{self.registered}", password=PASSWORD),
+            )
+        if operation == "login":
+            return self._login()
+        if operation == "send":
+            return self._email_to(f"{self.workload.prefix}{self.rng.randrange(self.workload.users)}")
+        if operation == "list":
+            return gloutils.GloMessage(
+                header=gloutils.Headers.INBOX_READING_REQUEST,
+                payload=gloutils.EmailListRequestPayload(
+                    limit=gloutils.CLIENT_PAGE_SIZE,
+                    fields=["number", "id", "sender", "subject", "date"],
+                ),
+            )
+        if operation == "fetch":
+            if not self.email_ids:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.INBOX_READING_CHOICE,
+                    payload=gloutils.EmailChoicePayload(choice=1),
+                )
+            return gloutils.GloMessage(
+                header=gloutils.Headers.INBOX_READING_ID,
+                payload=gloutils.EmailIdPayload(id=self.rng.choice(self.email_ids)),
+            )
+        return gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)
+
+    def handle_reply(self, reply: gloutils.GloMessage) -> None:
+        """Met à jour la session selon la réponse à la requête en cours."""
+        header = self.request["header"]
+        if header == gloutils.Headers.HELLO:
+            self.codec = reply["payload"].get("codec", glosocket.CODEC_JSON)
+            self.compression = reply["payload"].get("compression")
+        elif (header == gloutils.Headers.AUTH_REGISTER
+              and reply["header"] == gloutils.Headers.ERROR
+              and self.request["payload"]["username"] == self.username):
+            # Compte créé lors d'une exécution précédente
+            self.queue.appendleft(self._login())
+        elif header == gloutils.Headers.INBOX_READING_REQUEST and reply["header"] == gloutils.Headers.OK:
+            self.email_ids = [email["id"] for email in reply["payload"].get("emails", [])]
+        self.request = None
+
+    def _login(self) -> gloutils.GloMessage:
+        return gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username=self.username, password=PASSWORD),
+        )
+
+    def _email_to(self, username: str) -> gloutils.GloMessage:
+        return gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_SENDING,
+            payload=gloutils.EmailContentPayload(
+                sender=f"{self.username}@{gloutils.SERVER_DOMAIN}",
+                destination=f"{username}@{gloutils.SERVER_DOMAIN}",
+                subject=f"Courriel {self.rng.randrange(1 << 30)}",
+                date=gloutils.get_current_utc_time(),
+                content=self.rng.choice(self.bodies),
+            ),
+        )
+
+
+def _make_bodies(workload: Workload) -> list[str]:
+    """Contenus de courriels de `content_size` caractères en moyenne."""
+    rng = random.Random(workload.seed)
+    alphabet = string.ascii_letters + string.digits + "     \n"
+    return ["".join(rng.choices(alphabet, k=rng.randint(workload.content_size // 2,
+                                                        workload.content_size * 3 // 2)))
+            for _ in range(_BODY_POOL_SIZE)]
+
+
+def run_sessions(indices: range, workload: Workload,
+                 barrier: Optional[multiprocessing.synchronize.Barrier] = None) -> _Stats:
+    """
+    Fait tourner les utilisateurs `indices` jusqu'à la fin de la mesure et
+    retourne les statistiques des requêtes envoyées pendant celle-ci.
+
+    La mesure commence quand tous les utilisateurs ont préparé leur boîte,
+    y compris ceux des autres processus s'ils partagent `barrier`.
+    """
+    bodies = _make_bodies(workload)
+    selector = selectors.DefaultSelector()
+    sessions = []
+    for index in indices:
+        session = _Session(index, workload, bodies)
+        selector.register(session.soc, selectors.EVENT_READ, session)
+        sessions.append(session)
+    stats = _Stats()
+
+    def start(session: _Session) -> None:
+        try:
+            session.send(session.next_request())
+        except glosocket.GLOSocketError:
+            stats.disconnects += 1
+            preparing.discard(session)
+            drop(session)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session.writer.pending else 0)
+        selector.modify(session.soc, events, session)
+
+    def drop(session: _Session) -> None:
+        selector.unregister(session.soc)
+        session.soc.close()
+        sessions.remove(session)
+
+    # Préparation: chaque session vide sa file de requêtes initiales
+    preparing = set(sessions)
+    for session in list(sessions):
+        start(session)
+    measuring = False
+    end = float("inf")
+    while sessions:
+        if not measuring and not preparing:
+            if barrier is not None:
+                barrier.wait()
+            measuring = True
+            end = time.perf_counter() + workload.duration
+            for session in list(sessions):
+                start(session)
+        if time.perf_counter() > end + DRAIN_TIMEOUT:
+            break
+
+        for key, events in selector.select(timeout=1.0):
+            session = key.data
+            try:
+                if events & selectors.EVENT_WRITE and session.writer.write_to(session.soc):
+                    selector.modify(session.soc, selectors.EVENT_READ, session)
+                if not events & selectors.EVENT_READ:
+                    continue
+                frames = session.decoder.read_from(session.soc)
+                if session.decoder.eof and not frames:
+                    raise glosocket.GLOSocketError("The server closed the connection.")
+            except glosocket.GLOSocketError:
+                stats.disconnects += 1
+                preparing.discard(session)
+                drop(session)
+                continue
+
+            for frame in frames:
+                now = time.perf_counter()
+                reply = glosocket.decode_message(frame)
+                if measuring:
+                    name = gloutils.Headers(session.request["header"]).name
+                    stats.latencies[name].append(now - session.sent_at)
+                    if reply["header"] == gloutils.Headers.ERROR:
+                        stats.errors[name] += 1
+                session.handle_reply(reply)
+
+                if not measuring:
+                    if session.queue:
+                        start(session)
+                    else:
+                        preparing.discard(session)
+                elif now < end:
+                    start(session)
+                else:
+                    drop(session)
+    if not measuring and barrier is not None:
+        # Toutes les sessions ont été perdues pendant la préparation: les
+        # autres processus attendent quand même celui-ci pour mesurer
+        barrier.wait()
+    for session in sessions:
+        session.soc.close()
+    selector.close()
+    return stats
+
+
+def _run_process(indices: range, workload: Workload,
+                 barrier: multiprocessing.synchronize.Barrier,
+                 results: multiprocessing.Queue) -> None:
+    try:
+        stats = run_sessions(indices, workload, barrier)
+    except BaseException:
+        # Les autres processus ne doivent pas attendre celui-ci à la
+        # barrière, ni run() ses résultats
+        barrier.abort()
+        results.put(None)
+        raise
+    results.put((dict(stats.latencies), dict(stats.errors), stats.disconnects))
+
+
+def run(workload: Workload, processes: int = 1) -> _Stats:
+    """Répartit les utilisateurs entre `processes` processus et fusionne leurs mesures."""
+    if processes == 1:
+        return run_sessions(range(workload.users), workload)
+
+    barrier = multiprocessing.Barrier(processes)
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    children = [multiprocessing.Process(target=_run_process, daemon=True,
+                                        args=(range(p, workload.users, processes),
+                                              workload, barrier, results))
+                for p in range(processes)]
+    for child in children:
+        child.start()
+    stats = _Stats()
+    for _ in children:
+        result = results.get()
+        if result is None:
+            raise RuntimeError("Un processus de charge a échoué.")
+        latencies, errors, disconnects = result
+        child_stats = _Stats()
+        child_stats.latencies.update(latencies)
+        child_stats.errors.update(errors)
+        child_stats.disconnects = disconnects
+        stats.merge(child_stats)
+    for child in children:
+        child.join()
+    return stats
+
+
+def summarize(stats: _Stats, duration: float) -> dict[str, dict]:
+    """Débit et percentiles de latence (ms) de chaque entête et de l'ensemble."""
+    def summary(latencies: list[float], errors: int) -> dict:
+        latencies = sorted(latencies)
+        result = {
+            "count": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / duration,
+            "latency_ms": {},
+        }
+        if latencies:
+            for percentile in PERCENTILES:
+                rank = max(0, min(len(latencies) - 1,
+                                  int(len(latencies) * percentile / 100 + 0.5) - 1))
+                result["latency_ms"][f"p{percentile:g}"] = latencies[rank] * 1e3
+            result["latency_ms"]["mean"] = sum(latencies) / len(latencies) * 1e3
+            result["latency_ms"]["max"] = latencies[-1] * 1e3
+        return result
+
+    results = {name: summary(latencies, stats.errors[name])
+               for name, latencies in sorted(stats.latencies.items())}
+    results["TOTAL"] = summary(
+        [latency for latencies in stats.latencies.values() for latency in latencies],
+        sum(stats.errors.values()))
+    return results
+
+
+def print_report(results: dict[str, dict], baseline: Optional[dict[str, dict]] = None) -> None:
+    """Affiche les résultats, avec l'écart relatif à `baseline` s'il est fourni."""
+    def delta(name: str, value: float, *path: str) -> str:
+        if baseline is None or name not in baseline:
+            return ""
+        old = baseline[name]
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else {}
+        if not isinstance(old, (int, float)) or not old:
+            return ""
+        return f" ({(value - old) / old:+.0%})"
+
+    columns = [f"p{percentile:g}" for percentile in PERCENTILES] + ["max"]
+    print(f"{'entête':<28}{'requêtes':>10}{'erreurs':>9}{'req/s':>18}"
+          + "".join(f"{column + ' ms':>18}" for column in columns))
+    for name, result in results.items():
+        line = (f"{name:<28}{result['count']:>10}{result['errors']:>9}"
+                f"{result['throughput']:>9.1f}{delta(name, result['throughput'], 'throughput'):>9}")
+        for column in columns:
+            value = result["latency_ms"].get(column)
+            if value is None:
+                line += f"{'-':>18}"
+            else:
+                line += f"{value:>9.2f}{delta(name, value, 'latency_ms', column):>9}"
+        print(line)
+
+
+def _parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for item in text.split(","):
+        operation, _, weight = item.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f"opération inconnue: {operation} (choix: {', '.join(OPERATIONS)})")
+        try:
+            mix[operation] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"poids invalide: {item}")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("au moins une opération doit avoir un poids positif")
+    return mix
+
+
+def _git_commit(path: str) -> Optional[str]:
+    """Commit courant du dépôt qui contient le fichier `path`."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(path)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _spawn_server(server_path: str, server_args: list[str],
+                  data_dir: str) -> subprocess.Popen:
+    """Lance le serveur dans `data_dir` et attend qu'il accepte les connexions."""
+    server = subprocess.Popen([sys.executable, os.path.abspath(server_path), *server_args],
+                              cwd=data_dir, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", gloutils.APP_PORT)).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                sys.exit("Le serveur n'a pas démarré.")
+            time.sleep(0.05)
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", action="store", dest="users", type=int, default=100,
+                        help="Nombre d'utilisateurs simulés, chacun avec sa connexion.")
+    parser.add_argument("--duration", action="store", dest="duration", type=float, default=10,
+                        help="Durée de la mesure (secondes).")
+    parser.add_argument("--mix", action="store", dest="mix", type=_parse_mix,
+                        default=_parse_mix(DEFAULT_MIX),
+                        help=f"Poids de chaque opération (défaut: {DEFAULT_MIX}).")
+    parser.add_argument("--seed", action="store", dest="seed", type=int, default=0,
+                        help="Graine du générateur des données et des requêtes.")
+    parser.add_argument("--mailbox-mean", action="store", dest="mailbox_mean",
+                        type=float, default=20,
+                        help="Nombre moyen de courriels par boîte avant la mesure.")
+    parser.add_argument("--mailbox-max", action="store", dest="mailbox_max",
+                        type=int, default=1000,
+                        help="Nombre maximal de courriels par boîte avant la mesure.")
+    parser.add_argument("--content-size", action="store", dest="content_size",
+                        type=int, default=1000,
+                        help="Taille moyenne (caractères) du contenu des courriels.")
+    parser.add_argument("--prefix", action="store", dest="prefix", default="load",
+                        help="Préfixe des noms des utilisateurs simulés.")
+    parser.add_argument("--codec", action="store", dest="codec",
+                        choices=glosocket.CODECS, default=glosocket.CODEC_JSON,
+                        help="Codec négocié avec HELLO.")
+    parser.add_argument("--compression", action="store", dest="compression",
+                        choices=glosocket.COMPRESSIONS, default=None,
+                        help="Compression négociée avec HELLO.")
+    parser.add_argument("--processes", action="store", dest="processes", type=int, default=1,
+                        help="Nombre de processus qui se partagent les utilisateurs.")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Lance TP4_server.py avec un dossier de données vide.")
+    parser.add_argument("--server", action="store", dest="server",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             "TP4_server.py"),
+                        help="Serveur lancé avec --spawn (défaut: celui de ce dossier).")
+    parser.add_argument("--server-args", action="store", dest="server_args", default="",
+                        help="Arguments de TP4_server.py avec --spawn, ex. \"--workers 4\".")
+    parser.add_argument("--output", action="store", dest="output", default=None,
+                        help="Fichier JSON où sauvegarder les résultats.")
+    parser.add_argument("--baseline", action="store", dest="baseline", default=None,
+                        help="Résultats JSON d'une exécution précédente à comparer.")
+    args = parser.parse_args(sys.argv[1:])
+
+    workload = Workload(
+        users=args.users, mix=args.mix, duration=args.duration, seed=args.seed,
+        mailbox_mean=args.mailbox_mean, mailbox_max=args.mailbox_max,
+        content_size=args.content_size, prefix=args.prefix,
+        codec=args.codec, compression=args.compression,
+    )
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)["results"]
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        server = (_spawn_server(args.server, shlex.split(args.server_args), data_dir)
+                  if args.spawn else None)
+        try:
+            stats = run(workload, args.processes)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    results = summarize(stats, workload.duration)
+    print_report(results, baseline)
+    if stats.disconnects:
+        print(f"{stats.disconnects} connexions perdues")
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({
+                "commit": _git_commit(args.server if args.spawn else __file__),
+                "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "server_args": args.server_args if args.spawn else None,
+                "processes": args.processes,
+                "workload": workload._asdict(),
+                "disconnects": stats.disconnects,
+                "results": results,
+            }, file, indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
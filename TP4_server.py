@@ -6,33 +6,198 @@ Noms et numéros étudiants:
 -
 """
 
+import argparse
+import base64
+import binascii
+import bisect
+import collections
+import concurrent.futures
 import hashlib
 import hmac
-import json
+import itertools
 import os
-import select
+import selectors
+import signal
 import socket
 import sys
 import re
-import glob
+import threading
+import time
 import datetime
-import uuid
+from typing import Callable, Iterable, NamedTuple, Optional, TypedDict
+import glolog
+import glometrics
+import gloprofile
+import glosearch
 import glosocket
+import glostore
 import gloutils
 
 
+class EmailIndexEntry(TypedDict, total=True):
+    """Entrée de l'index en mémoire d'une boîte de courriel."""
+    id: int
+    sender: str
+    subject: str
+    date: str
+    timestamp: float
+    location: glostore.RecordLocation
+    size: int
+
+
+SELECTOR_BACKENDS: dict[str, Callable[[], selectors.BaseSelector]] = {
+    name: getattr(selectors, class_name)
+    for name, class_name in (("epoll", "EpollSelector"),
+                             ("kqueue", "KqueueSelector"),
+                             ("devpoll", "DevpollSelector"),
+                             ("poll", "PollSelector"),
+                             ("select", "SelectSelector"))
+    if hasattr(selectors, class_name)
+}
+
+
+# Requêtes qui modifient la session du client: toujours traitées seules
+SESSION_HEADERS = frozenset({
+    gloutils.Headers.AUTH_REGISTER,
+    gloutils.Headers.AUTH_LOGIN,
+    gloutils.Headers.AUTH_LOGOUT,
+    gloutils.Headers.BYE,
+    gloutils.Headers.HELLO,
+})
+
+# Nombre maximal de requêtes d'un même client traitées en parallèle
+MAX_PIPELINE_DEPTH = 16
+
+# L'index de recherche d'une boîte est réécrit sur le disque quand les
+# courriels ajoutés depuis la dernière écriture atteignent cette
+# proportion de l'index (et au moins SEARCH_SAVE_MIN courriels)
+SEARCH_SAVE_RATIO = 0.1
+SEARCH_SAVE_MIN = 1000
+
+# Critères de SearchPayload et champs correspondants des courriels
+SEARCH_FIELDS = (("sender", "sender"), ("subject", "subject"), ("body", "content"))
+
+# Avec un dossier partagé (--workers), intervalle (secondes) entre deux
+# vérifications des boîtes des abonnés: un courriel livré par un autre
+# processus leur est notifié au plus tard après ce délai
+SUBSCRIPTION_POLL_INTERVAL = 0.5
+
+
+class PendingRequest(NamedTuple):
+    """Requête reçue, avec son moment de réception et la taille de sa trame."""
+    message: gloutils.GloMessage
+    received: float
+    size: int
+
+
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, selector_factory: Callable[[], selectors.BaseSelector]
+                 = selectors.DefaultSelector, reuse_port: bool = False,
+                 pool_size: Optional[int] = None,
+                 max_frame_size: int = glosocket.MAX_FRAME_SIZE,
+                 quota: Optional[int] = None, admins: frozenset[str] = frozenset(),
+                 metrics_file: Optional[str] = None,
+                 metrics_port: Optional[int] = None,
+                 metrics_interval: float = 10.0,
+                 profiling: gloprofile.ProfilerOptions = gloprofile.ProfilerOptions(),
+                 event_log: glolog.LogOptions = glolog.LogOptions(),
+                 durability: str = glostore.DURABILITY_BATCHED,
+                 commit_delay: float = 0.0
+                 ) -> None:
         """
         Prépare le socket du serveur `_server_socket`
         et le met en mode écoute.
 
+        Avec `reuse_port`, le socket est lié avec SO_REUSEPORT afin que
+        plusieurs processus serveurs partagent le port et SERVER_DATA_DIR.
+        Les index des boîtes de courriel sont alors resynchronisés avec les
+        segments lorsqu'un autre processus y a livré un courriel.
+
+        Les requêtes qui font des entrées/sorties disque ou du hachage sont
+        traitées par un bassin d'au plus `pool_size` fils d'exécution.
+
+        Les sockets clients sont non bloquants: les messages sont décodés au
+        fil des octets reçus et un client qui annonce un message de plus de
+        `max_frame_size` octets est déconnecté.
+
+        Un courriel n'est pas livré si les courriels du destinataire
+        occuperaient alors plus de `quota` octets.
+
+        La réponse à un envoi n'est transmise qu'une fois les courriels
+        livrés écrits sur le disque, selon `durability`: aucun fsync
+        (DURABILITY_NONE), un fsync par lot d'envois (DURABILITY_BATCHED,
+        lots attendus jusqu'à `commit_delay` secondes) ou un fsync par
+        courriel (DURABILITY_MESSAGE).
+
+        Seuls les utilisateurs de `admins` peuvent demander les métriques
+        (METRICS_REQUEST). Elles sont aussi écrites au format Prometheus
+        dans `metrics_file` toutes les `metrics_interval` secondes et
+        servies en HTTP sur le port local `metrics_port`.
+
+        Les administrateurs peuvent aussi démarrer et arrêter le profilage
+        des requêtes (PROFILING_REQUEST), tout comme le signal SIGUSR1,
+        qui utilise les options `profiling`.
+
+        Les événements (connexions, comptes, envois, erreurs) sont écrits
+        sur la sortie standard en lignes JSON par un fil d'arrière-plan,
+        selon les options `event_log`: la boucle principale n'attend
+        jamais la sortie.
+
         Prépare les attributs suivants:
+        - `_selector` le sélecteur (epoll, kqueue, ...) produit par
+            `selector_factory`, où chaque socket est enregistré une seule fois.
         - `_client_socs` une liste des sockets clients.
+        - `_connection_ids` un dictionnaire associant chaque socket client
+            à son numéro de connexion dans le journal.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
+        - `_users` le registre des comptes: un dictionnaire associant
+            chaque nom d'utilisateur (en minuscules) à l'empreinte de son
+            mot de passe, chargé au démarrage.
+        - `_store` le stockage des courriels (glostore).
+        - `_mailbox_index` un dictionnaire associant chaque nom
+            d'utilisateur à l'index trié de ses courriels.
+        - `_mailbox_ids` un dictionnaire associant chaque nom d'utilisateur
+            aux entrées de son index, par identifiant de courriel.
+        - `_search_indexes` un dictionnaire associant chaque nom
+            d'utilisateur à l'index de recherche de ses courriels, chargé
+            à sa première recherche (glosearch).
+        - `_executor` le bassin de fils d'exécution des requêtes.
+        - `_group_commit` le fil qui rend durables les envois par lots,
+            None sans DURABILITY_BATCHED.
+        - `_request_state` l'état propre au fil du bassin qui traite une
+            requête: les segments où elle a livré des courriels et les
+            notifications à envoyer à sa fin.
+        - `_pending_requests` la file des requêtes en attente de chaque client.
+        - `_inflight` le nombre de requêtes de chaque client dans le bassin.
+        - `_exclusive_clients` les clients dont la requête en cours doit
+            être seule (mode ordonné ou requête qui change la session).
+        - `_unordered_clients` les clients qui acceptent des réponses dans
+            le désordre (négocié avec HELLO).
+        - `_client_codecs` le codec des réponses de chaque client qui en a
+            négocié un autre que JSON avec HELLO.
+        - `_client_compressions` la compression des réponses de chaque
+            client qui en a négocié une avec HELLO.
+        - `_completions` les requêtes terminées, à renvoyer par la boucle
+            principale, qui est réveillée par `_wakeup_writer`.
+        - `_subscriptions` un dictionnaire associant chaque client abonné
+            aux nouveaux courriels au nom de l'utilisateur connecté, et
+            `_subscribers` les clients abonnés de chaque utilisateur,
+            modifiés avec `_subscribers_lock`.
+        - `_notifications` les nouveaux courriels à notifier aux abonnés
+            de leur destinataire, envoyés par la boucle principale.
+        - `_decoders` et `_writers` les files de réception et d'envoi
+            des messages de chaque client.
+        - `_closing_clients` les clients à retirer une fois leurs
+            réponses envoyées.
+        - `_metrics` les métriques des requêtes et les jauges du serveur.
+        - `_profiler` le profileur des requêtes, None hors du profilage.
+        - `_request_runner` la fonction qui traite une requête dans le
+            bassin: `_run_request`, enveloppée par le profileur pendant le
+            profilage.
+        - `_log` le journal d'événements.
 
         S'assure que les dossiers de données du serveur existent.
         """
@@ -41,12 +206,18 @@ class Server:
         # self._logged_users
         # ...
 
+        self._log = glolog.EventLog(event_log, fields={"pid": os.getpid()},
+                                    initializer=_block_stop_signals)
+
         # Creation du socket server
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._shared_data_dir = reuse_port
+        if reuse_port:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             self._server_socket.bind(("127.0.0.1", gloutils.APP_PORT))
-            self._server_socket.listen()
+            self._server_socket.listen(socket.SOMAXCONN)
         except OverflowError:
             sys.exit("Port has bad value")
         except socket.gaierror:
@@ -54,44 +225,194 @@ class Server:
         except PermissionError:
             sys.exit("Port's permission is denied")
         
-        print(f'Server listening to port : {gloutils.APP_PORT}')
+        self._log.info("listening", port=gloutils.APP_PORT)
+
+        # Le socket d'écoute est non bloquant pour vider la file d'attente à chaque réveil
+        self._server_socket.setblocking(False)
+        self._selector = selector_factory()
+        self._selector.register(self._server_socket, selectors.EVENT_READ)
 
         # Intialise les dicts + list
         self._client_socs = []
+        self._connection_ids: dict[socket.socket, int] = {}
+        self._next_connection_id = itertools.count(1)
         self._logged_users = {}
+        self._mailbox_index: dict[str, list[EmailIndexEntry]] = {}
+        self._mailbox_ids: dict[str, dict[int, EmailIndexEntry]] = {}
+        self._search_indexes: dict[str, glosearch.SearchIndex] = {}
+        self._mailbox_locks: dict[str, threading.Lock] = {}
+        
+        # Bassin de fils d'exécution et file des réponses à envoyer
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=pool_size, initializer=_block_stop_signals)
+        self._store = glostore.MailboxStore(gloutils.SERVER_DATA_DIR,
+                                            shared=reuse_port,
+                                            executor=self._executor)
+        self._durability = durability
+        self._group_commit: Optional[glostore.GroupCommit] = None
+        if durability == glostore.DURABILITY_BATCHED:
+            self._group_commit = glostore.GroupCommit(commit_delay,
+                                                      initializer=_block_stop_signals)
+        self._request_state = threading.local()
+        self._pending_requests: dict[socket.socket, collections.deque[PendingRequest]] = {}
+        self._inflight: dict[socket.socket, int] = {}
+        self._exclusive_clients: set[socket.socket] = set()
+        self._unordered_clients: set[socket.socket] = set()
+        self._client_codecs: dict[socket.socket, str] = {}
+        self._client_compressions: dict[socket.socket, str] = {}
+        self._completions: collections.deque[tuple[socket.socket, PendingRequest, concurrent.futures.Future]] = collections.deque()
+        self._subscriptions: dict[socket.socket, str] = {}
+        self._subscribers: dict[str, set[socket.socket]] = {}
+        self._subscribers_lock = threading.Lock()
+        self._notifications: collections.deque[tuple[str, gloutils.EmailSummary]] = collections.deque()
+        self._pushed_notifications = 0
+        self._next_subscription_poll = 0.0
+        self._polling_subscriptions = False
+        self._max_frame_size = max_frame_size
+        self._quota = quota
+        self._decoders: dict[socket.socket, glosocket.FrameDecoder] = {}
+        self._writers: dict[socket.socket, glosocket.FrameWriter] = {}
+        self._closing_clients: set[socket.socket] = set()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
         
         # Verifie l'existence de SERVER_DATA_DIR et SERVER_LOST_DIR
-        data_dir = gloutils.SERVER_DATA_DIR
+        # (exist_ok car plusieurs processus peuvent démarrer en même temps)
         lost_dir = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
+        os.makedirs(lost_dir, exist_ok=True)
+        self._users = self._load_users()
         
-        if  not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-        if not os.path.exists(lost_dir):
-            os.makedirs(lost_dir)
+        self._admins = admins
+        gauges: glometrics.Gauges = {
+            "connected_clients": ("Clients connectés.", lambda: len(self._client_socs)),
+            "logged_users": ("Clients connectés à un compte.", lambda: len(self._logged_users)),
+            "subscribed_clients": ("Clients abonnés aux nouveaux courriels.",
+                                   lambda: len(self._subscriptions)),
+            "pushed_notifications": ("Nouveaux courriels notifiés aux clients abonnés.",
+                                     lambda: self._pushed_notifications),
+            "lost_mailbox_bytes": ("Octets des courriels de la boîte LOST.",
+                                   lambda: self._store.counters(gloutils.SERVER_LOST_DIR).size),
+            "log_dropped_events": ("Événements du journal jetés, sa sortie étant en retard.",
+                                   lambda: self._log.dropped),
+            "log_sampled_out_events": ("Événements du journal écartés par l'échantillonnage.",
+                                       lambda: self._log.sampled_out),
+        }
+        if self._group_commit is not None:
+            gauges["commit_batches"] = ("Lots d'envois rendus durables par un même fsync.",
+                                        lambda: self._group_commit.batches)
+            gauges["committed_requests"] = ("Requêtes d'envoi rendues durables par lot.",
+                                            lambda: self._group_commit.commits)
+        self._metrics = glometrics.ServerMetrics(gauges)
+        self._metrics.start_exporter(metrics_file, metrics_port, metrics_interval,
+                                     initializer=_block_stop_signals)
+        
+        self._profiling_options = profiling
+        self._profiler: Optional[gloprofile.RequestProfiler] = None
+        self._request_runner = self._run_request
+        self._profiling_toggled = False
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._on_profiling_signal)
 
     def cleanup(self) -> None:
         """Ferme toutes les connexions résiduelles."""
-        for client_soc in self._client_socs:
+        for client_soc in list(self._client_socs):
             self._remove_client(client_soc)
             
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self._group_commit is not None:
+            self._group_commit.close()
+        for username, search_index in self._search_indexes.items():
+            if search_index.unsaved:
+                search_index.save(glosearch.index_path(gloutils.SERVER_DATA_DIR, username))
+        self._stop_profiling()
+        self._selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
         self._server_socket.close()
         self._client_socs = []
         self._logged_users = []
+        self._log.close()
 
     def _accept_client(self) -> None:
-        """Accepte un nouveau client."""
-        new_soc, _ = self._server_socket.accept()
-        self._client_socs.append(new_soc)
-        print(f"Accept client {new_soc}")
+        """Accepte tous les nouveaux clients en attente."""
+        while True:
+            try:
+                new_soc, address = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                # Ex.: EMFILE, on réessaiera au prochain réveil
+                self._log.warning("accept_failed", error=str(ex))
+                return
+            new_soc.setblocking(False)
+            # Une réponse peut être envoyée en plusieurs morceaux (sendfile):
+            # sans TCP_NODELAY, le dernier attendrait l'ACK retardé du client
+            new_soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._client_socs.append(new_soc)
+            self._decoders[new_soc] = glosocket.FrameDecoder(self._max_frame_size)
+            self._writers[new_soc] = glosocket.FrameWriter()
+            self._selector.register(new_soc, selectors.EVENT_READ)
+            connection_id = next(self._next_connection_id)
+            self._connection_ids[new_soc] = connection_id
+            self._log.info("client_accepted", conn=connection_id,
+                           peer=f"{address[0]}:{address[1]}")
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
         self._logout(client_soc)
+        self._pending_requests.pop(client_soc, None)
+        self._decoders.pop(client_soc, None)
+        self._writers.pop(client_soc, None)
+        self._closing_clients.discard(client_soc)
+        self._unordered_clients.discard(client_soc)
+        self._client_codecs.pop(client_soc, None)
+        self._client_compressions.pop(client_soc, None)
         if client_soc in self._client_socs:
             self._client_socs.remove(client_soc)
-            print(f"Remove client {client_soc}")
+            try:
+                self._selector.unregister(client_soc)
+            except KeyError:
+                pass # ne lisait plus et n'avait rien à écrire
+            self._log.info("client_removed", conn=self._connection_ids.get(client_soc))
+        self._connection_ids.pop(client_soc, None)
         client_soc.close()
 
+    def _update_interest(self, client_soc: socket.socket) -> None:
+        """
+        Ajuste les événements surveillés pour le client: lecture tant qu'il
+        n'est pas en fermeture, écriture tant qu'il reste des octets à envoyer.
+        """
+        events = 0
+        if client_soc not in self._closing_clients:
+            events |= selectors.EVENT_READ
+        if self._writers[client_soc].pending:
+            events |= selectors.EVENT_WRITE
+        
+        try:
+            key = self._selector.get_key(client_soc)
+        except KeyError:
+            key = None
+        if key is None:
+            if events:
+                self._selector.register(client_soc, events)
+        elif not events:
+            self._selector.unregister(client_soc)
+        elif key.events != events:
+            self._selector.modify(client_soc, events)
+
+    def _remove_if_done(self, client_soc: socket.socket) -> None:
+        """
+        Retire un client en fermeture (BYE reçu ou connexion fermée par
+        l'autre bout) une fois toutes ses réponses envoyées.
+        """
+        if (client_soc in self._closing_clients
+                and not self._inflight.get(client_soc)
+                and not self._pending_requests.get(client_soc)
+                and not self._writers[client_soc].pending):
+            self._remove_client(client_soc)
+
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
                         ) -> gloutils.GloMessage:
@@ -103,13 +424,10 @@ class Server:
         sinon retourne un message d'erreur.
         """
         
-        print(f"Creating account : {client_soc}")
-        
         output_message : gloutils.GloMessage = gloutils.GloMessage(
             header=gloutils.Headers.OK
         )
         
-        users_name_lower = self._get_list_users()
         username = payload["username"].lower()
         error_message = "La création à échouée : \n"
         
@@ -122,7 +440,9 @@ class Server:
                 )
             )
         
-        if username in users_name_lower:
+        # Le dossier des courriels perdus n'est pas un compte
+        if (self._find_user(username) is not None
+                or username == gloutils.SERVER_LOST_DIR.lower()):
             error_message += "- Le nom d'utilisateur est déjà pris. Veuillez entrer un autre nom d'utilisateur. \n"
             output_message = gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
@@ -145,15 +465,29 @@ class Server:
             new_folder_path = os.path.join(gloutils.SERVER_DATA_DIR, username)
             password_file_path = os.path.join(new_folder_path, gloutils.PASSWORD_FILENAME)
             hashed_password = hashlib.sha3_512(payload["password"].encode('utf-8'))
-            os.makedirs(new_folder_path, exist_ok=True)
             
-            # Saves passowrd to user folder
-            with open(password_file_path, 'w') as file:
-                file.write(hashed_password.hexdigest())
+            # os.mkdir est atomique: un seul processus peut réserver le nom
+            try:
+                os.mkdir(new_folder_path)
+            except FileExistsError:
+                error_message += "- Le nom d'utilisateur est déjà pris. Veuillez entrer un autre nom d'utilisateur. \n"
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(
+                        error_message=error_message
+                    )
+                )
+            
+            # Saves passowrd to user folder, then registers the user
+            self._write_file_atomically(password_file_path, hashed_password.hexdigest())
+            self._users[username] = hashed_password.hexdigest()
             
             # Updates the logged users dict
             self._logged_users[client_soc] = payload["username"].lower()
         
+        self._log.info("account_created" if output_message["header"] == gloutils.Headers.OK
+                       else "account_refused",
+                       conn=self._connection_ids.get(client_soc), user=username)
         return output_message
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
@@ -165,16 +499,14 @@ class Server:
         retourne un succès, sinon retourne un message d'erreur.
         """
         
-        print(f"Logging into account : {client_soc}")
-        
         output_message = gloutils.GloMessage(
             header=gloutils.Headers.OK
         )
     
-        folderpaths_name = self._get_list_users()
         username = payload["username"].lower()
+        expected_hash = self._find_user(username)
         
-        if not username in folderpaths_name or username == "lost":
+        if expected_hash is None:
             output_message = gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
@@ -182,35 +514,80 @@ class Server:
                 )
             )
         else:
-            userfile_path = os.path.join(gloutils.SERVER_DATA_DIR, username)
-            password_path = os.path.join(userfile_path, gloutils.PASSWORD_FILENAME)
-            with open(password_path, "r") as file:
-                expected_hash = file.readline()
-                encoded_text = payload["password"].encode("utf-8")
-                hasher = hashlib.sha3_512()
-                hasher.update(encoded_text)
-                
-                if hmac.compare_digest(hasher.hexdigest(), expected_hash):
-                    # updates the dict with the logged in user
-                    self._logged_users[client_soc] = username
-                else:
-                    output_message = gloutils.GloMessage(
-                        header=gloutils.Headers.ERROR,
-                        payload=gloutils.ErrorPayload(
-                            error_message="Mot de passe invalide."
-                    )
+            encoded_text = payload["password"].encode("utf-8")
+            hasher = hashlib.sha3_512()
+            hasher.update(encoded_text)
+            
+            if hmac.compare_digest(hasher.hexdigest(), expected_hash):
+                # updates the dict with the logged in user
+                self._logged_users[client_soc] = username
+            else:
+                output_message = gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(
+                        error_message="Mot de passe invalide."
                 )
-                
+            )
+        
+        self._log.info("login", conn=self._connection_ids.get(client_soc), user=username,
+                       ok=output_message["header"] == gloutils.Headers.OK)
         return output_message
 
     def _logout(self, client_soc: socket.socket) -> None:
         """Déconnecte un utilisateur."""
+        self._unsubscribe(client_soc)
         if client_soc in self._logged_users.keys():
-            print(f"Loggout : {self._logged_users[client_soc]}")
+            self._log.info("logout", conn=self._connection_ids.get(client_soc),
+                           user=self._logged_users[client_soc])
             del self._logged_users[client_soc]
-            
 
-    def _get_email_list(self, client_soc: socket.socket
+    def _subscribe(self, client_soc: socket.socket,
+                   payload: gloutils.SubscribePayload) -> gloutils.GloMessage:
+        """
+        Abonne le client aux nouveaux courriels de son compte, ou le
+        désabonne. Un abonné reçoit une notification NEW_EMAIL pour chaque
+        courriel qui arrive dans sa boîte, jusqu'à la déconnexion du compte.
+
+        Avec un dossier partagé, l'index de la boîte est d'abord mis à jour:
+        les courriels qui s'y ajouteront ensuite sont ceux à notifier.
+        """
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Vous devez être connecté pour vous abonner aux courriels."
+                )
+            )
+        
+        if not payload["enabled"]:
+            self._unsubscribe(client_soc)
+        else:
+            with self._get_mailbox_lock(username):
+                if self._shared_data_dir:
+                    self._sync_mailbox_index(username)
+                with self._subscribers_lock:
+                    self._subscriptions[client_soc] = username
+                    self._subscribers.setdefault(username, set()).add(client_soc)
+        self._log.info("subscribe", conn=self._connection_ids.get(client_soc), user=username,
+                       enabled=payload["enabled"])
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+        )
+
+    def _unsubscribe(self, client_soc: socket.socket) -> None:
+        """Retire l'abonnement du client aux nouveaux courriels, s'il en a un."""
+        with self._subscribers_lock:
+            username = self._subscriptions.pop(client_soc, None)
+            if username is None:
+                return
+            sockets = self._subscribers[username]
+            sockets.discard(client_soc)
+            if not sockets:
+                del self._subscribers[username]
+
+    def _get_email_list(self, client_soc: socket.socket,
+                        payload: Optional[gloutils.EmailListRequestPayload] = None
                         ) -> gloutils.GloMessage:
         """
         Récupère la liste des courriels de l'utilisateur associé au socket.
@@ -218,26 +595,198 @@ class Server:
         SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
 
         Une absence de courriel n'est pas une erreur, mais une liste vide.
+
+        Si le payload est fourni, seule une page de `limit` courriels à
+        partir de `cursor` est retournée, avec le curseur de la page
+        suivante. Avec `fields`, les courriels sont retournés sous forme
+        de champs (parmi EMAIL_SUMMARY_FIELDS) plutôt que de texte.
         """
-        email_list = self._get_sorted_email_list(client_soc)
+        if payload is None:
+            email_list = self._get_mailbox_index(self._logged_users[client_soc])
+            return gloutils.GloMessage(
+                header=gloutils.Headers.OK,
+                payload=gloutils.EmailListPayload(
+                    email_list = self._format_email_list(
+                        email_list, range(1, len(email_list) + 1))
+                )
+            )
+        
+        limit = payload.get("limit", gloutils.MAX_PAGE_SIZE)
+        fields = payload.get("fields")
+        try:
+            offset = self._decode_cursor(payload.get("cursor"))
+        except ValueError:
+            offset = None
+        if (offset is None or not 1 <= limit <= gloutils.MAX_PAGE_SIZE
+                or (fields is not None and not set(fields) <= gloutils.EMAIL_SUMMARY_FIELDS)):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Requête de liste de courriels invalide."
+                )
+            )
+        
+        # Un courriel de plus pour savoir s'il y a une page suivante
+        email_list = self._get_mailbox_index(self._logged_users[client_soc],
+                                             offset, offset + limit + 1)
+        page = gloutils.EmailPagePayload()
+        if len(email_list) > limit:
+            email_list = email_list[:limit]
+            page["next_cursor"] = self._encode_cursor(offset + limit)
+        
+        numbers = range(offset + 1, offset + len(email_list) + 1)
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=self._fill_email_page(page, email_list, numbers, fields)
+        )
+
+    def _fill_email_page(self, page: gloutils.EmailPagePayload,
+                         email_list: list[EmailIndexEntry], numbers: Iterable[int],
+                         fields: Optional[list[str]]) -> gloutils.EmailPagePayload:
+        """
+        Ajoute à la page les courriels, numérotés par `numbers`: des lignes
+        SUBJECT_DISPLAY, ou leurs champs `fields`.
+        """
+        if fields is None:
+            page["email_list"] = self._format_email_list(email_list, numbers)
+        else:
+            page["emails"] = [
+                {field: (number if field == "number" else email[field])
+                 for field in fields}
+                for number, email in zip(numbers, email_list)
+            ]
+        return page
+
+    def _format_email_list(self, email_list: list[EmailIndexEntry],
+                           numbers: Iterable[int]) -> list[str]:
+        """Construit les lignes SUBJECT_DISPLAY, numérotées par `numbers`."""
         email_list_str = []
         
-        for i, email in enumerate(email_list):
+        for number, email in zip(numbers, email_list):
             email_list_str.append(gloutils.SUBJECT_DISPLAY.format(
-                number=i+1, # numbering starts at 1
+                number=number,
                 sender=email["sender"],
                 subject=email["subject"],
                 date=email["date"]
             ))
+        return email_list_str
 
-        output_message = gloutils.GloMessage(
-            header=gloutils.Headers.OK,
-            payload=gloutils.EmailListPayload(
-                email_list = email_list_str
+    def _search(self, client_soc: socket.socket,
+                payload: gloutils.SearchPayload) -> gloutils.GloMessage:
+        """
+        Cherche les courriels de l'utilisateur associé au socket selon les
+        critères du payload, avec son index de recherche pour les mots et
+        son index trié par date pour l'intervalle de dates.
+
+        Retourne une page de résultats comme `_get_email_list`, dans
+        l'ordre de la liste des courriels et numérotés selon leur position
+        dans celle-ci (le numéro à donner à INBOX_READING_CHOICE).
+        """
+        query = {field: payload[criterion] for criterion, field in SEARCH_FIELDS
+                 if payload.get(criterion)}
+        # Un critère sans aucun mot cherchable ne doit pas devenir une
+        # recherche sans critère, qui retournerait tous les courriels
+        terms = all(isinstance(text, str) and glosearch.tokenize(text)
+                    for text in query.values())
+        limit = payload.get("limit", gloutils.MAX_PAGE_SIZE)
+        fields = payload.get("fields")
+        try:
+            offset = self._decode_cursor(payload.get("cursor"))
+            since = self._parse_email_date(payload["since"]) if "since" in payload else None
+            until = self._parse_email_date(payload["until"]) if "until" in payload else None
+        except (TypeError, ValueError):
+            offset = None
+        if (offset is None or not terms or not 1 <= limit <= gloutils.MAX_PAGE_SIZE
+                or (fields is not None and not set(fields) <= gloutils.EMAIL_SUMMARY_FIELDS)
+                or not (query or since is not None or until is not None)):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Requête de recherche invalide."
+                )
             )
+        
+        username = self._logged_users[client_soc]
+        with self._get_mailbox_lock(username):
+            self._sync_mailbox_index(username)
+            index = self._mailbox_index[username]
+            timestamp = lambda entry: entry["timestamp"]
+            start = 0 if since is None else bisect.bisect_left(index, since, key=timestamp)
+            stop = len(index) if until is None else bisect.bisect_right(index, until, key=timestamp)
+            matches = (None if not query
+                       else self._get_search_index(username).search(query))
+            if matches is None:
+                positions = range(start, stop)
+            else:
+                # Un résultat de plus pour savoir s'il y a une page suivante
+                positions = self._find_positions(username, matches, start, stop,
+                                                 offset + limit + 1)
+            page_positions = positions[offset:offset + limit]
+            email_list = [index[position] for position in page_positions]
+        
+        page = gloutils.EmailPagePayload()
+        if offset + limit < len(positions):
+            page["next_cursor"] = self._encode_cursor(offset + limit)
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=self._fill_email_page(
+                page, email_list, [position + 1 for position in page_positions], fields)
         )
+
+    def _find_positions(self, username: str, email_ids: set[int],
+                        start: int, stop: int, count: int) -> list[int]:
+        """
+        Retourne les `count` premières positions, entre `start` et `stop`
+        dans l'index de l'utilisateur, des courriels `email_ids` encore
+        présents. Doit être appelée avec le verrou de la boîte.
+        """
+        index = self._mailbox_index[username]
+        ids = self._mailbox_ids[username]
+        if len(email_ids) * 16 >= stop - start:
+            # Beaucoup de résultats: parcourir la tranche jusqu'à en avoir
+            # assez est plus rapide
+            positions = []
+            for position in range(start, stop):
+                if index[position]["id"] in email_ids:
+                    positions.append(position)
+                    if len(positions) == count:
+                        break
+            return positions
         
-        return output_message
+        positions = []
+        for email_id in email_ids:
+            entry = ids.get(email_id)
+            if entry is None:
+                continue # supprimé
+            position = bisect.bisect_left(index, entry["timestamp"],
+                                          lo=start, hi=stop, key=lambda entry: entry["timestamp"])
+            # Courriels de même date: chercher l'entrée parmi eux
+            while position < stop and index[position] is not entry:
+                if index[position]["timestamp"] != entry["timestamp"]:
+                    position = stop
+                    break
+                position += 1
+            if position < stop:
+                positions.append(position)
+        positions.sort()
+        return positions[:count]
+
+    def _encode_cursor(self, offset: int) -> str:
+        return base64.urlsafe_b64encode(f"o:{offset}".encode()).decode()
+
+    def _decode_cursor(self, cursor: Optional[str]) -> int:
+        """Retourne la position encodée dans le curseur (0 si absent)."""
+        if cursor is None:
+            return 0
+        if not isinstance(cursor, str):
+            raise ValueError("invalid cursor")
+        try:
+            kind, offset = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        except (binascii.Error, UnicodeError):
+            raise ValueError("invalid cursor")
+        if kind != "o" or not offset.isdigit():
+            raise ValueError("invalid cursor")
+        return int(offset)
 
     def _get_email(self, client_soc: socket.socket,
                    payload: gloutils.EmailChoicePayload
@@ -246,35 +795,104 @@ class Server:
         Récupère le contenu de l'email dans le dossier de l'utilisateur associé
         au socket.
         """
-        index = payload["choice"] - 1 # because numering on client side, starts at 1
-        email_list = self._get_sorted_email_list(client_soc)
+        entry = self._get_chosen_entry(self._logged_users[client_soc], payload["choice"])
+        if entry is None:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Choix de courriel invalide."
+                )
+            )
+        
+        output_message = gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=self._read_email(entry)
+        )
+        
+        return output_message
+
+    def _get_chosen_entry(self, username: str, choice: int) -> Optional[EmailIndexEntry]:
+        """
+        Retourne l'entrée de l'index du courriel numéro `choice` de la liste
+        de l'utilisateur (numérotée à partir de 1 côté client), ou None si
+        ce numéro n'existe pas.
+        """
+        if not isinstance(choice, int) or isinstance(choice, bool) or choice < 1:
+            return None
+        email_list = self._get_mailbox_index(username, choice - 1, choice)
+        return email_list[0] if email_list else None
+
+    def _get_emails(self, client_soc: socket.socket,
+                    payload: gloutils.EmailBatchChoicePayload
+                    ) -> gloutils.GloMessage:
+        """
+        Récupère le contenu de plusieurs courriels de l'utilisateur associé
+        au socket, dans l'ordre des choix, avec une seule consultation de
+        l'index.
+        """
+        email_list = self._get_mailbox_index(self._logged_users[client_soc])
+        
+        if not all(1 <= choice <= len(email_list) for choice in payload["choices"]):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Choix de courriel invalide."
+                )
+            )
         
         output_message = gloutils.GloMessage(
             header=gloutils.Headers.OK,
-            payload=email_list[index]
+            payload=gloutils.EmailBatchContentPayload(
+                emails=[self._read_email(email_list[choice - 1])
+                        for choice in payload["choices"]]
+            )
         )
         
         return output_message
 
+    def _get_email_by_id(self, client_soc: socket.socket,
+                         payload: gloutils.EmailIdPayload
+                         ) -> gloutils.GloMessage:
+        """
+        Récupère le courriel de l'utilisateur associé au socket à partir de
+        son identifiant, sans parcourir la liste de ses courriels.
+        """
+        entry = self._get_mailbox_entry(self._logged_users[client_soc], payload["id"])
+        if entry is None:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Courriel introuvable."
+                )
+            )
+        
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=self._read_email(entry)
+        )
+
+    def _read_email(self, entry: EmailIndexEntry) -> gloutils.EmailContentPayload:
+        """Lit sur le disque le courriel correspondant à l'entrée de l'index."""
+        return self._store.read(entry["location"])
+
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
         de l'utilisateur associé au socket.
         """
         
-        email_list = self._get_sorted_email_list(client_soc)
         username = self._logged_users[client_soc]
-        folder_size = 0
-        user_folder = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        for path, dirs, files in os.walk(user_folder):
-            for f in files:
-                file_path = os.path.join(path, f)
-                folder_size += os.path.getsize(file_path)
+        # Compteurs tenus à jour par le stockage, sans parcourir la boîte
+        counters = self._store.counters(username)
+        
+        # La taille du dossier est celle des courriels plus celle du fichier de mot de passe
+        password_path = os.path.join(gloutils.SERVER_DATA_DIR, username, gloutils.PASSWORD_FILENAME)
+        folder_size = os.path.getsize(password_path) + counters.size
                 
         output_message = gloutils.GloMessage(
             header=gloutils.Headers.OK,
             payload=gloutils.StatsPayload(
-                count=len(email_list),
+                count=counters.count,
                 size=folder_size,
             )
         )
@@ -282,8 +900,8 @@ class Server:
         return output_message
         
 
-    def _send_email(self, payload: gloutils.EmailContentPayload
-                    ) -> gloutils.GloMessage:
+    def _send_email(self, client_soc: socket.socket,
+                    payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
         """
         Détermine si l'envoi est interne ou externe et:
         - Si l'envoi est interne, écris le message tel quel dans le dossier
@@ -294,151 +912,1144 @@ class Server:
 
         Retourne un messange indiquant le succès ou l'échec de l'opération.
         """
-        output_message = gloutils.GloMessage(
-            header=gloutils.Headers.OK,
-        )
+        status, error_message = self._deliver_email(payload)
+        self._log.info("email_sent", conn=self._connection_ids.get(client_soc),
+                       to=payload["destination"], status=status.name)
         
-        if not re.search(r"^[a-zA-Z0-9_\.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-\.]+$", payload["destination"]):
-            output_message = gloutils.GloMessage(
+        if status != gloutils.DeliveryStatus.DELIVERED:
+            return gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
-                    error_message="Adresse courriel invalide pour le destinataire"
+                    error_message=error_message
                 )
             )
-        elif not re.search(rf"{gloutils.SERVER_DOMAIN}$", payload["destination"]):
-            output_message = gloutils.GloMessage(
-                header=gloutils.Headers.ERROR,
-                payload=gloutils.ErrorPayload(
-                    error_message="Le destinataire est un destinataire externe. Veuillez communiquer seulement à l'interne"
-                )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+        )
+
+    def _send_batch_email(self, client_soc: socket.socket,
+                          payload: gloutils.EmailBatchPayload) -> gloutils.GloMessage:
+        """
+        Envoie le même courriel à chaque destinataire de la liste comme le
+        ferait `_send_email`. Les doublons sont ignorés.
+
+        Retourne le résultat de la livraison pour chaque destinataire, même
+        si elle a échoué pour certains.
+        """
+        results: list[gloutils.DeliveryResult] = []
+        seen = set()
+        
+        for destination in payload["destinations"]:
+            if destination.lower() in seen:
+                continue
+            seen.add(destination.lower())
+            
+            email = gloutils.EmailContentPayload(
+                sender=payload["sender"],
+                destination=destination,
+                subject=payload["subject"],
+                date=payload["date"],
+                content=payload["content"],
+            )
+            try:
+                status, error_message = self._deliver_email(email)
+            except Exception as ex:
+                # Les destinataires précédents ont déjà reçu le courriel: la
+                # réponse doit le dire, pour qu'un nouvel essai ne les vise pas
+                self._log.error("delivery_failed", conn=self._connection_ids.get(client_soc),
+                                to=destination, error=repr(ex))
+                status = gloutils.DeliveryStatus.FAILED
+                error_message = "La livraison au destinataire a échoué."
+            self._log.info("email_sent", conn=self._connection_ids.get(client_soc),
+                           to=destination, status=status.name)
+            results.append(gloutils.DeliveryResult(
+                destination=destination,
+                status=status,
+                error_message=error_message,
+            ))
+        
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.BatchDeliveryPayload(
+                results=results
             )
+        )
+
+    def _deliver_email(self, payload: gloutils.EmailContentPayload
+                       ) -> tuple[gloutils.DeliveryStatus, str]:
+        """
+        Livre le courriel à son destinataire s'il a un compte.
+
+        Retourne le statut de la livraison et le message d'erreur associé
+        (vide si le courriel est livré).
+        """
+        if not re.search(r"^[a-zA-Z0-9_\.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-\.]+$", payload["destination"]):
+            return (gloutils.DeliveryStatus.FAILED,
+                    "Adresse courriel invalide pour le destinataire")
+        if not re.search(rf"{gloutils.SERVER_DOMAIN}$", payload["destination"]):
+            return (gloutils.DeliveryStatus.FAILED,
+                    "Le destinataire est un destinataire externe. Veuillez communiquer seulement à l'interne")
+        try:
+            # Un courriel stocké doit pouvoir être classé par date
+            self._parse_email_date(payload["date"])
+        except ValueError:
+            return gloutils.DeliveryStatus.FAILED, "La date du courriel est invalide."
+        
+        nom_destinataire = payload["destination"][:-len(gloutils.SERVER_DOMAIN)-1].lower() # remove the SERVER_DOMAIN ending
+        if self._find_user(nom_destinataire) is None:
+            self._make_durable(self._store.append(gloutils.SERVER_LOST_DIR, payload))
+            return (gloutils.DeliveryStatus.LOST,
+                    "Le destinataire n'existe pas à l'interne.")
+        
+        try:
+            stored = self._store.append(nom_destinataire, payload, quota=self._quota)
+        except glostore.QuotaExceededError:
+            return (gloutils.DeliveryStatus.FAILED,
+                    "La boîte courriel du destinataire est pleine.")
+        
+        self._make_durable(stored)
+        self._index_email(nom_destinataire, stored)
+        return gloutils.DeliveryStatus.DELIVERED, ""
+
+    def _make_durable(self, stored: glostore.StoredEmail) -> None:
+        """
+        Selon la durabilité du serveur, force tout de suite l'écriture du
+        courriel livré sur le disque (DURABILITY_MESSAGE) ou note son
+        segment pour le lot de la requête en cours (DURABILITY_BATCHED).
+        """
+        if self._durability == glostore.DURABILITY_MESSAGE:
+            stored.location.segment.sync()
+        elif self._durability == glostore.DURABILITY_BATCHED:
+            segments = self._request_state.segments
+            segments.add(stored.location.segment)
+            if len(segments) >= glostore.MAX_OPEN_MAILBOXES:
+                # Envoi à beaucoup de destinataires: les segments notés
+                # garderaient leurs fichiers ouverts jusqu'au lot
+                for segment in segments:
+                    segment.sync()
+                segments.clear()
+
+    def _write_file_atomically(self, path: str, data: str) -> None:
+        """
+        Écris dans un fichier temporaire puis le renomme, pour qu'un autre
+        processus ne lise jamais un fichier à moitié écrit.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    
+    def _parse_email_date(self, date: str) -> float:
+        """Lève une exception ValueError si la date est invalide."""
+        try:
+            return datetime.datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %z").timestamp()
+        except (TypeError, OverflowError) as ex:
+            raise ValueError(f"Invalid date {date!r}") from ex
+
+    def _make_index_entry(self, stored: glostore.StoredEmail) -> EmailIndexEntry:
+        try:
+            timestamp = self._parse_email_date(stored.email["date"])
+        except ValueError:
+            # Courriel stocké avant la validation des dates: classé selon la
+            # dernière écriture de son segment plutôt que de rendre la
+            # boîte illisible
+            timestamp = os.fstat(stored.location.segment.fileno()).st_mtime
+        return EmailIndexEntry(
+            id=stored.email_id,
+            sender=stored.email["sender"],
+            subject=stored.email["subject"],
+            date=stored.email["date"],
+            timestamp=timestamp,
+            location=stored.location,
+            size=stored.location.size,
+        )
+
+    def _build_mailbox_index(self, username: str) -> None:
+        """
+        Construit l'index des courriels de l'utilisateur à partir de ses
+        segments, trié du plus ancien au plus récent.
+        """
+        emails = self._store.load(username)
+        index = [self._make_index_entry(stored) for stored in emails]
+        index.sort(key=lambda entry: entry["timestamp"])
+        self._mailbox_index[username] = index
+        self._mailbox_ids[username] = {entry["id"]: entry for entry in index}
+        if username in self._search_indexes:
+            for stored in emails:
+                self._add_to_search_index(username, stored)
+
+    def _refresh_mailbox_index(self, username: str) -> None:
+        """
+        Ajoute à l'index les courriels livrés par un autre processus et
+        retire ceux qu'il a supprimés. Seule la fin des segments est lue;
+        après une compaction, l'index est reconstruit.
+        """
+        changes = self._store.poll(username)
+        if changes is None:
+            self._build_mailbox_index(username)
+            return
+        added, deleted = changes
+        index = self._mailbox_index[username]
+        ids = self._mailbox_ids[username]
+        if deleted:
+            removed = {(location.segment.number, location.offset) for location in deleted}
+            index[:] = [entry for entry in index
+                        if (entry["location"].segment.number, entry["location"].offset) not in removed]
+            ids.clear()
+            ids.update((entry["id"], entry) for entry in index)
+        for stored in added:
+            entry = self._make_index_entry(stored)
+            bisect.insort(index, entry, key=lambda entry: entry["timestamp"])
+            ids[entry["id"]] = entry
+            self._add_to_search_index(username, stored)
+            self._queue_notification(username, stored)
+
+    def _get_mailbox_index(self, username: str, start: int = 0,
+                           stop: Optional[int] = None) -> list[EmailIndexEntry]:
+        """
+        Retourne l'index trié des courriels de l'utilisateur, ou la tranche
+        [start:stop] de celui-ci.
+
+        L'index est construit à la première consultation, puis maintenu
+        en mémoire par `_index_email`. Si le dossier est partagé avec
+        d'autres processus, il est resynchronisé avec la fin des segments.
+        """
+        with self._get_mailbox_lock(username):
+            self._sync_mailbox_index(username)
+            # Copie, car d'autres fils d'exécution peuvent modifier l'index
+            return self._mailbox_index[username][start:stop]
+
+    def _get_mailbox_entry(self, username: str, email_id: int) -> Optional[EmailIndexEntry]:
+        """
+        Retourne l'entrée de l'index pour le courriel `email_id` de
+        l'utilisateur, ou None s'il n'existe pas.
+        """
+        with self._get_mailbox_lock(username):
+            self._sync_mailbox_index(username)
+            return self._mailbox_ids[username].get(email_id)
+
+    def _sync_mailbox_index(self, username: str) -> None:
+        """
+        Construit l'index de l'utilisateur à la première consultation ou le
+        resynchronise avec les segments. Doit être appelée avec le verrou
+        de la boîte.
+        """
+        if username not in self._mailbox_index:
+            self._build_mailbox_index(username)
         else:
-            nom_destinataire = payload["destination"][:-len(gloutils.SERVER_DOMAIN)-1].lower() # remove the SERVER_DOMAIN ending
-            print("Envoi de courriel vers : ", nom_destinataire)
-            folderpaths_name = self._get_list_users()
-            
-            if not nom_destinataire in folderpaths_name:
-                output_message = gloutils.GloMessage(
-                    header=gloutils.Headers.ERROR,
-                    payload=gloutils.ErrorPayload(
-                        error_message="Le destinataire n'existe pas à l'interne."
-                    )
-                )
-                
-                lost_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
-                lost_file = os.path.join(lost_path, self._get_email_name())
-                
-                with open(lost_file, 'w') as file:
-                    json.dump(payload, file, ensure_ascii=False, indent=4)
-            else:
-                email_path = os.path.join(gloutils.SERVER_DATA_DIR, nom_destinataire)
-                email_file = os.path.join(email_path, self._get_email_name())
-                
-                with open(email_file, 'w') as file:
-                    json.dump(payload, file, ensure_ascii=False, indent=4)
-                    
-        return output_message
+            self._refresh_mailbox_index(username)
+
+    def _get_mailbox_lock(self, username: str) -> threading.Lock:
+        """Verrou protégeant l'index de la boîte de courriel de l'utilisateur."""
+        return self._mailbox_locks.setdefault(username, threading.Lock())
+
+    def _index_email(self, username: str, stored: glostore.StoredEmail) -> None:
+        """
+        Ajoute un courriel livré à l'index de l'utilisateur s'il est déjà
+        construit et le note pour ses abonnés. Si le dossier est partagé, le
+        courriel sera plutôt lu dans le segment par `_refresh_mailbox_index`,
+        comme ceux des autres processus: tout de suite si l'utilisateur est
+        abonné, pour le notifier sans attendre.
+        """
+        if self._shared_data_dir:
+            if username in self._subscribers:
+                with self._get_mailbox_lock(username):
+                    if username in self._mailbox_index:
+                        self._refresh_mailbox_index(username)
+            return
+        entry = self._make_index_entry(stored)
+        with self._get_mailbox_lock(username):
+            # L'index a pu être construit après l'ajout au stockage: il
+            # contient alors déjà le courriel
+            if (username in self._mailbox_index
+                    and entry["id"] not in self._mailbox_ids[username]):
+                bisect.insort(self._mailbox_index[username], entry,
+                              key=lambda entry: entry["timestamp"])
+                self._mailbox_ids[username][entry["id"]] = entry
+                self._add_to_search_index(username, stored)
+            self._queue_notification(username, stored)
+
+    def _queue_notification(self, username: str, stored: glostore.StoredEmail) -> None:
+        """
+        Note le nouveau courriel pour les abonnés de l'utilisateur: il leur
+        sera notifié à la fin de la requête en cours. Doit être appelée avec
+        le verrou de la boîte.
+        """
+        if username in self._subscribers:
+            self._request_state.notifications.append((username, gloutils.EmailSummary(
+                id=stored.email_id,
+                sender=stored.email["sender"],
+                subject=stored.email["subject"],
+                date=stored.email["date"],
+                size=stored.location.size,
+            )))
+
+    def _get_search_index(self, username: str) -> glosearch.SearchIndex:
+        """
+        Retourne l'index de recherche de l'utilisateur. À la première
+        recherche, il est lu sur le disque, puis les courriels qui n'y sont
+        pas encore (livrés après sa dernière écriture) y sont ajoutés.
+        Doit être appelée avec le verrou de la boîte, son index à jour.
+        """
+        search_index = self._search_indexes.get(username)
+        if search_index is not None:
+            return search_index
+        
+        path = glosearch.index_path(gloutils.SERVER_DATA_DIR, username)
+        try:
+            search_index = glosearch.SearchIndex.load(path)
+        except FileNotFoundError:
+            search_index = glosearch.SearchIndex()
+        except ValueError as ex:
+            self._log.warning("search_index_invalid", user=username, error=str(ex))
+            search_index = glosearch.SearchIndex()
+        ids = self._mailbox_ids[username]
+        for email_id in sorted(ids.keys() - search_index.ids()):
+            search_index.add(email_id, self._read_email(ids[email_id]))
+        self._search_indexes[username] = search_index
+        self._save_search_index(username, search_index)
+        return search_index
+
+    def _add_to_search_index(self, username: str, stored: glostore.StoredEmail) -> None:
+        """
+        Ajoute le courriel à l'index de recherche de l'utilisateur, s'il est
+        chargé. Doit être appelée avec le verrou de la boîte.
+        """
+        search_index = self._search_indexes.get(username)
+        if search_index is not None:
+            search_index.add(stored.email_id, stored.email)
+            self._save_search_index(username, search_index)
+
+    def _save_search_index(self, username: str, search_index: glosearch.SearchIndex) -> None:
+        """
+        Réécrit l'index de recherche si assez de courriels y ont été ajoutés:
+        les autres seront indexés de nouveau au prochain chargement.
+        """
+        if search_index.unsaved >= max(SEARCH_SAVE_MIN, SEARCH_SAVE_RATIO * len(search_index)):
+            search_index.save(glosearch.index_path(gloutils.SERVER_DATA_DIR, username))
     
-    def _get_email_name(self) -> str: 
-        return str(uuid.uuid4()) + ".json"
+    def _load_users(self) -> dict[str, str]:
+        """
+        Lit l'empreinte du mot de passe de chaque compte de SERVER_DATA_DIR.
+        Les dossiers sans fichier de mot de passe (LOST, compte en cours de
+        création) sont ignorés.
+        """
+        users = {}
+        with os.scandir(gloutils.SERVER_DATA_DIR) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                password_path = os.path.join(entry.path, gloutils.PASSWORD_FILENAME)
+                try:
+                    with open(password_path, "r") as file:
+                        users[entry.name.lower()] = file.readline()
+                except FileNotFoundError:
+                    pass
+        return users
     
-    def _sort_email_list(self, email_list : list[gloutils.EmailContentPayload]):
-        email_list.sort(key=lambda date: datetime.datetime.strptime(date["date"], "%a, %d %b %Y %H:%M:%S %z"))
-        return email_list
+    def _find_user(self, username: str) -> Optional[str]:
+        """
+        Retourne l'empreinte du mot de passe de l'utilisateur, ou None s'il
+        n'a pas de compte.
 
-    def _get_sorted_email_list(self, client_soc : socket.socket) -> list[gloutils.EmailContentPayload]:
-        username = self._logged_users[client_soc]
-        user_path = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        json_list = glob.glob(os.path.join(user_path, "*.json"))
-        email_list : list[gloutils.EmailContentPayload] = []
-        for email_file in json_list:
-            with open(email_file, 'r') as file:
-                email: gloutils.EmailContentPayload = json.load(file)
-                email_list.append(email)
-        
-        # sorting the email list by date
-        email_list:list[gloutils.EmailContentPayload] = self._sort_email_list(email_list)
-        return email_list
-    
-    def _get_list_users(self)->list[str]:
-        folderpaths = glob.glob(os.path.join(gloutils.SERVER_DATA_DIR, "*"))
-        folderpaths_name = [os.path.basename(x).lower() for x in folderpaths]
-        return folderpaths_name
+        Un compte absent du registre est cherché sur le disque, où un autre
+        processus serveur a pu le créer, puis ajouté au registre.
+        """
+        expected_hash = self._users.get(username)
+        if (expected_hash is not None
+                or username in (".", "..", gloutils.SERVER_LOST_DIR.lower())
+                or not re.search(r"^[a-z0-9_.-]+$", username)):
+            return expected_hash
+        password_path = os.path.join(gloutils.SERVER_DATA_DIR, username,
+                                     gloutils.PASSWORD_FILENAME)
+        try:
+            with open(password_path, "r") as file:
+                expected_hash = file.readline()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        self._users[username] = expected_hash
+        return expected_hash
     
-    def _try_send_message(self, destination: socket.socket, message:str) -> None:
+    def _try_send_message(self, destination: socket.socket,
+                          frame: list[glosocket.FramePart]) -> None:
+        writer = self._writers.get(destination)
+        if writer is None:
+            return # client déjà retiré
+        writer.append_frame(frame)
+        self._flush_client(destination)
+
+    def _flush_client(self, client_soc: socket.socket) -> None:
+        """Envoie ce que le socket accepte de la file d'envoi du client."""
         try:
-            glosocket.snd_mesg(destination, message)
-        except:
-            self._remove_client(destination)
+            self._writers[client_soc].write_to(client_soc)
+        except glosocket.GLOSocketError:
+            self._remove_client(client_soc)
+            return
+        self._update_interest(client_soc)
+        self._remove_if_done(client_soc)
         
     def _process_client(self, client_soc: socket.socket) -> None:
+        """
+        Lit les octets disponibles du client et place chaque requête
+        complète dans sa file d'attente.
+
+        Les requêtes d'un même client sont traitées une à la fois pour que
+        les réponses partent dans l'ordre des requêtes.
+        """
+        decoder = self._decoders[client_soc]
         try:
-            client_message = glosocket.recv_mesg(client_soc)
+            frames = decoder.read_from(client_soc)
         except glosocket.GLOSocketError:
             self._remove_client(client_soc)
             return
         
-        client_message : gloutils.GloMessage = json.loads(client_message)
+        pending = self._pending_requests.setdefault(client_soc, collections.deque())
+        received = time.perf_counter()
+        for client_data in frames:
+            try:
+                # Le codec de la requête est reconnu à son premier octet
+                client_message : gloutils.GloMessage = glosocket.decode_message(client_data)
+            except ValueError:
+                self._remove_client(client_soc)
+                return
+            pending.append(PendingRequest(
+                client_message, received, len(client_data) + glosocket.FRAME_HEADER_SIZE))
         
+        if decoder.eof:
+            # Traite les requêtes déjà reçues avant de retirer le client
+            self._closing_clients.add(client_soc)
+            self._update_interest(client_soc)
+        self._dispatch_next(client_soc)
+
+    def _dispatch_next(self, client_soc: socket.socket) -> None:
+        """
+        Lance le traitement des requêtes en attente du client.
+
+        Par défaut, une seule requête du client est traitée à la fois et les
+        réponses suivent l'ordre des requêtes. Si le client a accepté les
+        réponses dans le désordre, jusqu'à MAX_PIPELINE_DEPTH requêtes
+        indépendantes sont traitées en parallèle, mais les requêtes qui
+        changent la session (connexion, déconnexion, ...) restent seules.
+        """
+        pending = self._pending_requests.get(client_soc)
+        while pending and client_soc not in self._exclusive_clients:
+            request = pending[0]
+            client_message = request.message
+            exclusive = (client_soc not in self._unordered_clients
+                         or client_message["header"] in SESSION_HEADERS)
+            inflight = self._inflight.get(client_soc, 0)
+            if inflight and (exclusive or inflight >= MAX_PIPELINE_DEPTH):
+                break
+            pending.popleft()
+            
+            if client_message["header"] == gloutils.Headers.AUTH_LOGOUT:
+                self._logout(client_soc)
+                self._record_request(request, None)
+            
+            elif client_message["header"] == gloutils.Headers.BYE:
+                pending.clear()
+                self._closing_clients.add(client_soc)
+                self._update_interest(client_soc)
+                self._record_request(request, None)
+            
+            elif client_message["header"] == gloutils.Headers.HELLO:
+                send_message = self._negotiate(client_soc, client_message.get("payload"))
+                # La réponse au HELLO utilise encore l'ancien codec
+                # et l'ancienne compression
+                frame = self._encode_reply(client_soc, client_message, send_message)
+                self._try_send_message(client_soc, frame)
+                if send_message["header"] == gloutils.Headers.OK:
+                    self._set_encoding(client_soc, send_message["payload"])
+                self._record_request(request, (send_message["header"], frame))
+            
+            elif client_message["header"] in (gloutils.Headers.METRICS_REQUEST,
+                                              gloutils.Headers.PROFILING_REQUEST):
+                # Les métriques et le profileur ne sont modifiés que par la
+                # boucle principale
+                if client_message["header"] == gloutils.Headers.METRICS_REQUEST:
+                    send_message = self._get_metrics(client_soc)
+                else:
+                    send_message = self._set_profiling(client_soc, client_message.get("payload"))
+                if send_message is None:
+                    # Arrêt du profilage: le profileur est retiré ici, mais
+                    # ses fichiers sont écrits par le bassin, qui répond
+                    self._submit(client_soc, exclusive, self._execute_profiling_stop,
+                                 request, self._detach_profiler())
+                    continue
+                frame = self._encode_reply(client_soc, client_message, send_message)
+                self._try_send_message(client_soc, frame)
+                self._record_request(request, (send_message["header"], frame))
+            
+            else:
+                if client_message["header"] in (gloutils.Headers.AUTH_LOGIN,
+                                                gloutils.Headers.AUTH_REGISTER):
+                    # L'abonnement ne suit pas le client vers un autre compte
+                    self._unsubscribe(client_soc)
+                # Les entrées/sorties disque et le hachage sont faits hors de la boucle
+                self._submit(client_soc, exclusive, self._execute_request, request)
+        
+        if client_soc in self._writers:
+            self._remove_if_done(client_soc)
+
+    def _submit(self, client_soc: socket.socket, exclusive: bool,
+                task: Callable[..., None], *args) -> None:
+        """
+        Fait exécuter `task(client_soc, *args)` par le bassin pour une
+        requête du client; la tâche transmet la réponse avec
+        `_notify_completion`.
+        """
+        self._inflight[client_soc] = self._inflight.get(client_soc, 0) + 1
+        if exclusive:
+            self._exclusive_clients.add(client_soc)
+        self._executor.submit(task, client_soc, *args)
+
+    def _negotiate(self, client_soc: socket.socket,
+                   payload: Optional[gloutils.HelloPayload]) -> gloutils.GloMessage:
+        """
+        Applique les options de connexion demandées par le client et
+        retourne celles qui sont acceptées.
+
+        Le codec et la compression retenus sont les premiers proposés par
+        le client qui sont connus du serveur. Par défaut, les messages sont
+        en JSON et ne sont pas compressés. Des options invalides sont
+        refusées et celles de la connexion ne changent pas.
+        """
+        if payload is None:
+            payload = gloutils.HelloPayload()
+        if (not isinstance(payload, dict)
+                or not _is_str_list(payload.get("codecs", []))
+                or not _is_str_list(payload.get("compressions", []))):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Options de connexion invalides."
+                )
+            )
+        
+        accepted = gloutils.HelloPayload()
+        if payload.get("out_of_order"):
+            self._unordered_clients.add(client_soc)
+            accepted["out_of_order"] = True
+        else:
+            self._unordered_clients.discard(client_soc)
+        
+        codec = glosocket.CODEC_JSON
+        for proposed in payload.get("codecs", []):
+            if proposed in glosocket.CODECS:
+                codec = proposed
+                break
+        accepted["codec"] = codec
+        
+        for proposed in payload.get("compressions", []):
+            if proposed in glosocket.COMPRESSIONS:
+                accepted["compression"] = proposed
+                break
+        
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=accepted
+        )
+
+    def _set_encoding(self, client_soc: socket.socket,
+                      accepted: gloutils.HelloPayload) -> None:
+        """Utilise le codec et la compression acceptés pour les réponses suivantes."""
+        if accepted["codec"] == glosocket.CODEC_JSON:
+            self._client_codecs.pop(client_soc, None)
+        else:
+            self._client_codecs[client_soc] = accepted["codec"]
+        
+        if "compression" in accepted:
+            self._client_compressions[client_soc] = accepted["compression"]
+        else:
+            self._client_compressions.pop(client_soc, None)
+
+    def _encode_reply(self, client_soc: socket.socket,
+                      client_message: gloutils.GloMessage,
+                      send_message: gloutils.GloMessage) -> list[glosocket.Buffer]:
+        """
+        Prépare la trame de la réponse, avec l'identifiant de la requête,
+        le codec et la compression du client.
+        """
+        if "request_id" in client_message:
+            send_message["request_id"] = client_message["request_id"]
+        codec = self._client_codecs.get(client_soc, glosocket.CODEC_JSON)
+        return glosocket.encode_frame(glosocket.encode_message(send_message, codec),
+                                      self._client_compressions.get(client_soc))
+
+    def _run_request(self, client_soc: socket.socket,
+                     client_message: gloutils.GloMessage
+                     ) -> Optional[tuple[gloutils.Headers, list[glosocket.FramePart]]]:
+        """
+        Traite une requête dans un fil d'exécution du bassin et y prépare
+        aussi la trame de la réponse: la compression (zlib) libère le GIL
+        et ne bloque donc pas la boucle principale. Retourne l'entête de
+        la réponse et sa trame.
+
+        Le codec et la compression du client ne changent pas pendant le
+        traitement, car HELLO attend la fin des requêtes en cours.
+        """
+        if (client_message["header"] in (gloutils.Headers.INBOX_READING_CHOICE,
+                                         gloutils.Headers.INBOX_READING_ID)
+                and client_soc not in self._client_compressions):
+            return self._get_email_frame(client_soc, client_message)
+        
+        send_message = self._handle_request(client_soc, client_message)
+        if send_message is None:
+            return None
+        return (send_message["header"],
+                self._encode_reply(client_soc, client_message, send_message))
+
+    def _get_email_frame(self, client_soc: socket.socket,
+                         client_message: gloutils.GloMessage
+                         ) -> tuple[gloutils.Headers, list[glosocket.FramePart]]:
+        """
+        Prépare la réponse à INBOX_READING_CHOICE ou INBOX_READING_ID sans
+        lire le courriel: son contenu JSON est transmis directement depuis
+        son segment avec sendfile, entouré du reste de la réponse.
+
+        Seulement pour les clients sans compression, car le contenu doit
+        être transmis tel que stocké.
+        """
+        username = self._logged_users[client_soc]
+        if client_message["header"] == gloutils.Headers.INBOX_READING_ID:
+            entry = self._get_mailbox_entry(username, client_message["payload"]["id"])
+        else:
+            entry = self._get_chosen_entry(username, client_message["payload"]["choice"])
+        if entry is None:
+            # Même réponse (erreur) que le chemin habituel
+            send_message = self._handle_request(client_soc, client_message)
+            return (send_message["header"],
+                    self._encode_reply(client_soc, client_message, send_message))
+        
+        location = entry["location"]
+        send_message = gloutils.GloMessage(header=gloutils.Headers.OK)
+        if "request_id" in client_message:
+            send_message["request_id"] = client_message["request_id"]
+        codec = self._client_codecs.get(client_soc, glosocket.CODEC_JSON)
+        prefix, suffix = glosocket.encode_message_around(
+            send_message, "payload", location.body_size, codec)
+        return gloutils.Headers.OK, glosocket.encode_frame_parts([
+            prefix,
+            glosocket.FileRegion(location.segment, location.body_offset, location.body_size),
+            suffix,
+        ])
+
+    def _handle_request(self, client_soc: socket.socket,
+                        client_message: gloutils.GloMessage
+                        ) -> Optional[gloutils.GloMessage]:
+        """
+        Traite une requête dans un fil d'exécution du bassin et retourne
+        la réponse à transmettre au client.
+        """
         if client_message["header"] == gloutils.Headers.AUTH_REGISTER:
             send_message = self._create_account(client_soc, client_message["payload"])
             
             if send_message["header"] == gloutils.Headers.ERROR:
-                message_data = json.dumps(send_message)
-                self._try_send_message(client_soc, message_data)
-            else:
-                send_message = self._login(client_soc, client_message["payload"])
-                message_data = json.dumps(send_message)
-                self._try_send_message(client_soc, message_data)
+                return send_message
+            return self._login(client_soc, client_message["payload"])
             
         elif client_message["header"] == gloutils.Headers.AUTH_LOGIN:
-            send_message = self._login(client_soc, client_message["payload"])
-            message_data = json.dumps(send_message)
-            self._try_send_message(client_soc, message_data)
-            
-        elif client_message["header"] == gloutils.Headers.AUTH_LOGOUT:
-            self._logout(client_soc)
-            
-        elif client_message["header"] == gloutils.Headers.BYE:
-            self._remove_client(client_soc)
+            return self._login(client_soc, client_message["payload"])
             
         elif client_message["header"] == gloutils.Headers.INBOX_READING_REQUEST:
-            send_message = self._get_email_list(client_soc)
-            message_data = json.dumps(send_message)
-            self._try_send_message(client_soc, message_data)
+            return self._get_email_list(client_soc, client_message.get("payload"))
             
         elif client_message["header"] == gloutils.Headers.INBOX_READING_CHOICE:
-            send_message = self._get_email(client_soc, client_message["payload"])
-            message_data = json.dumps(send_message)
-            self._try_send_message(client_soc, message_data)
+            return self._get_email(client_soc, client_message["payload"])
+            
+        elif client_message["header"] == gloutils.Headers.INBOX_READING_ID:
+            return self._get_email_by_id(client_soc, client_message["payload"])
+            
+        elif client_message["header"] == gloutils.Headers.INBOX_READING_BATCH_CHOICE:
+            return self._get_emails(client_soc, client_message["payload"])
             
         elif client_message["header"] == gloutils.Headers.EMAIL_SENDING:
-            send_message = self._send_email(client_message["payload"])
-            message_data = json.dumps(send_message)
-            self._try_send_message(client_soc, message_data)
+            return self._send_email(client_soc, client_message["payload"])
+            
+        elif client_message["header"] == gloutils.Headers.EMAIL_BATCH_SENDING:
+            return self._send_batch_email(client_soc, client_message["payload"])
         
         elif client_message["header"] == gloutils.Headers.STATS_REQUEST:
-            send_message = self._get_stats(client_soc)
-            message_data = json.dumps(send_message)
-            self._try_send_message(client_soc, message_data)
+            return self._get_stats(client_soc)
+        
+        elif client_message["header"] == gloutils.Headers.SEARCH:
+            return self._search(client_soc, client_message["payload"])
+        
+        elif client_message["header"] == gloutils.Headers.SUBSCRIBE:
+            return self._subscribe(client_soc, client_message["payload"])
+        
+        return None
+
+    def _execute_request(self, client_soc: socket.socket,
+                         request: PendingRequest) -> None:
+        """
+        Traite la requête dans le bassin, puis transmet sa réponse à la
+        boucle principale. Avec DURABILITY_BATCHED, la réponse d'une requête
+        qui a livré des courriels n'est transmise qu'une fois le lot qui
+        contient ses segments écrit sur le disque: le fil du bassin passe
+        à la requête suivante sans attendre le fsync. Les nouveaux courriels
+        sont notifiés aux abonnés avec la réponse, donc une fois durables.
+        """
+        result: concurrent.futures.Future = concurrent.futures.Future()
+        self._request_state.segments = set()
+        self._request_state.notifications = []
+        try:
+            result.set_result(self._request_runner(client_soc, request.message))
+        except Exception as ex:
+            result.set_exception(ex)
+        
+        segments = self._request_state.segments
+        notifications = self._request_state.notifications
+        if not segments:
+            self._notify_completion(client_soc, request, result, notifications)
+            return
+        
+        def on_commit(commit: concurrent.futures.Future) -> None:
+            # Un fsync échoué fait échouer la requête, sans notification
+            if commit.exception():
+                self._notify_completion(client_soc, request, commit, [])
+            else:
+                self._notify_completion(client_soc, request, result, notifications)
+        self._group_commit.submit(segments).add_done_callback(on_commit)
+
+    def _notify_completion(self, client_soc: socket.socket,
+                           request: PendingRequest,
+                           future: concurrent.futures.Future,
+                           notifications: list[tuple[str, gloutils.EmailSummary]]) -> None:
+        """
+        Appelée par le bassin (ou par le fil de `_group_commit`) quand une
+        requête est terminée: transmet le résultat et les notifications à
+        la boucle principale et la réveille.
+        """
+        self._notifications.extend(notifications)
+        self._completions.append((client_soc, request, future))
+        self._wake_main_loop()
+
+    def _wake_main_loop(self) -> None:
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass # la boucle est déjà réveillée
+
+    def _process_completions(self) -> None:
+        """Envoie les réponses des requêtes terminées par le bassin."""
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        
+        while self._completions:
+            client_soc, request, future = self._completions.popleft()
+            self._inflight[client_soc] -= 1
+            if not self._inflight[client_soc]:
+                del self._inflight[client_soc]
+            self._exclusive_clients.discard(client_soc)
+            
+            if client_soc.fileno() == -1:
+                # Client retiré pendant le traitement (ex.: login concurrent)
+                self._logged_users.pop(client_soc, None)
+                self._unsubscribe(client_soc)
+                continue
+            
+            try:
+                reply = future.result()
+            except Exception as ex:
+                self._log.error("request_failed", conn=self._connection_ids.get(client_soc),
+                                header=_header_name(request.message["header"]),
+                                error=repr(ex))
+                reply = gloutils.Headers.ERROR, self._encode_reply(
+                    client_soc, request.message, gloutils.GloMessage(
+                        header=gloutils.Headers.ERROR,
+                        payload=gloutils.ErrorPayload(
+                            error_message="La requête n'a pas pu être traitée."
+                        )
+                    ))
             
+            if reply is not None:
+                self._try_send_message(client_soc, reply[1])
+            self._record_request(request, reply)
+            self._dispatch_next(client_soc)
+        
+        if self._notifications:
+            self._push_notifications()
+
+    def _push_notifications(self) -> None:
+        """
+        Envoie les notifications NEW_EMAIL en attente aux clients abonnés,
+        en une seule trame par client pour tous ses nouveaux courriels.
+        """
+        emails: dict[socket.socket, list[gloutils.EmailSummary]] = {}
+        while self._notifications:
+            username, summary = self._notifications.popleft()
+            # Copie, car le bassin peut abonner d'autres clients
+            for client_soc in tuple(self._subscribers.get(username, ())):
+                emails.setdefault(client_soc, []).append(summary)
+        
+        for client_soc, summaries in emails.items():
+            if client_soc in self._closing_clients:
+                continue
+            frame = self._encode_reply(client_soc, gloutils.GloMessage(), gloutils.GloMessage(
+                header=gloutils.Headers.NEW_EMAIL,
+                payload=gloutils.NewEmailPayload(
+                    emails=summaries
+                )
+            ))
+            self._try_send_message(client_soc, frame)
+            self._pushed_notifications += len(summaries)
+
+    def _poll_subscriptions(self) -> None:
+        """
+        Avec un dossier partagé, fait vérifier par le bassin les boîtes des
+        abonnés toutes les SUBSCRIPTION_POLL_INTERVAL secondes, pour leur
+        notifier les courriels livrés par les autres processus.
+        """
+        now = time.monotonic()
+        if now < self._next_subscription_poll:
+            return
+        self._next_subscription_poll = now + SUBSCRIPTION_POLL_INTERVAL
+        if not self._polling_subscriptions:
+            self._polling_subscriptions = True
+            self._executor.submit(self._refresh_subscribed_mailboxes, list(self._subscribers))
+
+    def _refresh_subscribed_mailboxes(self, usernames: list[str]) -> None:
+        """
+        Resynchronise dans le bassin l'index de la boîte de chaque abonné
+        avec ses segments, puis transmet les notifications à la boucle
+        principale.
+        """
+        self._request_state.notifications = []
+        try:
+            for username in usernames:
+                with self._get_mailbox_lock(username):
+                    if username in self._mailbox_index:
+                        self._refresh_mailbox_index(username)
+        except Exception as ex:
+            self._log.error("subscription_poll_failed", error=repr(ex))
+        finally:
+            self._polling_subscriptions = False
+        if self._request_state.notifications:
+            self._notifications.extend(self._request_state.notifications)
+            self._wake_main_loop()
               
+    def _record_request(self, request: PendingRequest,
+                        reply: Optional[tuple[gloutils.Headers, list[glosocket.FramePart]]]
+                        ) -> None:
+        """
+        Ajoute aux métriques une requête dont la réponse (entête et trame,
+        ou None sans réponse) vient d'être transmise.
+        """
+        self._metrics.record(
+            request.message["header"], time.perf_counter() - request.received,
+            reply is not None and reply[0] == gloutils.Headers.ERROR,
+            request.size, 0 if reply is None else glosocket.frame_size(reply[1]))
+
+    def _get_metrics(self, client_soc: socket.socket) -> gloutils.GloMessage:
+        """Retourne les métriques du serveur si le client est administrateur."""
+        if not self._is_admin(client_soc):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Les métriques sont réservées aux administrateurs."
+                )
+            )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=self._metrics.to_payload()
+        )
+
+    def _is_admin(self, client_soc: socket.socket) -> bool:
+        return self._logged_users.get(client_soc) in self._admins
+
+    def _set_profiling(self, client_soc: socket.socket,
+                       payload: Optional[gloutils.ProfilingPayload]
+                       ) -> Optional[gloutils.GloMessage]:
+        """
+        Démarre le profilage avec les options du payload (les options par
+        défaut du serveur pour celles absentes), si le client est
+        administrateur. Retourne None pour un arrêt, dont la réponse est
+        préparée par le bassin une fois les fichiers écrits.
+        """
+        if not self._is_admin(client_soc):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Le profilage est réservé aux administrateurs."
+                )
+            )
+        invalid = gloutils.GloMessage(
+            header=gloutils.Headers.ERROR,
+            payload=gloutils.ErrorPayload(
+                error_message="Options de profilage invalides."
+            )
+        )
+        if payload is None:
+            payload = gloutils.ProfilingPayload()
+        if not isinstance(payload, dict):
+            return invalid
+        if not payload.get("enabled"):
+            return None
+        
+        defaults = self._profiling_options
+        mode = payload.get("mode", defaults.mode)
+        percent = payload.get("percent", defaults.percent)
+        headers = payload.get("headers")
+        if (not isinstance(mode, str) or mode not in gloprofile.MODES
+                or not isinstance(percent, (int, float)) or isinstance(percent, bool)
+                or not 0 < percent <= 100
+                or not (headers is None or _is_str_list(headers))
+                or not set(headers or ()) <= gloutils.Headers.__members__.keys()):
+            return invalid
+        options = defaults._replace(
+            mode=mode,
+            percent=percent,
+            headers=defaults.headers if headers is None else frozenset(headers),
+        )
+        self._start_profiling(options)
+        accepted = gloutils.ProfilingPayload(enabled=True, mode=options.mode,
+                                             percent=options.percent)
+        if options.headers is not None:
+            accepted["headers"] = sorted(options.headers)
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=accepted
+        )
+
+    def _start_profiling(self, options: gloprofile.ProfilerOptions) -> None:
+        """Profile les requêtes traitées par le bassin à partir de maintenant."""
+        previous = self._detach_profiler()
+        if previous is not None:
+            self._executor.submit(self._write_profile, previous)
+        profiler = gloprofile.RequestProfiler(options, initializer=_block_stop_signals)
+        self._profiler = profiler
+        self._request_runner = (
+            lambda client_soc, client_message: profiler.run(
+                _header_name(client_message["header"]),
+                self._run_request, client_soc, client_message))
+        self._log.info("profiling_started", mode=options.mode, percent=options.percent,
+                       headers=None if options.headers is None else sorted(options.headers))
+
+    def _detach_profiler(self) -> Optional[gloprofile.RequestProfiler]:
+        """
+        Cesse de profiler les nouvelles requêtes et retourne le profileur
+        (None hors du profilage), dont les fichiers restent à écrire avec
+        `_write_profile`.
+        """
+        profiler, self._profiler = self._profiler, None
+        self._request_runner = self._run_request
+        return profiler
+
+    def _write_profile(self, profiler: gloprofile.RequestProfiler) -> list[str]:
+        """
+        Arrête le profileur et retourne les fichiers écrits. Attend la fin
+        de son fil d'échantillonnage et écrit sur le disque: appelée par le
+        bassin, sauf à l'arrêt du serveur.
+        """
+        paths = profiler.stop()
+        self._log.info("profiling_stopped", directory=profiler.options.directory,
+                       files=len(paths))
+        return paths
+
+    def _execute_profiling_stop(self, client_soc: socket.socket, request: PendingRequest,
+                                profiler: Optional[gloprofile.RequestProfiler]) -> None:
+        """
+        Écrit dans le bassin les fichiers du profileur retiré par la boucle
+        principale, puis lui transmet la réponse à PROFILING_REQUEST.
+        """
+        result: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            send_message = gloutils.GloMessage(
+                header=gloutils.Headers.OK,
+                payload=gloutils.ProfilingPayload(
+                    enabled=False,
+                    files=[] if profiler is None else self._write_profile(profiler)
+                )
+            )
+            result.set_result((send_message["header"], self._encode_reply(
+                client_soc, request.message, send_message)))
+        except Exception as ex:
+            result.set_exception(ex)
+        self._notify_completion(client_soc, request, result, [])
+
+    def _stop_profiling(self) -> None:
+        """Arrête le profilage et attend l'écriture de ses fichiers."""
+        profiler = self._detach_profiler()
+        if profiler is not None:
+            self._write_profile(profiler)
+
+    def _on_profiling_signal(self, signum, frame) -> None:
+        """
+        SIGUSR1: demande à la boucle principale de démarrer ou d'arrêter le
+        profilage, puis la réveille.
+        """
+        self._profiling_toggled = True
+        self._wake_main_loop()
+
     def run(self):
         """Point d'entrée du serveur."""
-        waiters = []
         while True:
-            # Select readable sockets
-            result = select.select([self._server_socket] + self._client_socs, [], [])
-            waiters: list[socket.socket] = result[0]
-            for waiter in waiters:
+            timeout = None
+            if self._shared_data_dir and self._subscribers:
+                # Réveil pour la prochaine vérification des boîtes des abonnés
+                timeout = max(0.0, self._next_subscription_poll - time.monotonic())
+            # Sockets prêts en lecture ou en écriture
+            events = self._selector.select(timeout)
+            for key, mask in events:
+                waiter: socket.socket = key.fileobj
                 # Handle sockets
-                if waiter == self._server_socket:
+                if waiter is self._server_socket:
                     self._accept_client()
+                elif waiter is self._wakeup_reader:
+                    self._process_completions()
                 else:
-                    self._process_client(waiter)
+                    # fileno() vaut -1 si le client a été retiré plus tôt dans ce tour
+                    if mask & selectors.EVENT_READ and waiter.fileno() != -1:
+                        self._process_client(waiter)
+                    if mask & selectors.EVENT_WRITE and waiter.fileno() != -1:
+                        self._flush_client(waiter)
+            
+            if self._shared_data_dir and self._subscribers:
+                self._poll_subscriptions()
+            
+            if self._profiling_toggled:
+                self._profiling_toggled = False
+                if self._profiler is None:
+                    self._start_profiling(self._profiling_options)
+                else:
+                    self._executor.submit(self._write_profile, self._detach_profiler())
                 
+def _is_str_list(value: object) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def _header_name(header: int) -> str:
+    try:
+        return gloutils.Headers(header).name
+    except ValueError:
+        return str(header)
+
+
+def _block_stop_signals() -> None:
+    """
+    Bloque SIGINT/SIGTERM (et SIGUSR1) dans les fils du bassin pour qu'ils
+    soient livrés au fil principal, seul à pouvoir interrompre `Server.run`.
+    """
+    if hasattr(signal, "pthread_sigmask"):
+        signals = {signal.SIGINT, signal.SIGTERM}
+        if hasattr(signal, "SIGUSR1"):
+            signals.add(signal.SIGUSR1)
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+
+
+def _parse_rate(text: str) -> float:
+    try:
+        rate = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"fraction invalide: {text}")
+    if not 0 <= rate <= 1:
+        raise argparse.ArgumentTypeError(f"la fraction doit être entre 0 et 1: {text}")
+    return rate
+
+
+def _parse_event_sample(text: str) -> tuple[str, float]:
+    event, separator, rate = text.partition("=")
+    if not separator or not event:
+        raise argparse.ArgumentTypeError(f"attendu EVENEMENT=FRACTION: {text}")
+    return event, _parse_rate(rate)
+
+
 def _main() -> int:
-    server = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--selector", action="store", dest="selector",
+                        choices=sorted(SELECTOR_BACKENDS), default=None,
+                        help="Mécanisme de sélection des sockets "
+                             "(défaut: le plus performant disponible).")
+    parser.add_argument("--workers", action="store", dest="workers",
+                        type=int, default=1,
+                        help="Nombre de processus serveurs partageant le port.")
+    parser.add_argument("--pool-size", action="store", dest="pool_size",
+                        type=int, default=None,
+                        help="Nombre de fils d'exécution traitant les requêtes "
+                             "par processus (défaut: selon le nombre de cœurs).")
+    parser.add_argument("--max-frame-size", action="store", dest="max_frame_size",
+                        type=int, default=glosocket.MAX_FRAME_SIZE,
+                        help="Taille maximale (octets) d'un message reçu d'un client.")
+    parser.add_argument("--quota", action="store", dest="quota",
+                        type=int, default=None,
+                        help="Taille maximale (octets) des courriels d'une boîte "
+                             "(défaut: aucune limite).")
+    parser.add_argument("--admin", action="append", dest="admins", default=[],
+                        help="Utilisateur autorisé à demander les métriques "
+                             "(METRICS_REQUEST). Peut être répété.")
+    parser.add_argument("--metrics-file", action="store", dest="metrics_file",
+                        default=None,
+                        help="Fichier où écrire les métriques au format Prometheus "
+                             "(suffixé du numéro du processus avec --workers).")
+    parser.add_argument("--metrics-port", action="store", dest="metrics_port",
+                        type=int, default=None,
+                        help="Port local où servir les métriques en HTTP "
+                             "(plus le numéro du processus avec --workers).")
+    parser.add_argument("--metrics-interval", action="store", dest="metrics_interval",
+                        type=float, default=10.0,
+                        help="Intervalle (secondes) d'écriture du fichier de métriques.")
+    parser.add_argument("--profile-dir", action="store", dest="profile_dir",
+                        default="profiles",
+                        help="Dossier des fichiers de profilage (démarré et arrêté "
+                             "par SIGUSR1 ou PROFILING_REQUEST).")
+    parser.add_argument("--profile-mode", action="store", dest="profile_mode",
+                        choices=gloprofile.MODES, default=gloprofile.MODE_SAMPLE,
+                        help="cprofile: statistiques de cProfile (.prof); sample: "
+                             "piles échantillonnées pour un flame graph (.folded).")
+    parser.add_argument("--profile-percent", action="store", dest="profile_percent",
+                        type=float, default=100.0,
+                        help="Pourcentage des requêtes profilées.")
+    parser.add_argument("--profile-header", action="append", dest="profile_headers",
+                        choices=sorted(gloutils.Headers.__members__), default=None,
+                        help="Entête dont les requêtes sont profilées (défaut: tous). "
+                             "Peut être répété.")
+    parser.add_argument("--durability", action="store", dest="durability",
+                        choices=glostore.DURABILITY_MODES, default=glostore.DURABILITY_BATCHED,
+                        help="Écriture sur le disque des courriels livrés avant de "
+                             "répondre: none (aucun fsync), batched (un fsync par lot "
+                             "d'envois) ou message (un fsync par courriel).")
+    parser.add_argument("--commit-delay", action="store", dest="commit_delay",
+                        type=float, default=0.0,
+                        help="Avec batched, attente (secondes) avant chaque fsync pour "
+                             "grossir les lots.")
+    parser.add_argument("--log-level", action="store", dest="log_level",
+                        choices=glolog.LEVELS, default="info",
+                        help="Niveau minimal des événements journalisés.")
+    parser.add_argument("--log-sample", action="store", dest="log_sample",
+                        type=_parse_rate, default=1.0,
+                        help="Fraction gardée des événements sous le niveau warning.")
+    parser.add_argument("--log-sample-event", action="append", dest="log_event_samples",
+                        type=_parse_event_sample, default=[],
+                        help="Fraction gardée d'un événement, sous la forme "
+                             "EVENEMENT=FRACTION (ex.: email_sent=0.01). Peut être répété.")
+    parser.add_argument("--log-buffer", action="store", dest="log_buffer",
+                        type=int, default=glolog.DEFAULT_CAPACITY,
+                        help="Nombre maximal d'événements en attente d'écriture; "
+                             "au-delà, ils sont jetés et comptés.")
+    args = parser.parse_args(sys.argv[1:])
+    selector_factory = SELECTOR_BACKENDS.get(args.selector, selectors.DefaultSelector)
+    server_options = dict(
+        pool_size=args.pool_size, max_frame_size=args.max_frame_size,
+        quota=args.quota, admins=frozenset(name.lower() for name in args.admins),
+        metrics_interval=args.metrics_interval,
+        profiling=gloprofile.ProfilerOptions(
+            directory=args.profile_dir, mode=args.profile_mode,
+            percent=args.profile_percent,
+            headers=None if args.profile_headers is None else frozenset(args.profile_headers)),
+        event_log=glolog.LogOptions(
+            level=glolog.LEVELS[args.log_level], sample=args.log_sample,
+            event_samples=dict(args.log_event_samples), capacity=args.log_buffer),
+        durability=args.durability, commit_delay=args.commit_delay,
+    )
+    if args.workers > 1:
+        return _run_workers(args.workers, selector_factory, args.metrics_file,
+                            args.metrics_port, **server_options)
+    server = Server(selector_factory, metrics_file=args.metrics_file,
+                    metrics_port=args.metrics_port, **server_options)
     try:
         server.run()
     except KeyboardInterrupt:
@@ -446,5 +2057,61 @@ def _main() -> int:
     return 0
 
 
+def _run_workers(workers: int, selector_factory: Callable[[], selectors.BaseSelector],
+                 metrics_file: Optional[str], metrics_port: Optional[int],
+                 **server_options) -> int:
+    """
+    Lance `workers` processus serveurs partageant le port avec SO_REUSEPORT,
+    puis attend leur fin. Un SIGTERM ou un SIGUSR1 reçu est transmis aux
+    processus.
+
+    Chaque processus a ses propres métriques: le processus `i` les écrit
+    dans `metrics_file.i` et les sert sur le port `metrics_port + i`.
+    """
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("--workers requires os.fork and SO_REUSEPORT")
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            server = Server(
+                selector_factory, reuse_port=True,
+                metrics_file=None if metrics_file is None else f"{metrics_file}.{index}",
+                metrics_port=None if metrics_port is None else metrics_port + index,
+                **server_options)
+            try:
+                server.run()
+            except KeyboardInterrupt:
+                server.cleanup()
+            os._exit(0)
+        children.append(pid)
+
+    def _forward(signum, _frame):
+        for child in children:
+            try:
+                os.kill(child, signum)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, _forward)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, _forward)
+
+    exit_code = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            # Les processus reçoivent aussi le SIGINT du terminal
+            continue
+        except ChildProcessError:
+            break
+        children.remove(pid)
+        if os.waitstatus_to_exitcode(status) != 0:
+            exit_code = 1
+    return exit_code
+
+
 if __name__ == '__main__':
     sys.exit(_main())
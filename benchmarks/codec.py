@@ -0,0 +1,93 @@
+"""\
+Microbenchmarks des codecs de glosocket (JSON et binaire).
+
+Mesure, pour les messages du chemin critique du serveur (liste, page de
+liste, consultation, statistiques, connexion), le temps d'encodage et de
+décodage de chaque codec ainsi que la taille du message encodé.
+
+Utilisation:
+    python benchmarks/codec.py
+    python benchmarks/codec.py --emails 200 --repeat 7
+"""
+import argparse
+import os
+import sys
+import timeit
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glosocket  # noqa: E402
+import gloutils  # noqa: E402
+
+DATE = "Mon, 01 Jan 2024 12:00:00 +0000"
+
+
+def make_messages(emails: int, content_size: int) -> dict[str, gloutils.GloMessage]:
+    """Messages représentatifs des réponses et des requêtes du serveur."""
+    summaries = [gloutils.EmailSummary(number=number, id=number,
+                                       sender="alice@glo2000.ca",
+                                       subject=f"Sujet du courriel {number}",
+                                       date=DATE, size=content_size)
+                 for number in range(1, emails + 1)]
+    lines = [gloutils.SUBJECT_DISPLAY.format(number=summary["number"],
+                                             sender=summary["sender"],
+                                             subject=summary["subject"],
+                                             date=summary["date"])
+             for summary in summaries]
+    return {
+        "liste": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailListPayload(email_list=lines), request_id=1),
+        "page": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailPagePayload(emails=summaries, next_cursor="bzox"),
+            request_id=1),
+        "courriel": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailContentPayload(
+                sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+                subject="Sujet du courriel", date=DATE, content="x" * content_size),
+            request_id=1),
+        "stats": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.StatsPayload(count=emails, size=emails * content_size),
+            request_id=1),
+        "connexion": gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username="alice", password="Password123"),
+            request_id=1),
+    }
+
+
+def _best(function: Callable[[], object], repeat: int) -> float:
+    """Meilleur temps (microsecondes) d'un appel de `function`."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", action="store", dest="emails", type=int, default=50,
+                        help="Nombre de courriels des listes.")
+    parser.add_argument("--content-size", action="store", dest="content_size",
+                        type=int, default=1000,
+                        help="Taille (caractères) du contenu du courriel consulté.")
+    parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=5,
+                        help="Nombre de mesures dont la meilleure est retenue.")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'message':<10} {'codec':<7} {'octets':>8} {'encodage (µs)':>14}"
+          f" {'décodage (µs)':>14}")
+    for name, message in make_messages(args.emails, args.content_size).items():
+        for codec in (glosocket.CODEC_JSON, glosocket.CODEC_BINARY):
+            data = glosocket.encode_message(message, codec)
+            encode = _best(lambda: glosocket.encode_message(message, codec), args.repeat)
+            decode = _best(lambda: glosocket.decode_message(data), args.repeat)
+            print(f"{name:<10} {codec:<7} {len(data):>8} {encode:>14.2f} {decode:>14.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,122 @@
+"""\
+Banc d'essai des trames de glosocket.
+
+Compare snd_mesg et recv_mesg (recv_into dans un tampon préalloué, envoi
+de l'entête et du message sans concaténation) à l'implémentation
+précédente (recv par blocs de 4096 octets concaténés et
+`data_length + data`), reproduite ci-dessous, pour des messages de 1 Ko,
+1 Mo et 50 Mo échangés sur une paire de sockets.
+
+Utilisation:
+    python benchmarks/framing.py
+    python benchmarks/framing.py --sizes 1024,1048576 --repeat 5
+"""
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glosocket  # noqa: E402
+
+DEFAULT_SIZES = "1024,1048576,52428800"
+# Volume échangé pour chaque taille, pour que les petits messages soient
+# mesurés sur plusieurs milliers d'envois. La copie de l'implémentation
+# précédente est quadratique: un message de 50 Mo y prend quelques minutes.
+_TARGET_BYTES = 200 * 1024 * 1024
+_LEGACY_TARGET_BYTES = 16 * 1024 * 1024
+# Une mesure plus longue n'est pas répétée
+_MAX_REPEATED = 10.0
+
+
+def legacy_recvall(source: socket.socket, size: int) -> bytes:
+    """_recvall avant le passage à recv_into."""
+    msg = b""
+    while size > 0:
+        chunk_size = min(size, 4096)
+        buffer = source.recv(chunk_size)
+        if not buffer:
+            raise glosocket.GLOSocketError("The other socket is closed.")
+        msg += buffer
+        size -= len(buffer)
+    return msg
+
+
+def legacy_snd_mesg(dest_soc: socket.socket, message: str) -> None:
+    """snd_mesg avant l'envoi de l'entête et du message sans concaténation."""
+    data = message.encode(encoding='utf-8')
+    data_length = struct.pack("!I", len(data))
+    dest_soc.sendall(data_length + data)
+
+
+def legacy_recv_mesg(source_soc: socket.socket) -> str:
+    """recv_mesg avant le passage à recv_into."""
+    length, = struct.unpack("!I", legacy_recvall(source_soc, 4))
+    return legacy_recvall(source_soc, length).decode('utf-8')
+
+
+def measure(send: Callable[[socket.socket, str], None],
+            recv: Callable[[socket.socket], object],
+            message: str, count: int) -> float:
+    """Durée (secondes) de `count` échanges de `message`."""
+    sender, receiver = socket.socketpair()
+    try:
+        thread = threading.Thread(target=lambda: [send(sender, message)
+                                                  for _ in range(count)])
+        start = time.perf_counter()
+        thread.start()
+        for _ in range(count):
+            recv(receiver)
+        thread.join()
+        return time.perf_counter() - start
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def _format_size(size: int) -> str:
+    for unit in ("o", "Ko", "Mo"):
+        if size < 1024 or unit == "Mo":
+            return f"{size:g} {unit}"
+        size //= 1024
+    return str(size)
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", action="store", dest="sizes", default=DEFAULT_SIZES,
+                        help=f"Tailles des messages en octets (défaut: {DEFAULT_SIZES}).")
+    parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=3,
+                        help="Nombre de mesures dont la meilleure est retenue.")
+    args = parser.parse_args(sys.argv[1:])
+
+    implementations = {
+        "précédente": (legacy_snd_mesg, legacy_recv_mesg),
+        "actuelle": (glosocket.snd_mesg, glosocket.recv_mesg),
+        "actuelle (bytes)": (glosocket.snd_mesg, glosocket.recv_bytes),
+    }
+    print(f"{'taille':>7} {'implémentation':<17} {'messages':>8} {'ms/message':>11} {'Mo/s':>9}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        text = "x" * size
+        data = text.encode('utf-8')
+        for name, (send, recv) in implementations.items():
+            target = _LEGACY_TARGET_BYTES if send is legacy_snd_mesg else _TARGET_BYTES
+            count = max(1, min(10000, target // size))
+            message = data if "bytes" in name else text
+            elapsed = measure(send, recv, message, count)
+            for _ in range(args.repeat - 1):
+                if elapsed > _MAX_REPEATED:
+                    break
+                elapsed = min(elapsed, measure(send, recv, message, count))
+            print(f"{_format_size(size):>7} {name:<17} {count:>8}"
+                  f" {elapsed / count * 1000:>11.3f} {size * count / elapsed / 1e6:>9.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
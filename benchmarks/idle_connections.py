@@ -0,0 +1,176 @@
+"""\
+Banc d'essai du serveur avec un grand nombre de connexions inactives.
+
+Lance TP4_server.py, ouvre des connexions inactives par paliers et, à
+chaque palier, mesure sur une connexion active la latence d'une requête
+(connexion refusée d'un compte inexistant, comprise par toutes les
+versions du serveur), le temps processeur du serveur par requête et sa
+mémoire résidente. Avec select.select, chaque réveil du serveur parcourt
+toutes les connexions et le serveur échoue au-delà de FD_SETSIZE (1024).
+
+Pour mesurer une version antérieure du serveur:
+    git worktree add /tmp/avant <commit>
+    python benchmarks/idle_connections.py --server /tmp/avant/TP4_server.py
+
+Utilisation:
+    python benchmarks/idle_connections.py --connections 10000 --step 2000
+    python benchmarks/idle_connections.py --server-args "--selector poll"
+
+La limite de descripteurs de fichiers (ulimit -n) doit dépasser le
+nombre de connexions: la limite souple est relevée jusqu'à la limite
+stricte, héritée par le serveur.
+"""
+import argparse
+import json
+import os
+import shlex
+import socket
+import sys
+import tempfile
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glosocket  # noqa: E402
+import gloutils  # noqa: E402
+import TP4_loadgen  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Un serveur qui n'accepte plus les connexions (ex.: arrêté par une
+# erreur de select) ne bloque pas le banc d'essai
+CONNECT_TIMEOUT = 10.0
+
+
+def _raise_file_limit() -> int:
+    """Relève la limite souple de descripteurs et retourne la nouvelle limite."""
+    if resource is None:
+        return 0
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    return soft
+
+
+def _server_cpu(pid: int) -> Optional[float]:
+    """Temps processeur (secondes) du processus, si /proc est disponible."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            fields = file.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+    # utime et stime, 14e et 15e champs
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _server_rss(pid: int) -> Optional[int]:
+    """Mémoire résidente (Ko) du processus, si /proc est disponible."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure_requests(client: socket.socket, requests: int) -> list[float]:
+    """Latences (secondes) de `requests` requêtes sur la connexion active."""
+    data = json.dumps(gloutils.GloMessage(
+        header=gloutils.Headers.AUTH_LOGIN,
+        payload=gloutils.AuthPayload(username="inexistant", password="Password123"),
+    ))
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        glosocket.snd_mesg(client, data)
+        glosocket.recv_mesg(client)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", action="store", dest="connections",
+                        type=int, default=10000,
+                        help="Nombre maximal de connexions inactives.")
+    parser.add_argument("--step", action="store", dest="step", type=int, default=1000,
+                        help="Connexions inactives ajoutées à chaque palier.")
+    parser.add_argument("--requests", action="store", dest="requests", type=int, default=500,
+                        help="Requêtes mesurées à chaque palier.")
+    parser.add_argument("--server", action="store", dest="server",
+                        default=os.path.join(os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))), "TP4_server.py"),
+                        help="Serveur à lancer (défaut: celui de ce dépôt).")
+    parser.add_argument("--server-args", action="store", dest="server_args", default="",
+                        help="Arguments de TP4_server.py, ex. \"--selector poll\".")
+    args = parser.parse_args(sys.argv[1:])
+
+    limit = _raise_file_limit()
+    if limit and limit < args.connections + 64:
+        print(f"Limite de descripteurs trop basse ({limit}) pour"
+              f" {args.connections} connexions.", file=sys.stderr)
+        return 1
+
+    print(f"{'inactives':>9} {'ouverture (s)':>13} {'p50 (µs)':>9} {'p99 (µs)':>9}"
+          f" {'CPU/req (µs)':>12} {'RSS (Mo)':>9}")
+    idle: list[socket.socket] = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        server = TP4_loadgen._spawn_server(args.server, shlex.split(args.server_args),
+                                           data_dir)
+        try:
+            client = socket.create_connection(("127.0.0.1", gloutils.APP_PORT))
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            opening = 0.0
+            while True:
+                try:
+                    # Échauffement, hors mesure
+                    measure_requests(client, min(50, args.requests))
+                    cpu = _server_cpu(server.pid)
+                    latencies = measure_requests(client, args.requests)
+                except glosocket.GLOSocketError:
+                    print(f"Le serveur ne répond plus avec {len(idle)} connexions"
+                          " inactives.")
+                    break
+                cpu_after = _server_cpu(server.pid)
+                rss = _server_rss(server.pid)
+                cpu_text = (f"{(cpu_after - cpu) / args.requests * 1e6:.0f}"
+                            if cpu is not None and cpu_after is not None else "?")
+                print(f"{len(idle):>9} {opening:>13.2f}"
+                      f" {_percentile(latencies, 50) * 1e6:>9.0f}"
+                      f" {_percentile(latencies, 99) * 1e6:>9.0f} {cpu_text:>12}"
+                      f" {rss / 1024 if rss is not None else 0:>9.1f}", flush=True)
+                if len(idle) >= args.connections:
+                    break
+                start = time.perf_counter()
+                try:
+                    for _ in range(min(args.step, args.connections - len(idle))):
+                        idle.append(socket.create_connection(
+                            ("127.0.0.1", gloutils.APP_PORT), CONNECT_TIMEOUT))
+                except OSError as ex:
+                    print(f"Connexion {len(idle) + 1} impossible: {ex}")
+                    break
+                opening = time.perf_counter() - start
+            client.close()
+        finally:
+            for soc in idle:
+                soc.close()
+            server.terminate()
+            server.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,534 @@
+"""\
+Client asynchrone du serveur mail @glo2000.ca.
+
+Offre les opérations du protocole (création de compte, connexion, envoi,
+liste, recherche, consultation, statistiques et déconnexion) sous forme de
+coroutines, au-dessus des flux asyncio et avec les trames de glosocket.
+
+Chaque requête porte un `request_id`: plusieurs coroutines peuvent
+attendre une réponse sur la même connexion, et chaque réponse est remise
+à celle qui l'attend. Une connexion perdue est rouverte à la requête
+suivante, avec le compte connecté; une requête sans effet de bord en
+cours est alors renvoyée une fois. `GloClientPool` garde plusieurs
+connexions authentifiées au même compte pour les gros volumes d'envois.
+
+Plutôt que de relire la liste des courriels, un client abonné avec
+`subscribe` reçoit les nouveaux courriels au fil de `notifications`: le
+serveur les envoie sans requête, entre les réponses, et le client les
+met de côté jusqu'à leur lecture.
+
+Exemple:
+    async with GloClient("127.0.0.1") as client:
+        await client.login("alice", "Password123")
+        await client.send("bob@glo2000.ca", "Sujet", "Bonjour!")
+        page = await client.list()
+        email = await client.fetch(page.emails[0]["id"])
+
+        await client.subscribe()
+        async for summary in client.notifications():
+            email = await client.fetch(summary["id"])
+"""
+import asyncio
+import itertools
+import socket
+from typing import AsyncIterator, Callable, NamedTuple, Optional, Sequence
+
+import glosocket
+import gloutils
+
+# Délai d'attente (secondes) d'une connexion ou d'une réponse
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_FIELDS = ("number", "id", "sender", "subject", "date")
+
+# Requêtes sans effet de bord, renvoyées une fois après une reconnexion
+_IDEMPOTENT_HEADERS = frozenset({
+    gloutils.Headers.AUTH_LOGIN,
+    gloutils.Headers.INBOX_READING_REQUEST,
+    gloutils.Headers.INBOX_READING_CHOICE,
+    gloutils.Headers.INBOX_READING_ID,
+    gloutils.Headers.INBOX_READING_BATCH_CHOICE,
+    gloutils.Headers.STATS_REQUEST,
+    gloutils.Headers.METRICS_REQUEST,
+    gloutils.Headers.SEARCH,
+    gloutils.Headers.SUBSCRIBE,
+})
+
+
+class GLOClientError(Exception):
+    """Une erreur de communication avec le serveur."""
+
+
+class ServerError(GLOClientError):
+    """Le serveur a répondu à la requête par l'entête ERROR."""
+
+    def __init__(self, error_message: str) -> None:
+        super().__init__(error_message)
+        self.error_message = error_message
+
+
+class _ConnectionLost(GLOClientError):
+    pass
+
+
+class EmailPage(NamedTuple):
+    """Une page de la liste des courriels et le curseur de la suivante."""
+    emails: list[gloutils.EmailSummary]
+    next_cursor: Optional[str]
+
+
+class _Connection:
+    """
+    Connexion ouverte: ses flux, son encodage et les réponses attendues.
+    `on_push` reçoit les messages envoyés par le serveur sans requête,
+    puis None à la fermeture.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter,
+                 on_push: Callable[[Optional[gloutils.GloMessage]], None]) -> None:
+        self.writer = writer
+        self._on_push = on_push
+        self.codec = glosocket.CODEC_JSON
+        self.compression: Optional[str] = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.closed = False
+        self._decoder = glosocket.FrameDecoder()
+        self._reader_task = asyncio.create_task(self._read_replies(reader))
+
+    def send(self, message: gloutils.GloMessage) -> None:
+        self.writer.writelines(glosocket.encode_frame(
+            glosocket.encode_message(message, self.codec), self.compression))
+
+    async def request(self, message: gloutils.GloMessage) -> gloutils.GloMessage:
+        """Envoie la requête, qui doit avoir un `request_id`, et attend sa réponse."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message["request_id"]] = future
+        try:
+            self.send(message)
+            await self.writer.drain()
+            return await future
+        except OSError as ex:
+            self.close()
+            raise _ConnectionLost("Lost connection with the server") from ex
+        finally:
+            self.pending.pop(message["request_id"], None)
+
+    def close(self) -> None:
+        """Ferme la connexion; les requêtes en attente échouent."""
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        self._reader_task.cancel()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(_ConnectionLost("Lost connection with the server"))
+        self._on_push(None)
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while data := await reader.read(glosocket.RECV_CHUNK_SIZE):
+                for frame in self._decoder.feed(data):
+                    reply: gloutils.GloMessage = glosocket.decode_message(frame)
+                    if "request_id" not in reply:
+                        # Notification (NEW_EMAIL) entre deux réponses
+                        self._on_push(reply)
+                        continue
+                    future = self.pending.get(reply.get("request_id"))
+                    if future is not None and not future.done():
+                        future.set_result(reply)
+        except (OSError, ValueError, glosocket.GLOSocketError):
+            pass
+        finally:
+            # Sans appel à cancel(), sinon close() annulerait cette tâche
+            self._reader_task = asyncio.current_task()
+            self.close()
+
+
+class GloClient:
+    """
+    Client asynchrone pour le serveur mail @glo2000.ca.
+
+    La connexion est ouverte par `connect` (ou `async with`) et rouverte au
+    besoin si `reconnect` est vrai. Les codecs et compressions proposés au
+    serveur avec HELLO sont `codecs` et `compressions`, par ordre de
+    préférence. Chaque connexion et chaque requête doivent aboutir en
+    `timeout` secondes, sinon GLOClientError est levée et la connexion
+    est fermée. Un abonnement aux nouveaux courriels est renouvelé à
+    chaque reconnexion.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = gloutils.APP_PORT,
+                 timeout: float = DEFAULT_TIMEOUT, reconnect: bool = True,
+                 codecs: Sequence[str] = glosocket.CODECS,
+                 compressions: Sequence[str] = glosocket.COMPRESSIONS) -> None:
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._reconnect = reconnect
+        self._codecs = list(codecs)
+        self._compressions = list(compressions)
+        self._connection: Optional[_Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._request_ids = itertools.count(1)
+        self._credentials: Optional[gloutils.AuthPayload] = None
+        self._subscribed = False
+        # Courriels notifiés et pas encore lus; None signale une connexion
+        # fermée ou la fin de l'abonnement à `notifications`
+        self._notifications: asyncio.Queue[Optional[gloutils.EmailSummary]] = asyncio.Queue()
+
+    async def __aenter__(self) -> "GloClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @property
+    def username(self) -> Optional[str]:
+        """Nom de l'utilisateur connecté, ou None."""
+        return self._credentials["username"] if self._credentials else None
+
+    @property
+    def pending(self) -> int:
+        """Nombre de requêtes en attente d'une réponse."""
+        return len(self._connection.pending) if self._connection else 0
+
+    async def connect(self) -> None:
+        """
+        Ouvre la connexion si elle ne l'est pas, négocie le codec et la
+        compression, puis reconnecte l'utilisateur s'il l'était.
+        """
+        async with self._connect_lock:
+            if self._connection is not None and not self._connection.closed:
+                return
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self._host, self._port), self._timeout)
+            except (OSError, asyncio.TimeoutError) as ex:
+                raise GLOClientError(f"Cannot connect to {self._host}:{self._port}") from ex
+            writer.get_extra_info("socket").setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = _Connection(reader, writer, self._on_push)
+
+            reply = await self._exchange(connection, gloutils.GloMessage(
+                header=gloutils.Headers.HELLO,
+                payload=gloutils.HelloPayload(
+                    out_of_order=True,
+                    codecs=self._codecs,
+                    compressions=self._compressions,
+                ),
+            ))
+            if reply["header"] == gloutils.Headers.OK:
+                connection.codec = reply["payload"].get("codec", glosocket.CODEC_JSON)
+                connection.compression = reply["payload"].get("compression")
+            if self._credentials is not None:
+                reply = await self._exchange(connection, gloutils.GloMessage(
+                    header=gloutils.Headers.AUTH_LOGIN, payload=self._credentials))
+                if reply["header"] == gloutils.Headers.ERROR:
+                    connection.close()
+                    raise ServerError(reply["payload"]["error_message"])
+            if self._subscribed:
+                # Les courriels arrivés pendant la coupure ne sont pas notifiés
+                await self._exchange(connection, gloutils.GloMessage(
+                    header=gloutils.Headers.SUBSCRIBE,
+                    payload=gloutils.SubscribePayload(enabled=True)))
+            self._connection = connection
+
+    async def close(self) -> None:
+        """
+        Prévient le serveur avec l'entête BYE et ferme la connexion, ce qui
+        met fin à l'abonnement aux nouveaux courriels.
+        """
+        self._end_subscription()
+        connection, self._connection = self._connection, None
+        if connection is None or connection.closed:
+            return
+        try:
+            connection.send(gloutils.GloMessage(header=gloutils.Headers.BYE))
+            await asyncio.wait_for(connection.writer.drain(), self._timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        connection.close()
+        try:
+            await connection.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte. Lève ServerError en cas de refus."""
+        credentials = gloutils.AuthPayload(username=username, password=password)
+        self._end_subscription()
+        await self._call(gloutils.Headers.AUTH_REGISTER, credentials)
+        self._credentials = credentials
+
+    async def login(self, username: str, password: str) -> None:
+        """Se connecte au compte. Lève ServerError en cas de refus."""
+        credentials = gloutils.AuthPayload(username=username, password=password)
+        self._end_subscription()
+        await self._call(gloutils.Headers.AUTH_LOGIN, credentials)
+        self._credentials = credentials
+
+    async def logout(self) -> None:
+        """Se déconnecte du compte; le serveur ne répond pas à AUTH_LOGOUT."""
+        self._credentials = None
+        self._end_subscription()
+        if self._connection is not None and not self._connection.closed:
+            self._connection.send(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
+
+    async def send(self, destination: str, subject: str, content: str) -> None:
+        """Envoie un courriel. Lève ServerError s'il n'est pas livré."""
+        await self._call(gloutils.Headers.EMAIL_SENDING, gloutils.EmailContentPayload(
+            sender=self._sender(),
+            destination=destination,
+            subject=subject,
+            date=gloutils.get_current_utc_time(),
+            content=content,
+        ))
+
+    async def send_batch(self, destinations: list[str], subject: str,
+                         content: str) -> list[gloutils.DeliveryResult]:
+        """Envoie le même courriel à plusieurs destinataires en une requête."""
+        payload: gloutils.BatchDeliveryPayload = await self._call(
+            gloutils.Headers.EMAIL_BATCH_SENDING, gloutils.EmailBatchPayload(
+                sender=self._sender(),
+                destinations=destinations,
+                subject=subject,
+                date=gloutils.get_current_utc_time(),
+                content=content,
+            ))
+        return payload["results"]
+
+    async def list(self, limit: int = gloutils.CLIENT_PAGE_SIZE,
+                   cursor: Optional[str] = None,
+                   fields: Sequence[str] = DEFAULT_FIELDS) -> EmailPage:
+        """Retourne une page de la liste des courriels, à partir de `cursor`."""
+        request = gloutils.EmailListRequestPayload(limit=limit, fields=list(fields))
+        if cursor is not None:
+            request["cursor"] = cursor
+        page: gloutils.EmailPagePayload = await self._call(
+            gloutils.Headers.INBOX_READING_REQUEST, request)
+        return EmailPage(page["emails"], page.get("next_cursor"))
+
+    async def search(self, sender: Optional[str] = None, subject: Optional[str] = None,
+                     body: Optional[str] = None, since: Optional[str] = None,
+                     until: Optional[str] = None, limit: int = gloutils.CLIENT_PAGE_SIZE,
+                     cursor: Optional[str] = None,
+                     fields: Sequence[str] = DEFAULT_FIELDS) -> EmailPage:
+        """
+        Retourne une page des courriels qui contiennent tous les mots de
+        `sender`, `subject` et `body` dans ces champs, datés entre `since`
+        et `until` (format de `gloutils.get_current_utc_time`).
+        """
+        request = gloutils.SearchPayload(limit=limit, fields=list(fields))
+        for name, value in (("sender", sender), ("subject", subject), ("body", body),
+                            ("since", since), ("until", until), ("cursor", cursor)):
+            if value is not None:
+                request[name] = value
+        page: gloutils.EmailPagePayload = await self._call(gloutils.Headers.SEARCH, request)
+        return EmailPage(page["emails"], page.get("next_cursor"))
+
+    async def iter_emails(self, fields: Sequence[str] = DEFAULT_FIELDS,
+                          page_size: int = gloutils.MAX_PAGE_SIZE
+                          ) -> AsyncIterator[gloutils.EmailSummary]:
+        """Parcourt toute la liste des courriels, une page à la fois."""
+        cursor = None
+        while True:
+            page = await self.list(page_size, cursor, fields)
+            for email in page.emails:
+                yield email
+            if page.next_cursor is None:
+                return
+            cursor = page.next_cursor
+
+    async def fetch(self, email_id: int) -> gloutils.EmailContentPayload:
+        """Retourne le courriel d'identifiant `email_id`."""
+        return await self._call(gloutils.Headers.INBOX_READING_ID,
+                                gloutils.EmailIdPayload(id=email_id))
+
+    async def stats(self) -> gloutils.StatsPayload:
+        """Retourne le nombre de courriels et la taille du dossier."""
+        return await self._call(gloutils.Headers.STATS_REQUEST)
+
+    async def metrics(self) -> gloutils.MetricsPayload:
+        """Retourne les métriques du serveur (compte administrateur seulement)."""
+        return await self._call(gloutils.Headers.METRICS_REQUEST)
+
+    async def start_profiling(self, mode: Optional[str] = None,
+                              percent: Optional[float] = None,
+                              headers: Optional[Sequence[str]] = None
+                              ) -> gloutils.ProfilingPayload:
+        """
+        Démarre le profilage des requêtes du serveur (compte administrateur
+        seulement) et retourne les options retenues. Les options omises
+        sont celles par défaut du serveur.
+        """
+        payload = gloutils.ProfilingPayload(enabled=True)
+        if mode is not None:
+            payload["mode"] = mode
+        if percent is not None:
+            payload["percent"] = percent
+        if headers is not None:
+            payload["headers"] = list(headers)
+        return await self._call(gloutils.Headers.PROFILING_REQUEST, payload)
+
+    async def stop_profiling(self) -> Sequence[str]:
+        """Arrête le profilage et retourne les fichiers écrits par le serveur."""
+        payload: gloutils.ProfilingPayload = await self._call(
+            gloutils.Headers.PROFILING_REQUEST, gloutils.ProfilingPayload(enabled=False))
+        return payload["files"]
+
+    async def subscribe(self) -> None:
+        """
+        S'abonne aux nouveaux courriels du compte connecté, qui seront
+        remis par `notifications`.
+        """
+        await self._call(gloutils.Headers.SUBSCRIBE, gloutils.SubscribePayload(enabled=True))
+        self._subscribed = True
+
+    async def unsubscribe(self) -> None:
+        """Met fin à l'abonnement aux nouveaux courriels."""
+        self._end_subscription()
+        await self._call(gloutils.Headers.SUBSCRIBE, gloutils.SubscribePayload(enabled=False))
+
+    async def notifications(self) -> AsyncIterator[gloutils.EmailSummary]:
+        """
+        Parcourt les nouveaux courriels (`id`, `sender`, `subject`, `date`
+        et `size`) à mesure que le serveur les notifie, jusqu'à la fin de
+        l'abonnement (`unsubscribe`, `logout` ou `close`).
+
+        Une connexion perdue est rouverte si `reconnect` est vrai, sinon
+        GLOClientError est levée. Les courriels arrivés pendant la coupure
+        ne sont pas notifiés: `list` les retrouve.
+        """
+        while True:
+            email = await self._notifications.get()
+            if email is not None:
+                yield email
+            elif not self._subscribed:
+                return
+            elif self._connection is None or self._connection.closed:
+                if not self._reconnect:
+                    raise GLOClientError("Lost connection with the server")
+                await self.connect()
+
+    def _on_push(self, message: Optional[gloutils.GloMessage]) -> None:
+        """Met de côté les courriels notifiés par le serveur sans requête."""
+        if message is None:
+            if self._subscribed:
+                self._notifications.put_nowait(None)
+        elif message.get("header") == gloutils.Headers.NEW_EMAIL:
+            for email in message["payload"]["emails"]:
+                self._notifications.put_nowait(email)
+
+    def _end_subscription(self) -> None:
+        if self._subscribed:
+            self._subscribed = False
+            self._notifications.put_nowait(None)
+
+    def _sender(self) -> str:
+        if self._credentials is None:
+            raise GLOClientError("Not logged in")
+        return f"{self._credentials['username']}@{gloutils.SERVER_DOMAIN}"
+
+    async def _call(self, header: gloutils.Headers, payload=None):
+        """
+        Envoie une requête et retourne le payload de la réponse. Lève
+        ServerError si le serveur répond par une erreur.
+        """
+        message = gloutils.GloMessage(header=header)
+        if payload is not None:
+            message["payload"] = payload
+        retries = 1 if self._reconnect and header in _IDEMPOTENT_HEADERS else 0
+        while True:
+            if self._connection is None or self._connection.closed:
+                if self._connection is not None and not self._reconnect:
+                    raise GLOClientError("Lost connection with the server")
+                await self.connect()
+            try:
+                reply = await self._exchange(self._connection, message)
+                break
+            except _ConnectionLost:
+                if not retries:
+                    raise
+                retries -= 1
+        if reply["header"] == gloutils.Headers.ERROR:
+            raise ServerError(reply["payload"]["error_message"])
+        return reply.get("payload")
+
+    async def _exchange(self, connection: _Connection,
+                        message: gloutils.GloMessage) -> gloutils.GloMessage:
+        message = gloutils.GloMessage(message, request_id=next(self._request_ids))
+        try:
+            return await asyncio.wait_for(connection.request(message), self._timeout)
+        except asyncio.TimeoutError:
+            # La réponse viendra peut-être plus tard: on repart de zéro
+            connection.close()
+            raise GLOClientError("Timed out waiting for the server") from None
+
+
+class GloClientPool:
+    """
+    Bassin de `size` connexions authentifiées au même compte.
+
+    Chaque requête part sur la connexion qui attend le moins de réponses.
+    Avec plusieurs processus serveurs (--workers), les connexions sont
+    aussi réparties entre eux. Les options de GloClient sont acceptées.
+    """
+
+    def __init__(self, username: str, password: str, size: int = 4,
+                 **client_options) -> None:
+        self._username = username
+        self._password = password
+        self._clients = [GloClient(**client_options) for _ in range(size)]
+
+    async def __aenter__(self) -> "GloClientPool":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        """Ouvre les connexions et y connecte l'utilisateur."""
+        try:
+            await asyncio.gather(*(self._open_client(client) for client in self._clients))
+        except GLOClientError:
+            await self.close()
+            raise
+
+    async def close(self) -> None:
+        await asyncio.gather(*(client.close() for client in self._clients))
+
+    async def send(self, destination: str, subject: str, content: str) -> None:
+        await self._client().send(destination, subject, content)
+
+    async def send_batch(self, destinations: list[str], subject: str,
+                         content: str) -> list[gloutils.DeliveryResult]:
+        return await self._client().send_batch(destinations, subject, content)
+
+    async def list(self, limit: int = gloutils.CLIENT_PAGE_SIZE,
+                   cursor: Optional[str] = None,
+                   fields: Sequence[str] = DEFAULT_FIELDS) -> EmailPage:
+        return await self._client().list(limit, cursor, fields)
+
+    async def search(self, sender: Optional[str] = None, subject: Optional[str] = None,
+                     body: Optional[str] = None, since: Optional[str] = None,
+                     until: Optional[str] = None, limit: int = gloutils.CLIENT_PAGE_SIZE,
+                     cursor: Optional[str] = None,
+                     fields: Sequence[str] = DEFAULT_FIELDS) -> EmailPage:
+        return await self._client().search(sender, subject, body, since, until,
+                                           limit, cursor, fields)
+
+    async def fetch(self, email_id: int) -> gloutils.EmailContentPayload:
+        return await self._client().fetch(email_id)
+
+    async def stats(self) -> gloutils.StatsPayload:
+        return await self._client().stats()
+
+    async def _open_client(self, client: GloClient) -> None:
+        await client.connect()
+        await client.login(self._username, self._password)
+
+    def _client(self) -> GloClient:
+        return min(self._clients, key=lambda client: client.pending)
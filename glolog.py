@@ -0,0 +1,158 @@
+"""\
+Module fournissant le journal d'événements structuré du serveur.
+
+Un événement est un nom et des champs, écrit en une ligne JSON:
+    {"time": "2024-01-01T12:00:00.000Z", "level": "info", "event": "login", "pid": 42, "conn": 7, "user": "alice", "ok": true}
+
+Journaliser ne fait qu'ajouter l'événement à un tampon de taille fixe.
+Un fil d'arrière-plan vide le tampon toutes les `flush_interval` secondes
+et écrit les lignes en une seule écriture. Si la sortie est lente ou
+bloquée (ex.: un tube que plus personne ne lit), le fil d'écriture attend
+mais le serveur continue: une fois le tampon plein, les nouveaux
+événements sont jetés et comptés, puis un événement "log_dropped" en
+donne le nombre dès que la sortie reprend.
+
+Les événements sous le niveau `level` sont ignorés. Ceux sous WARNING
+peuvent être échantillonnés: seule une fraction `sample` est gardée, ou
+la fraction donnée pour leur nom dans `event_samples`.
+"""
+import collections
+import json
+import random
+import sys
+import threading
+import time
+from typing import Callable, NamedTuple, Optional, TextIO
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+_LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+# Nombre maximal d'événements en attente d'écriture
+DEFAULT_CAPACITY = 10000
+# Intervalle (secondes) entre deux écritures des événements en attente
+DEFAULT_FLUSH_INTERVAL = 0.1
+
+
+class LogOptions(NamedTuple):
+    """
+    Options du journal: niveau minimal, fraction gardée des événements
+    sous WARNING (par défaut et par nom d'événement) et nombre maximal
+    d'événements en attente.
+    """
+    level: int = INFO
+    sample: float = 1.0
+    event_samples: Optional[dict[str, float]] = None
+    capacity: int = DEFAULT_CAPACITY
+
+
+class EventLog:
+    """Journal d'événements en lignes JSON, écrit par un fil d'arrière-plan."""
+
+    def __init__(self, options: LogOptions = LogOptions(),
+                 stream: Optional[TextIO] = None,
+                 fields: Optional[dict[str, object]] = None,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 initializer: Optional[Callable[[], None]] = None) -> None:
+        """
+        `fields` sont ajoutés à chaque événement (ex.: le pid du processus)
+        et `initializer` est appelée au début du fil d'écriture.
+        """
+        self._level = options.level
+        self._sample = options.sample
+        self._event_samples = options.event_samples or {}
+        self._capacity = options.capacity
+        self._stream = stream if stream is not None else sys.stdout
+        self._fields = fields or {}
+        self._buffer: collections.deque[tuple[float, int, str, dict[str, object]]] = collections.deque()
+        # Compteurs modifiés depuis plusieurs fils
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.sampled_out = 0
+        self._reported_dropped = 0
+        self._stopped = threading.Event()
+        self._writer = threading.Thread(
+            target=self._write_periodically, args=(flush_interval, initializer), daemon=True)
+        self._writer.start()
+
+    def log(self, level: int, event: str, **fields: object) -> None:
+        """Ajoute l'événement au tampon s'il est gardé, sans jamais attendre la sortie."""
+        if level < self._level:
+            return
+        if level < WARNING:
+            sample = self._event_samples.get(event, self._sample)
+            if sample < 1.0 and random.random() >= sample:
+                with self._lock:
+                    self.sampled_out += 1
+                return
+        if len(self._buffer) >= self._capacity:
+            with self._lock:
+                self.dropped += 1
+            return
+        self._buffer.append((time.time(), level, event, fields))
+
+    def debug(self, event: str, **fields: object) -> None:
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event: str, **fields: object) -> None:
+        self.log(INFO, event, **fields)
+
+    def warning(self, event: str, **fields: object) -> None:
+        self.log(WARNING, event, **fields)
+
+    def error(self, event: str, **fields: object) -> None:
+        self.log(ERROR, event, **fields)
+
+    def close(self, timeout: float = 1.0) -> None:
+        """
+        Écrit les événements en attente et arrête le fil d'écriture, sans
+        attendre plus de `timeout` secondes une sortie bloquée.
+        """
+        self._stopped.set()
+        self._writer.join(timeout)
+
+    def _write_periodically(self, interval: float,
+                            initializer: Optional[Callable[[], None]]) -> None:
+        if initializer is not None:
+            initializer()
+        while not self._stopped.wait(interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self) -> None:
+        """Écrit en une fois les événements en attente."""
+        lines = []
+        dropped = self.dropped - self._reported_dropped
+        if dropped:
+            self._reported_dropped += dropped
+            lines.append(self._format(time.time(), WARNING, "log_dropped",
+                                      {"dropped": dropped, "total": self._reported_dropped}))
+        buffer = self._buffer
+        for _ in range(len(buffer)):
+            lines.append(self._format(*buffer.popleft()))
+        if not lines:
+            return
+        try:
+            self._stream.write("".join(lines))
+            self._stream.flush()
+        except (OSError, ValueError):
+            # Sortie fermée: les événements sont perdus
+            with self._lock:
+                self.dropped += len(lines)
+            self._reported_dropped += len(lines)
+
+    def _format(self, timestamp: float, level: int, event: str,
+                fields: dict[str, object]) -> str:
+        milliseconds = int(timestamp % 1 * 1000)
+        record = {
+            "time": time.strftime(f"%Y-%m-%dT%H:%M:%S.{milliseconds:03d}Z",
+                                  time.gmtime(timestamp)),
+            "level": _LEVEL_NAMES.get(level, str(level)),
+            "event": event,
+            **self._fields,
+            **fields,
+        }
+        return json.dumps(record, ensure_ascii=False, default=str) + "\n"
@@ -0,0 +1,175 @@
+"""\
+Module fournissant les métriques du serveur.
+
+Pour chaque entête de requête, le serveur compte les requêtes, les
+erreurs et les octets reçus et envoyés, et classe les latences dans un
+histogramme. Les jauges (clients connectés, utilisateurs connectés,
+taille de la boîte LOST) sont lues au moment de l'export.
+
+Les métriques sont exportées en payload (entête METRICS_REQUEST) ou au
+format texte de Prometheus, dans un fichier ou sur un port HTTP local.
+
+Seule la boucle principale du serveur enregistre des requêtes. Les
+entêtes connus ont tous leur entrée dès le départ: un export depuis un
+autre fil ne voit donc jamais le dictionnaire changer de taille.
+"""
+import bisect
+import http.server
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import gloutils
+
+# Bornes supérieures (secondes) des classes de l'histogramme des latences
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_PREFIX = "glo"
+
+# Jauge: (description, fonction qui retourne sa valeur)
+Gauges = dict[str, tuple[str, Callable[[], float]]]
+
+
+class RequestMetrics:
+    """Métriques des requêtes d'un entête."""
+    __slots__ = ("requests", "errors", "bytes_in", "bytes_out",
+                 "latency_counts", "latency_sum")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Une classe de plus pour les latences au-delà de la dernière borne
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+
+class ServerMetrics:
+    """Métriques des requêtes du serveur, par entête, et ses jauges."""
+
+    def __init__(self, gauges: Optional[Gauges] = None) -> None:
+        self._requests = {
+            header: RequestMetrics() for header in gloutils.Headers
+            if header not in (gloutils.Headers.OK, gloutils.Headers.ERROR)
+        }
+        self._gauges = gauges or {}
+        self._started = time.time()
+
+    def record(self, header: int, latency: float, error: bool,
+               bytes_in: int, bytes_out: int) -> None:
+        """Enregistre une requête traitée. Les entêtes inconnus sont ignorés."""
+        metrics = self._requests.get(header)
+        if metrics is None:
+            return
+        metrics.requests += 1
+        if error:
+            metrics.errors += 1
+        metrics.bytes_in += bytes_in
+        metrics.bytes_out += bytes_out
+        metrics.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        metrics.latency_sum += latency
+
+    def to_payload(self) -> gloutils.MetricsPayload:
+        """Retourne les métriques des entêtes déjà reçus et les jauges."""
+        return gloutils.MetricsPayload(
+            uptime=time.time() - self._started,
+            requests={
+                header.name: gloutils.RequestMetricsPayload(
+                    requests=metrics.requests,
+                    errors=metrics.errors,
+                    bytes_in=metrics.bytes_in,
+                    bytes_out=metrics.bytes_out,
+                    latency_buckets=list(LATENCY_BUCKETS),
+                    latency_counts=list(metrics.latency_counts),
+                    latency_sum=metrics.latency_sum,
+                )
+                for header, metrics in self._requests.items() if metrics.requests
+            },
+            gauges={name: read() for name, (_, read) in self._gauges.items()},
+        )
+
+    def to_prometheus(self) -> str:
+        """Retourne les métriques au format texte de Prometheus."""
+        requests = [(header.name, metrics) for header, metrics in self._requests.items()
+                    if metrics.requests]
+        lines = []
+        for name, description, attribute in (
+                ("requests_total", "Requêtes traitées.", "requests"),
+                ("request_errors_total", "Requêtes terminées par une erreur.", "errors"),
+                ("received_bytes_total", "Octets des requêtes reçues.", "bytes_in"),
+                ("sent_bytes_total", "Octets des réponses envoyées.", "bytes_out")):
+            lines.append(f"# HELP {_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {_PREFIX}_{name} counter")
+            for header, metrics in requests:
+                lines.append(f'{_PREFIX}_{name}{{header="{header}"}} {getattr(metrics, attribute)}')
+
+        name = f"{_PREFIX}_request_duration_seconds"
+        lines.append(f"# HELP {name} Latence des requêtes, de leur réception à leur réponse.")
+        lines.append(f"# TYPE {name} histogram")
+        for header, metrics in requests:
+            total = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), metrics.latency_counts):
+                total += count
+                lines.append(f'{name}_bucket{{header="{header}",le="{bound}"}} {total}')
+            lines.append(f'{name}_sum{{header="{header}"}} {metrics.latency_sum}')
+            lines.append(f'{name}_count{{header="{header}"}} {total}')
+
+        for gauge, (description, read) in self._gauges.items():
+            lines.append(f"# HELP {_PREFIX}_{gauge} {description}")
+            lines.append(f"# TYPE {_PREFIX}_{gauge} gauge")
+            lines.append(f"{_PREFIX}_{gauge} {read()}")
+        lines.append(f"# TYPE {_PREFIX}_start_time_seconds gauge")
+        lines.append(f"{_PREFIX}_start_time_seconds {self._started}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: str) -> None:
+        """Écrit les métriques au format Prometheus, de façon atomique."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def start_exporter(self, path: Optional[str], port: Optional[int],
+                       interval: float,
+                       initializer: Optional[Callable[[], None]] = None) -> None:
+        """
+        Lance en arrière-plan l'écriture des métriques dans le fichier
+        `path` toutes les `interval` secondes et leur service en HTTP sur
+        le port local `port`. `initializer` est appelée au début de chaque
+        fil lancé.
+        """
+        def _run(target: Callable[[], None]) -> None:
+            if initializer is not None:
+                initializer()
+            target()
+
+        if path is not None:
+            def _write_periodically() -> None:
+                while True:
+                    try:
+                        self.write_file(path)
+                    except OSError as ex:
+                        print(f"Cannot write metrics to {path} : {ex}")
+                    time.sleep(interval)
+            threading.Thread(target=_run, args=(_write_periodically,), daemon=True).start()
+
+        if port is not None:
+            metrics = self
+
+            class _Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    body = metrics.to_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args) -> None:
+                    pass
+
+            httpd = http.server.HTTPServer(("127.0.0.1", port), _Handler)
+            threading.Thread(target=_run, args=(httpd.serve_forever,), daemon=True).start()
@@ -0,0 +1,153 @@
+"""\
+Module fournissant le profilage à la demande des requêtes du serveur.
+
+Un RequestProfiler profile une partie des requêtes (`percent`), ou
+seulement celles de certains entêtes, de l'une de deux façons:
+- "cprofile": chaque requête choisie est exécutée sous cProfile et les
+    statistiques sont cumulées par entête, puis écrites dans
+    `<entête>-<pid>.prof` (lisible avec `python -m pstats`);
+- "sample": un fil relève les piles des fils qui traitent une requête
+    choisie toutes les `interval` secondes, puis les écrit par entête dans
+    `<entête>-<pid>.folded`, une pile par ligne suivie de son nombre
+    d'échantillons (format de flamegraph.pl et speedscope). Plus léger
+    que cProfile, qui ralentit chaque appel de fonction.
+
+Le serveur ne passe par le profileur que pendant le profilage: arrêté,
+il n'a aucun coût.
+"""
+import cProfile
+import collections
+import os
+import pstats
+import random
+import sys
+import threading
+import types
+from typing import Callable, NamedTuple, Optional, TypeVar
+
+MODE_CPROFILE = "cprofile"
+MODE_SAMPLE = "sample"
+MODES = (MODE_CPROFILE, MODE_SAMPLE)
+
+# Intervalle (secondes) entre deux relevés des piles en mode "sample"
+SAMPLE_INTERVAL = 0.001
+
+_T = TypeVar("_T")
+
+
+class ProfilerOptions(NamedTuple):
+    """
+    Options du profilage: dossier des fichiers écrits, mode, pourcentage
+    des requêtes profilées et noms des entêtes visés (None pour tous).
+    """
+    directory: str = "profiles"
+    mode: str = MODE_SAMPLE
+    percent: float = 100.0
+    headers: Optional[frozenset[str]] = None
+
+
+class RequestProfiler:
+    """Profile les requêtes choisies selon les options, jusqu'à `stop`."""
+
+    def __init__(self, options: ProfilerOptions,
+                 interval: float = SAMPLE_INTERVAL,
+                 initializer: Optional[Callable[[], None]] = None) -> None:
+        if options.mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {options.mode}")
+        self.options = options
+        self._lock = threading.Lock()
+        # Depuis Python 3.12, un seul profileur cProfile peut être actif à
+        # la fois dans le processus: une seule requête est profilée à la fois
+        self._cprofile_lock = threading.Lock()
+        self._stats: dict[str, pstats.Stats] = {}
+        self._stacks: dict[str, collections.Counter[str]] = collections.defaultdict(collections.Counter)
+        # Fils en train de traiter une requête choisie, et son entête
+        self._active: dict[int, str] = {}
+        self._stopped = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        if options.mode == MODE_SAMPLE:
+            self._sampler = threading.Thread(
+                target=self._sample, args=(interval, initializer), daemon=True)
+            self._sampler.start()
+
+    def run(self, header: str, function: Callable[..., _T], *args) -> _T:
+        """Exécute `function(*args)`, profilée si la requête est choisie."""
+        options = self.options
+        if ((options.headers is not None and header not in options.headers)
+                or (options.percent < 100 and random.random() * 100 >= options.percent)):
+            return function(*args)
+
+        if options.mode == MODE_CPROFILE:
+            if not self._cprofile_lock.acquire(blocking=False):
+                return function(*args)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                self._cprofile_lock.release()
+                with self._lock:
+                    if header in self._stats:
+                        self._stats[header].add(profile)
+                    else:
+                        self._stats[header] = pstats.Stats(profile)
+
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = header
+        try:
+            return function(*args)
+        finally:
+            with self._lock:
+                del self._active[ident]
+
+    def stop(self) -> list[str]:
+        """Arrête le profilage, écrit les fichiers et retourne leurs chemins."""
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        os.makedirs(self.options.directory, exist_ok=True)
+        paths = []
+        with self._lock:
+            for header, stats in sorted(self._stats.items()):
+                path = self._path(header, ".prof")
+                stats.dump_stats(path)
+                paths.append(path)
+            for header, stacks in sorted(self._stacks.items()):
+                path = self._path(header, ".folded")
+                with open(path, 'w', encoding='utf-8') as file:
+                    for stack, count in stacks.most_common():
+                        file.write(f"{stack} {count}\n")
+                paths.append(path)
+        return paths
+
+    def _path(self, header: str, suffix: str) -> str:
+        # Un fichier par processus avec --workers
+        return os.path.join(self.options.directory, f"{header}-{os.getpid()}{suffix}")
+
+    def _sample(self, interval: float,
+                initializer: Optional[Callable[[], None]]) -> None:
+        """Relève les piles des fils actifs jusqu'à l'arrêt."""
+        if initializer is not None:
+            initializer()
+        while not self._stopped.wait(interval):
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, header in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self._stacks[header][self._collapse(frame)] += 1
+
+    def _collapse(self, frame: Optional[types.FrameType]) -> str:
+        """Pile de la racine (l'appel de `run`) jusqu'au cadre, séparée par des « ; »."""
+        names = []
+        while frame is not None and frame.f_code is not _RUN_CODE:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                         f":{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+
+_RUN_CODE = RequestProfiler.run.__code__
@@ -0,0 +1,216 @@
+"""\
+Module fournissant la recherche plein texte dans les courriels d'une boîte.
+
+Un SearchIndex est un index inversé: pour chaque champ (expéditeur,
+sujet, corps), chaque terme est associé à la liste triée des
+identifiants (glostore) des courriels qui le contiennent. Les termes sont
+les mots du texte, en minuscules et sans accents; un courriel correspond
+à une requête s'il contient tous ses termes.
+
+L'index est tenu à jour en mémoire à chaque courriel ajouté et écrit
+dans le fichier `search.idx` de la boîte par `save`. Il n'a pas à être
+écrit à chaque ajout: l'index chargé connaît les identifiants qu'il
+contient et les courriels manquants (ajoutés après la dernière écriture)
+sont indexés de nouveau à partir des segments.
+
+Les courriels supprimés restent dans l'index: les résultats doivent
+être filtrés avec les identifiants encore présents dans la boîte.
+"""
+import array
+import bisect
+import os
+import re
+import struct
+import sys
+import unicodedata
+from typing import Mapping, Optional
+
+import glostore
+import gloutils
+
+# Champs indexés des courriels
+FIELDS = ("sender", "subject", "content")
+INDEX_FILENAME = "search.idx"
+# Les mots plus longs (ex.: pièces jointes encodées) ne sont pas indexés
+MAX_TERM_LENGTH = 64
+
+_WORD = re.compile(r"\w+")
+# Accents séparés des lettres par la décomposition NFKD
+_COMBINING = re.compile("[\u0300-\u036f]")
+
+_MAGIC = b"GLOIDX1\n"
+_COUNT = struct.Struct("!I")
+# Longueur du terme encodé et nombre d'identifiants qui le suivent
+_TERM = struct.Struct("!HI")
+_ID_SIZE = array.array("Q").itemsize
+
+
+def tokenize(text: str) -> set[str]:
+    """Retourne les termes du texte: ses mots, en minuscules et sans accents."""
+    text = _COMBINING.sub("", unicodedata.normalize("NFKD", text.casefold()))
+    return {word for word in _WORD.findall(text) if len(word) <= MAX_TERM_LENGTH}
+
+
+class SearchIndex:
+    """Index inversé des courriels d'une boîte, par champ."""
+
+    def __init__(self) -> None:
+        self._postings: dict[str, dict[str, array.array]] = {field: {} for field in FIELDS}
+        self._ids: set[int] = set()
+        # Courriels ajoutés depuis le chargement ou la dernière écriture
+        self.unsaved = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, email_id: int) -> bool:
+        return email_id in self._ids
+
+    def ids(self) -> set[int]:
+        """Identifiants des courriels indexés."""
+        return set(self._ids)
+
+    def add(self, email_id: int, email: gloutils.EmailContentPayload) -> None:
+        """Indexe le courriel, s'il ne l'est pas déjà."""
+        if email_id in self._ids:
+            return
+        self._ids.add(email_id)
+        for field in FIELDS:
+            postings = self._postings[field]
+            for term in tokenize(email[field]):
+                ids = postings.get(term)
+                if ids is None:
+                    postings[term] = array.array("Q", (email_id,))
+                elif ids[-1] < email_id:
+                    ids.append(email_id)
+                else:
+                    # Livraisons concurrentes indexées dans le désordre
+                    ids.insert(bisect.bisect_left(ids, email_id), email_id)
+        self.unsaved += 1
+
+    def search(self, query: Mapping[str, str]) -> Optional[set[int]]:
+        """
+        Retourne les identifiants des courriels qui contiennent tous les
+        termes de chaque champ de `query` (nom du champ: texte), ou None si
+        la requête ne contient aucun terme.
+        """
+        lists = []
+        for field, text in query.items():
+            for term in tokenize(text):
+                ids = self._postings[field].get(term)
+                if ids is None:
+                    return set()
+                lists.append(ids)
+        if not lists:
+            return None
+        # En partant du terme le plus rare: les quelques résultats sont
+        # cherchés par bissection dans les longues listes, les autres
+        # listes sont intersectées directement
+        lists.sort(key=len)
+        result = set(lists[0])
+        for ids in lists[1:]:
+            if len(ids) > 16 * len(result):
+                result = {email_id for email_id in result if _contains(ids, email_id)}
+            else:
+                result.intersection_update(ids)
+            if not result:
+                break
+        return result
+
+    def save(self, path: str) -> None:
+        """Écrit l'index dans le fichier, de façon atomique."""
+        # Un fichier temporaire par processus avec --workers
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(_MAGIC)
+            ids = array.array("Q", sorted(self._ids))
+            file.write(_COUNT.pack(len(ids)))
+            file.write(_to_network_order(ids))
+            for field in FIELDS:
+                postings = self._postings[field]
+                file.write(_COUNT.pack(len(postings)))
+                for term, ids in postings.items():
+                    encoded = term.encode('utf-8')
+                    file.write(_TERM.pack(len(encoded), len(ids)))
+                    file.write(encoded)
+                    file.write(_to_network_order(ids))
+        os.replace(temp_path, path)
+        self.unsaved = 0
+
+    @classmethod
+    def load(cls, path: str) -> "SearchIndex":
+        """
+        Lit l'index écrit par `save`. Lève une exception ValueError si le
+        fichier est invalide.
+        """
+        with open(path, 'rb') as file:
+            data = file.read()
+        if not data.startswith(_MAGIC):
+            raise ValueError(f"Not a search index: {path}")
+        view = memoryview(data)
+        index = cls()
+        try:
+            pos = len(_MAGIC)
+            count, = _COUNT.unpack_from(data, pos)
+            pos += _COUNT.size
+            ids, pos = _read_ids(view, pos, count)
+            index._ids = set(ids)
+            for field in FIELDS:
+                postings = index._postings[field]
+                terms, = _COUNT.unpack_from(data, pos)
+                pos += _COUNT.size
+                for _ in range(terms):
+                    length, count = _TERM.unpack_from(data, pos)
+                    pos += _TERM.size
+                    term = str(view[pos:pos + length], 'utf-8')
+                    postings[term], pos = _read_ids(view, pos + length, count)
+        except (struct.error, UnicodeError) as ex:
+            raise ValueError(f"Invalid search index {path}: {ex}")
+        if pos != len(data):
+            raise ValueError(f"Invalid search index {path}: trailing data")
+        return index
+
+
+def index_path(data_dir: str, username: str) -> str:
+    return os.path.join(data_dir, username, INDEX_FILENAME)
+
+
+def update_index(store: glostore.MailboxStore, data_dir: str, username: str) -> int:
+    """
+    Ajoute à l'index de l'utilisateur sur le disque ses courriels qui n'y
+    sont pas encore, puis l'écrit. Retourne le nombre de courriels ajoutés.
+    """
+    path = index_path(data_dir, username)
+    try:
+        index = SearchIndex.load(path)
+    except (FileNotFoundError, ValueError):
+        index = SearchIndex()
+    for stored in store.load(username):
+        index.add(stored.email_id, stored.email)
+    added = index.unsaved
+    if added:
+        index.save(path)
+    return added
+
+
+def _contains(ids: array.array, email_id: int) -> bool:
+    position = bisect.bisect_left(ids, email_id)
+    return position < len(ids) and ids[position] == email_id
+
+
+def _to_network_order(ids: array.array) -> bytes:
+    if sys.byteorder == "little":
+        ids = array.array("Q", ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+
+def _read_ids(view: memoryview, pos: int, count: int) -> tuple[array.array, int]:
+    end = pos + count * _ID_SIZE
+    if end > len(view):
+        raise ValueError("truncated search index")
+    ids = array.array("Q")
+    ids.frombytes(view[pos:end])
+    if sys.byteorder == "little":
+        ids.byteswap()
+    return ids, end
@@ -2,8 +2,84 @@
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
 """
+import array
+import collections
+import itertools
+import json
+import os
 import socket
 import struct
+import sys
+import threading
+import zlib
+from typing import NamedTuple, Optional, Protocol, Union
+
+try:
+    # Compression plus rapide que zlib, si le module est installé
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+
+# Taille maximale d'un appel à recv_into lors de la réception d'un message
+RECV_CHUNK_SIZE = 65536
+
+# Taille maximale acceptée pour un message, pour qu'une longueur
+# invalide ne provoque pas une allocation de plusieurs gigaoctets
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Nombre maximal d'octets lus par FrameDecoder.read_from en un appel,
+# pour qu'un client rapide ne monopolise pas le serveur
+READ_BUDGET = 1024 * 1024
+
+# En deçà de cette taille, copier l'entête et le message coûte moins
+# qu'un envoi groupé
+_COALESCE_LIMIT = 16384
+
+_HEADER = struct.Struct("!I")
+FRAME_HEADER_SIZE = _HEADER.size
+
+# Les deux bits de poids fort de l'entête indiquent la compression du
+# message, les autres sa longueur (moins de 1 Gio)
+_FLAGS_SHIFT = 30
+_LENGTH_MASK = (1 << _FLAGS_SHIFT) - 1
+
+# Compressions des messages, négociées avec l'entête HELLO
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZ4 = "lz4"
+_COMPRESSION_FLAGS = {COMPRESSION_ZLIB: 1, COMPRESSION_LZ4: 2}
+COMPRESSIONS = ((COMPRESSION_LZ4,) if _lz4 is not None else ()) + (COMPRESSION_ZLIB,)
+
+# En deçà de cette taille, un message est toujours envoyé sans compression
+COMPRESSION_THRESHOLD = 1024
+
+# Sur les listes et les courriels, le niveau 1 compresse presque autant
+# que le niveau par défaut (6) en deux fois moins de temps
+_ZLIB_LEVEL = 1
+
+# Nombre maximal de tampons par appel à sendmsg (IOV_MAX usuel)
+_MAX_IOVECS = 1024
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Sérialise les lectures positionnées sans os.pread (voir _pread)
+_seek_lock = threading.Lock()
+
+
+class _HasFileno(Protocol):
+    def fileno(self) -> int: ...
+
+
+class FileRegion(NamedTuple):
+    """
+    Partie d'un fichier à transmettre telle quelle avec os.sendfile, sans
+    la lire en mémoire. `file` doit rester ouvert jusqu'à la transmission.
+    """
+    file: _HasFileno
+    offset: int
+    count: int
+
+
+FramePart = Union[Buffer, FileRegion]
 
 
 class GLOSocketError(Exception):
@@ -13,55 +89,719 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+def _recvall(source: socket.socket, size: int,
+             chunk_size: int = RECV_CHUNK_SIZE) -> Union[bytes, bytearray]:
     """
     Fonction utilitaire pour recv_mesg.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Applique socket.recv_into en boucle dans un tampon préalloué
+    jusqu'à la réception d'un message de la taille voulue. Un petit
+    message reçu d'un seul recv est retourné sans tampon préalloué.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    if size <= chunk_size:
         try:
-            buffer = source.recv(chunk_size)
+            data = source.recv(size)
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if len(data) == size:
+            return data
+        if not data:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
+        msg = bytearray(size)
+        msg[:len(data)] = data
+        received = len(data)
+    else:
+        msg = bytearray(size)
+        received = 0
+    view = memoryview(msg)
+    while received < size:
+        chunk_end = min(size, received + chunk_size)
+        try:
+            count = source.recv_into(view[received:chunk_end])
+        except OSError as ex:
+            raise GLOSocketError("The source socket is closed.") from ex
+        if not count:
+            raise GLOSocketError("The other socket is closed.")
+        received += count
     return msg
 
 
-def snd_mesg(dest_soc: socket.socket, message: str) -> None:
+def _compress(data: Buffer, compression: str) -> bytes:
+    """Fonction utilitaire pour encode_frame: compresse le message."""
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, _ZLIB_LEVEL)
+    if compression == COMPRESSION_LZ4 and _lz4 is not None:
+        return _lz4.compress(data)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def _decompress(data: Buffer, flags: int, max_size: int) -> bytes:
+    """
+    Fonction utilitaire pour recv_bytes et FrameDecoder: décompresse le
+    message sans jamais produire plus de `max_size` octets.
+
+    Lève une exception GLOSocketError si le message est invalide ou si sa
+    taille décompressée dépasse `max_size` (bombe de décompression).
+    """
+    if flags == _COMPRESSION_FLAGS[COMPRESSION_ZLIB]:
+        decompressor = zlib.decompressobj()
+        error = zlib.error
+    elif flags == _COMPRESSION_FLAGS[COMPRESSION_LZ4] and _lz4 is not None:
+        decompressor = _lz4.LZ4FrameDecompressor()
+        error = RuntimeError
+    else:
+        raise GLOSocketError("The received message uses an unknown compression")
+
+    try:
+        message = decompressor.decompress(data, max_size + 1)
+    except error as ex:
+        raise GLOSocketError("The received message is not correctly compressed") from ex
+    if len(message) > max_size:
+        raise GLOSocketError("The decompressed message length is too large")
+    if not decompressor.eof or decompressor.unused_data:
+        raise GLOSocketError("The received message is not correctly compressed")
+    return message
+
+
+def encode_frame(message: Union[str, Buffer],
+                 compression: Optional[str] = None) -> list[Buffer]:
+    """
+    Retourne les tampons (entête de longueur, message) à transmettre.
+    Les petits messages sont regroupés en un seul tampon.
+
+    Si une compression est donnée, les messages d'au moins
+    COMPRESSION_THRESHOLD octets sont compressés, sauf si la compression
+    ne les raccourcit pas.
+    """
+    if isinstance(message, str):
+        data = message.encode(encoding='utf-8')
+    else:
+        data = message
+    # len() d'une memoryview compte des éléments, pas forcément des octets
+    length = len(data) if type(data) is bytes else memoryview(data).nbytes
+    flags = 0
+    if compression is not None and length >= COMPRESSION_THRESHOLD:
+        compressed = _compress(data, compression)
+        if len(compressed) < length:
+            data, length = compressed, len(compressed)
+            flags = _COMPRESSION_FLAGS[compression]
+    if length > _LENGTH_MASK:
+        raise GLOSocketError("The message is too large to be sent")
+    data_length = _HEADER.pack(flags << _FLAGS_SHIFT | length)
+    if length < _COALESCE_LIMIT:
+        return [data_length + data]
+    return [data_length, data]
+
+
+def encode_frame_parts(parts: list[FramePart]) -> list[FramePart]:
+    """
+    Retourne les tampons à transmettre pour un message formé de tampons et
+    de parties de fichiers (FileRegion), sans compression. Utilisé avec
+    FrameWriter.append_frame. Les petits messages sont lus et regroupés
+    en un seul tampon.
+    """
+    length = sum(part.count if type(part) is FileRegion else memoryview(part).nbytes
+                 for part in parts)
+    if length > _LENGTH_MASK:
+        raise GLOSocketError("The message is too large to be sent")
+    data_length = _HEADER.pack(length)
+    if length < _COALESCE_LIMIT:
+        # Petit message: le lire et l'envoyer d'un seul tampon coûte moins
+        # que plusieurs envois (et plusieurs paquets)
+        data = bytearray(data_length)
+        for part in parts:
+            if type(part) is FileRegion:
+                data += _pread(part.file, part.count, part.offset)
+            else:
+                data += part
+        return [data]
+    if parts and type(parts[0]) is not FileRegion:
+        return [data_length + parts[0], *parts[1:]]
+    return [data_length, *parts]
+
+
+def frame_size(frame: list[FramePart]) -> int:
+    """Nombre d'octets à transmettre pour la trame, entête compris."""
+    size = 0
+    for part in frame:
+        # Les tampons des trames sont des octets: len() suffit
+        size += part.count if type(part) is FileRegion else len(part)
+    return size
+
+
+def _pread(file: _HasFileno, size: int, offset: int) -> bytes:
+    """Lit `size` octets du fichier à la position `offset`, sans la déplacer."""
+    if hasattr(os, "pread"):
+        return os.pread(file.fileno(), size, offset)
+    # Ex.: Windows, avec la position partagée du descripteur
+    with _seek_lock:
+        os.lseek(file.fileno(), offset, os.SEEK_SET)
+        return os.read(file.fileno(), size)
+
+
+def _sendfile(dest_soc: socket.socket, region: FileRegion) -> int:
+    """
+    Fonction utilitaire pour FrameWriter: transmet le début de la partie de
+    fichier et retourne le nombre d'octets transmis.
+    """
+    if hasattr(os, "sendfile"):
+        sent = os.sendfile(dest_soc.fileno(), region.file.fileno(),
+                           region.offset, region.count)
+    else:
+        # Ex.: Windows, on lit le fichier par morceaux
+        data = _pread(region.file, min(region.count, RECV_CHUNK_SIZE), region.offset)
+        sent = dest_soc.send(data) if data else 0
+    if not sent:
+        raise GLOSocketError("The file is shorter than the region to send")
+    return sent
+
+
+def _sendall_buffers(dest_soc: socket.socket, buffers: list[Buffer]) -> None:
+    """
+    Fonction utilitaire pour snd_mesg.
+
+    Envoie les tampons avec socket.sendmsg (envoi groupé, sans les
+    concaténer) en reprenant là où un envoi partiel s'est arrêté.
+    """
+    if not hasattr(dest_soc, "sendmsg"):
+        # Ex.: Windows, on se rabat sur un envoi par tampon
+        for buffer in buffers:
+            dest_soc.sendall(buffer)
+        return
+
+    views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    while views:
+        sent = dest_soc.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+def snd_mesg(dest_soc: socket.socket, message: Union[str, Buffer],
+             compression: Optional[str] = None) -> None:
     """
     Encode le message puis le transmet à la destination.
 
+    Un message déjà encodé (bytes, bytearray ou memoryview) est
+    transmis tel quel, sans copie, s'il n'est pas compressé.
+
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    buffers = encode_frame(message, compression)
     try:
-        dest_soc.sendall(data_length + data)
+        if len(buffers) == 1:
+            dest_soc.sendall(buffers[0])
+        else:
+            _sendall_buffers(dest_soc, buffers)
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
-def recv_mesg(source_soc: socket.socket) -> str:
+def recv_bytes(source_soc: socket.socket,
+               chunk_size: int = RECV_CHUNK_SIZE) -> Union[bytes, bytearray]:
     """
-    Récupère un message de la source et le décode.
+    Récupère un message de la source, le décompresse au besoin, sans
+    le décoder.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data_length = _recvall(source_soc, 4)
+    data_length = _recvall(source_soc, _HEADER.size)
     try:
-        length, = struct.unpack("!I", data_length)
+        header, = _HEADER.unpack(data_length)
     except struct.error as ex:
         raise GLOSocketError("The received data was"
                              " not the message's length") from ex
+    length = header & _LENGTH_MASK
+    if length > MAX_FRAME_SIZE:
+        raise GLOSocketError("The announced message length is too large")
+
+    message = _recvall(source_soc, length, chunk_size)
+    flags = header >> _FLAGS_SHIFT
+    if flags:
+        return _decompress(message, flags, MAX_FRAME_SIZE)
+    return message
+
+
+def recv_mesg(source_soc: socket.socket,
+              chunk_size: int = RECV_CHUNK_SIZE) -> str:
+    """
+    Récupère un message de la source et le décode.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    return recv_bytes(source_soc, chunk_size).decode('utf-8')
+
+
+class FrameDecoder:
+    """
+    Décodeur incrémental de messages pour les sockets non bloquants.
+
+    Consomme les octets disponibles, même partiels, et retourne les messages
+    complets, décompressés au besoin. Un message plus grand que
+    `max_frame_size`, avant ou après décompression, lève une exception
+    GLOSocketError avant toute allocation excessive.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE,
+                 chunk_size: int = RECV_CHUNK_SIZE) -> None:
+        self._max_frame_size = max_frame_size
+        self._chunk_size = chunk_size
+        self._reset()
+        self.eof = False
+
+    def _reset(self) -> None:
+        self._buffer = bytearray(_HEADER.size)
+        self._view = memoryview(self._buffer)
+        self._received = 0
+        self._in_body = False
+        self._flags = 0
+
+    def _advance(self, frames: list[Buffer]) -> None:
+        """Passe à l'étape suivante pour chaque entête ou message complété."""
+        while self._received == len(self._buffer):
+            if self._in_body:
+                if self._flags:
+                    frames.append(_decompress(self._buffer, self._flags,
+                                              self._max_frame_size))
+                else:
+                    frames.append(self._buffer)
+                self._reset()
+                continue
+            header, = _HEADER.unpack(self._buffer)
+            length = header & _LENGTH_MASK
+            self._flags = header >> _FLAGS_SHIFT
+            if length > self._max_frame_size:
+                raise GLOSocketError("The announced message length is too large")
+            self._buffer = bytearray(length)
+            self._view = memoryview(self._buffer)
+            self._received = 0
+            self._in_body = True
+
+    def feed(self, data: Buffer) -> list[Buffer]:
+        """Ajoute des octets reçus et retourne les messages complétés."""
+        frames: list[Buffer] = []
+        data = memoryview(data).cast("B")
+        while data:
+            count = min(len(data), len(self._buffer) - self._received)
+            self._view[self._received:self._received + count] = data[:count]
+            self._received += count
+            data = data[count:]
+            self._advance(frames)
+        return frames
+
+    def read_from(self, source_soc: socket.socket,
+                  max_bytes: int = READ_BUDGET) -> list[Buffer]:
+        """
+        Lit ce qui est disponible sur un socket non bloquant (au plus
+        `max_bytes` octets) et retourne les messages complétés.
+
+        Met l'attribut `eof` à vrai si l'autre socket a fermé la connexion.
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        frames: list[Buffer] = []
+        total = 0
+        while total < max_bytes:
+            remaining = len(self._buffer) - self._received
+            try:
+                if self._in_body and remaining >= self._chunk_size:
+                    # Gros message: réception directe dans le tampon préalloué
+                    end = self._received + self._chunk_size
+                    count = source_soc.recv_into(self._view[self._received:end])
+                    self._received += count
+                    self._advance(frames)
+                else:
+                    data = source_soc.recv(self._chunk_size)
+                    count = len(data)
+                    frames.extend(self.feed(data))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as ex:
+                raise GLOSocketError("The source socket is closed.") from ex
+            if not count:
+                self.eof = True
+                break
+            total += count
+        return frames
+
+
+class FrameWriter:
+    """
+    File d'envoi de messages pour les sockets non bloquants.
+
+    Les messages sont mis en file par `append` et transmis par `write_to`
+    au rythme où le socket les accepte. Les parties de fichiers
+    (FileRegion) sont transmises avec os.sendfile.
+    """
+
+    def __init__(self) -> None:
+        self._parts: collections.deque[Union[memoryview, FileRegion]] = collections.deque()
+
+    @property
+    def pending(self) -> bool:
+        """Vrai s'il reste des octets à transmettre."""
+        return bool(self._parts)
+
+    def append(self, message: Union[str, Buffer],
+               compression: Optional[str] = None) -> None:
+        """Met un message en file, sans copier un message déjà encodé."""
+        self.append_frame(encode_frame(message, compression))
+
+    def append_frame(self, parts: list[FramePart]) -> None:
+        """
+        Met en file les tampons d'un message préparé par encode_frame
+        ou encode_frame_parts.
+        """
+        for part in parts:
+            if type(part) is FileRegion:
+                if part.count:
+                    self._parts.append(part)
+                continue
+            view = memoryview(part).cast("B")
+            if len(view):
+                self._parts.append(view)
+
+    def write_to(self, dest_soc: socket.socket) -> bool:
+        """
+        Transmet autant d'octets que le socket en accepte sans bloquer.
+
+        Retourne vrai si la file est vide. Lève une exception
+        GLOSocketError en cas de problème de communication.
+        """
+        use_sendmsg = hasattr(dest_soc, "sendmsg")
+        while self._parts:
+            head = self._parts[0]
+            try:
+                if type(head) is FileRegion:
+                    sent = _sendfile(dest_soc, head)
+                    if sent < head.count:
+                        self._parts[0] = head._replace(offset=head.offset + sent,
+                                                       count=head.count - sent)
+                    else:
+                        self._parts.popleft()
+                    continue
+                if use_sendmsg:
+                    views = list(itertools.takewhile(
+                        lambda part: type(part) is not FileRegion,
+                        itertools.islice(self._parts, _MAX_IOVECS)))
+                    sent = dest_soc.sendmsg(views)
+                else:
+                    sent = dest_soc.send(head)
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError as ex:
+                raise GLOSocketError("Cannot send data with socket") from ex
+            while sent and sent >= len(self._parts[0]):
+                sent -= len(self._parts[0])
+                self._parts.popleft()
+            if sent:
+                self._parts[0] = self._parts[0][sent:]
+        return True
+
+
+# Codecs de sérialisation des messages, négociés avec l'entête HELLO
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+CODECS = (CODEC_BINARY, CODEC_JSON)
+
+# Premier octet d'un message binaire (un message JSON commence par "{")
+_BINARY_MAGIC = 0xB1
+
+# Noms des champs des messages et des payloads de gloutils, encodés sur
+# un seul octet. Ajouter les nouveaux champs à la fin seulement.
+_FIELD_NAMES = (
+    "header", "payload", "request_id", "error_message", "username",
+    "password", "sender", "destination", "subject", "date", "content",
+    "email_list", "choice", "count", "size", "out_of_order", "codecs",
+    "codec", "destinations", "results", "status", "choices", "emails",
+    "limit", "cursor", "fields", "number", "next_cursor", "id",
+    "compressions", "compression",
+    "body", "since", "until",
+    "enabled", "uptime", "requests", "gauges", "errors", "bytes_in",
+    "bytes_out", "latency_buckets", "latency_counts", "latency_sum", "mode",
+    "percent", "headers", "files",
+)
+_FIELD_IDS = {name: index for index, name in enumerate(_FIELD_NAMES)}
+_FIELD_ID_BYTES = [bytes([index]) for index in range(len(_FIELD_NAMES))]
+_UNKNOWN_FIELD = 0xFF
+
+_TAG_NONE = 0
+_TAG_FALSE = 1
+_TAG_TRUE = 2
+_TAG_INT8 = 3
+_TAG_INT32 = 4
+_TAG_INT64 = 5
+_TAG_FLOAT = 6
+_TAG_STR8 = 7
+_TAG_STR32 = 8
+_TAG_LIST = 9
+_TAG_DICT = 10
+_TAG_STR_LIST = 11
+# Valeur déjà sérialisée en JSON (voir encode_message_around)
+_TAG_JSON = 12
+
+_BINARY_PREFIX = struct.Struct("!BB")
+_TAG_B = struct.Struct("!BB")
+_TAG_b = struct.Struct("!Bb")
+_TAG_I = struct.Struct("!BI")
+_TAG_i = struct.Struct("!Bi")
+_TAG_q = struct.Struct("!Bq")
+_TAG_d = struct.Struct("!Bd")
+_U8 = struct.Struct("!B")
+_U32 = struct.Struct("!I")
+
+# Profondeur maximale des listes et dictionnaires imbriqués d'un message
+# binaire: les messages de gloutils en ont au plus quelques niveaux
+MAX_NESTING_DEPTH = 32
+
+
+def _encode_value(value, out: list[bytes]) -> None:
+    """Fonction utilitaire pour encode_message: encode une valeur étiquetée."""
+    value_type = type(value)
+    if value_type is str:
+        data = value.encode('utf-8')
+        if len(data) < 256:
+            out.append(_TAG_B.pack(_TAG_STR8, len(data)))
+        else:
+            out.append(_TAG_I.pack(_TAG_STR32, len(data)))
+        out.append(data)
+    elif value is None:
+        out.append(b"\x00")
+    elif value is True:
+        out.append(b"\x02")
+    elif value is False:
+        out.append(b"\x01")
+    elif isinstance(value, int):
+        if -128 <= value < 128:
+            out.append(_TAG_b.pack(_TAG_INT8, value))
+        elif -2**31 <= value < 2**31:
+            out.append(_TAG_i.pack(_TAG_INT32, value))
+        else:
+            out.append(_TAG_q.pack(_TAG_INT64, value))
+    elif isinstance(value, dict):
+        out.append(_TAG_I.pack(_TAG_DICT, len(value)))
+        for key, item in value.items():
+            field_id = _FIELD_IDS.get(key)
+            if field_id is None:
+                data = key.encode('utf-8')
+                out.append(_TAG_I.pack(_UNKNOWN_FIELD, len(data)))
+                out.append(data)
+            else:
+                out.append(_FIELD_ID_BYTES[field_id])
+            if type(item) is str:
+                data = item.encode('utf-8')
+                if len(data) < 256:
+                    out.append(_TAG_B.pack(_TAG_STR8, len(data)))
+                    out.append(data)
+                    continue
+            _encode_value(item, out)
+    elif isinstance(value, (list, tuple)):
+        if value and all(type(item) is str for item in value):
+            # Cas fréquent (ex.: email_list): longueurs (en caractères) des
+            # chaînes, puis toutes les chaînes encodées d'un seul bloc
+            lengths = array.array("I", map(len, value))
+            if sys.byteorder == "little":
+                lengths.byteswap()
+            data = "".join(value).encode('utf-8')
+            out.append(_TAG_I.pack(_TAG_STR_LIST, len(value)))
+            out.append(lengths.tobytes())
+            out.append(_U32.pack(len(data)))
+            out.append(data)
+        else:
+            out.append(_TAG_I.pack(_TAG_LIST, len(value)))
+            for item in value:
+                _encode_value(item, out)
+    elif isinstance(value, float):
+        out.append(_TAG_d.pack(_TAG_FLOAT, value))
+    else:
+        raise TypeError(f"Cannot encode {value_type.__name__} values")
+
+
+def _decode_value(data: bytes, pos: int, depth: int = 0):
+    """
+    Fonction utilitaire pour decode_message: décode la valeur étiquetée
+    à la position `pos` et retourne (valeur, position suivante). `depth`
+    est le nombre de listes et dictionnaires qui contiennent la valeur.
+    """
+    if depth > MAX_NESTING_DEPTH:
+        raise ValueError("Binary message nested too deeply")
+    tag = data[pos]
+    if tag == _TAG_STR8:
+        end = pos + 2 + data[pos + 1]
+        return data[pos + 2:end].decode('utf-8'), end
+    if tag == _TAG_STR32:
+        length, = _U32.unpack_from(data, pos + 1)
+        end = pos + 5 + length
+        if end > len(data):
+            raise ValueError("Truncated binary message")
+        return data[pos + 5:end].decode('utf-8'), end
+    if tag == _TAG_INT8:
+        return _TAG_b.unpack_from(data, pos)[1], pos + 2
+    if tag == _TAG_INT32:
+        return _TAG_i.unpack_from(data, pos)[1], pos + 5
+    if tag == _TAG_INT64:
+        return _TAG_q.unpack_from(data, pos)[1], pos + 9
+    if tag == _TAG_DICT:
+        count, = _U32.unpack_from(data, pos + 1)
+        pos += 5
+        result = {}
+        for _ in range(count):
+            field_id = data[pos]
+            if field_id == _UNKNOWN_FIELD:
+                length, = _U32.unpack_from(data, pos + 1)
+                key = data[pos + 5:pos + 5 + length].decode('utf-8')
+                pos += 5 + length
+            else:
+                key = _FIELD_NAMES[field_id]
+                pos += 1
+            # Chaînes courtes et petits entiers décodés sans appel récursif
+            tag = data[pos]
+            if tag == _TAG_STR8:
+                end = pos + 2 + data[pos + 1]
+                result[key] = data[pos + 2:end].decode('utf-8')
+                pos = end
+            elif tag == _TAG_INT8:
+                result[key] = _TAG_b.unpack_from(data, pos)[1]
+                pos += 2
+            else:
+                result[key], pos = _decode_value(data, pos, depth + 1)
+        return result, pos
+    if tag == _TAG_LIST:
+        count, = _U32.unpack_from(data, pos + 1)
+        pos += 5
+        if count > len(data) - pos:
+            raise ValueError("Truncated binary message")
+        result = []
+        append = result.append
+        for _ in range(count):
+            if data[pos] == _TAG_STR8:
+                end = pos + 2 + data[pos + 1]
+                append(data[pos + 2:end].decode('utf-8'))
+                pos = end
+            else:
+                item, pos = _decode_value(data, pos, depth + 1)
+                append(item)
+        return result, pos
+    if tag == _TAG_STR_LIST:
+        count, = _U32.unpack_from(data, pos + 1)
+        pos += 5
+        lengths = array.array("I")
+        lengths.frombytes(data[pos:pos + 4 * count])
+        if len(lengths) != count:
+            raise ValueError("Truncated binary message")
+        if sys.byteorder == "little":
+            lengths.byteswap()
+        pos += 4 * count
+        length, = _U32.unpack_from(data, pos)
+        text = data[pos + 4:pos + 4 + length].decode('utf-8')
+        offsets = [0, *itertools.accumulate(lengths)]
+        if offsets[-1] != len(text):
+            raise ValueError("Invalid binary message")
+        return [text[start:end] for start, end in zip(offsets, offsets[1:])], pos + 4 + length
+    if tag == _TAG_JSON:
+        length, = _U32.unpack_from(data, pos + 1)
+        end = pos + 5 + length
+        if end > len(data):
+            raise ValueError("Truncated binary message")
+        return json.loads(data[pos + 5:end]), end
+    if tag == _TAG_NONE:
+        return None, pos + 1
+    if tag == _TAG_TRUE:
+        return True, pos + 1
+    if tag == _TAG_FALSE:
+        return False, pos + 1
+    if tag == _TAG_FLOAT:
+        return _TAG_d.unpack_from(data, pos)[1], pos + 9
+    raise ValueError(f"Unknown binary tag {tag}")
+
+
+def encode_message(message: dict, codec: str = CODEC_JSON) -> bytes:
+    """
+    Sérialise un message (GloMessage) avec le codec choisi.
+
+    Le codec binaire écrit un octet magique, l'octet de l'entête, puis les
+    autres champs du message préfixés par leur identifiant et leur longueur.
+    """
+    if codec == CODEC_JSON:
+        return json.dumps(message).encode('utf-8')
+    if codec != CODEC_BINARY:
+        raise ValueError(f"Unknown codec {codec}")
+
+    fields = dict(message)
+    out = [_BINARY_PREFIX.pack(_BINARY_MAGIC, fields.pop("header"))]
+    _encode_value(fields, out)
+    return b"".join(out)
+
+
+def encode_message_around(message: dict, field: str, length: int,
+                          codec: str = CODEC_JSON) -> tuple[bytes, bytes]:
+    """
+    Sérialise le message, sauf la valeur du champ `field` qui est déjà
+    sérialisée en JSON (`length` octets, ex.: un courriel stocké), et
+    retourne les octets à placer avant et après cette valeur.
+
+    Permet de transmettre la valeur sans la lire en mémoire (FileRegion).
+    decode_message décode le résultat comme un message ordinaire.
+    """
+    others = {key: value for key, value in message.items() if key != field}
+    if codec == CODEC_JSON:
+        head = json.dumps(others)
+        separator = ", " if others else ""
+        prefix = head[:-1] + separator + json.dumps(field) + ": "
+        return prefix.encode('utf-8'), b"}"
+    if codec != CODEC_BINARY:
+        raise ValueError(f"Unknown codec {codec}")
+
+    out = [_BINARY_PREFIX.pack(_BINARY_MAGIC, others.pop("header"))]
+    _encode_value(others, out)
+    # Le champ est ajouté au dictionnaire après les autres
+    out[1] = _TAG_I.pack(_TAG_DICT, len(others) + 1)
+    field_id = _FIELD_IDS.get(field)
+    if field_id is None:
+        data = field.encode('utf-8')
+        out.append(_TAG_I.pack(_UNKNOWN_FIELD, len(data)))
+        out.append(data)
+    else:
+        out.append(_FIELD_ID_BYTES[field_id])
+    out.append(_TAG_I.pack(_TAG_JSON, length))
+    return b"".join(out), b""
+
+
+def decode_message(data: Buffer) -> dict:
+    """
+    Désérialise un message encodé par encode_message, peu importe le codec.
+
+    Lève une exception ValueError si le message est invalide: ce doit être
+    un dictionnaire avec un entier `header` et, s'il y en a un, un entier
+    `request_id`.
+    """
+    if not data:
+        raise ValueError("Empty message")
+    if data[0] != _BINARY_MAGIC:
+        try:
+            fields = json.loads(data)
+        except RecursionError as ex:
+            # Ex.: des milliers de "[" imbriqués
+            raise ValueError("Invalid JSON message") from ex
+        if not isinstance(fields, dict) or not _is_int(fields.get("header")):
+            raise ValueError("Invalid JSON message")
+    else:
+        data = bytes(data)
+        try:
+            fields, end = _decode_value(data, 1 + 1)
+        except (IndexError, struct.error, UnicodeDecodeError, RecursionError) as ex:
+            raise ValueError("Invalid binary message") from ex
+        if end != len(data) or not isinstance(fields, dict):
+            raise ValueError("Invalid binary message")
+        fields["header"] = data[1]
+    if "request_id" in fields and not _is_int(fields["request_id"]):
+        raise ValueError("Invalid request_id")
+    return fields
+
 
-    data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+def _is_int(value: object) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
@@ -0,0 +1,957 @@
+"""\
+Module fournissant le stockage des courriels du serveur.
+
+Les courriels de chaque utilisateur sont ajoutés à la fin de fichiers
+segments (`<numéro>.seg`) dans son dossier, dans un format compact:
+une entête (type, longueur, CRC32) suivie de l'identifiant du courriel,
+stable et unique dans la boîte, et du courriel en JSON compact.
+Une suppression ajoute une pierre tombale; la compaction réécrit les
+courriels encore présents dans un nouveau segment. Le nombre de courriels,
+leur taille et le prochain identifiant sont tenus à jour dans le fichier
+`counters` de la boîte.
+
+Plusieurs processus serveurs peuvent partager le même dossier: les
+ajouts sont sérialisés par un verrou de fichier (flock) et chaque
+processus lit les ajouts des autres avec `MailboxStore.poll`.
+
+Un ajout n'est durable qu'après un fsync de son segment. Pour ne pas
+payer un fsync par courriel, `GroupCommit` fait un seul fsync par
+segment pour tous les ajouts soumis pendant le fsync précédent.
+
+Utilisation hors ligne:
+    python glostore.py migrate   # convertit les anciens fichiers *.json
+    python glostore.py compact   # compacte toutes les boîtes
+    python glostore.py check     # vérifie les segments et les compteurs
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Ex.: Windows, où le serveur ne peut pas partager ses dossiers
+    # entre plusieurs processus
+    fcntl = None
+
+import gloutils
+
+# Taille à partir de laquelle un nouveau segment est commencé
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Une boîte est compactée en arrière-plan quand au moins cette proportion
+# de ses octets (et au moins COMPACTION_MIN_BYTES) appartient à des
+# courriels supprimés
+COMPACTION_RATIO = 0.5
+COMPACTION_MIN_BYTES = 1024 * 1024
+
+RECORD_EMAIL = 1
+RECORD_TOMBSTONE = 2
+
+# Nombre de boîtes dont les fichiers (verrou, compteurs, segments) restent
+# ouverts entre deux opérations: ceux des boîtes les moins récemment
+# utilisées sont fermés, et rouverts à leur prochaine opération
+MAX_OPEN_MAILBOXES = 128
+
+# Durabilité des courriels livrés: aucun fsync, un fsync par lot de
+# livraisons (GroupCommit) ou un fsync par courriel
+DURABILITY_NONE = "none"
+DURABILITY_BATCHED = "batched"
+DURABILITY_MESSAGE = "message"
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_MESSAGE)
+# Nombre de segments d'un même lot synchronisés en parallèle: un lot
+# touche les segments de plusieurs boîtes
+SYNC_THREADS = 8
+
+_SEGMENT_MAGIC = b"GLOSEG2\n"
+_SEGMENT_SUFFIX = ".seg"
+_LOCK_FILENAME = "store.lock"
+_COUNTERS_FILENAME = "counters"
+
+# Type, longueur et CRC32 du contenu de l'enregistrement
+_RECORD_HEADER = struct.Struct("!BII")
+# Identifiant du courriel, au début du contenu d'un enregistrement RECORD_EMAIL
+_EMAIL_ID = struct.Struct("!Q")
+# Numéro de segment et position de l'enregistrement supprimé
+_TOMBSTONE = struct.Struct("!IQ")
+# Nombre de courriels, octets des courriels, octets supprimés et prochain identifiant
+_COUNTERS = struct.Struct("!QQQQ")
+
+
+class StoreError(Exception):
+    """Une erreur de lecture ou d'écriture dans le stockage des courriels."""
+
+
+class QuotaExceededError(StoreError):
+    """L'ajout du courriel dépasserait le quota de la boîte."""
+
+
+# Sans traduction des fins de ligne (Windows)
+_O_BINARY = getattr(os, "O_BINARY", 0)
+# Sérialise les lectures et écritures positionnées sans os.pread et
+# os.pwrite, qui déplacent la position partagée du descripteur
+_seek_lock = threading.Lock()
+
+
+def _pread(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    # Ex.: Windows
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+        return
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def _fsync_directory(path: str) -> None:
+    """Force l'écriture des entrées du dossier (fichiers créés ou renommés)."""
+    if not hasattr(os, "O_DIRECTORY"):
+        # Ex.: Windows, où un dossier ne peut pas être ouvert
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Segment:
+    """
+    Fichier segment ouvert.
+
+    Le descripteur reste utilisable après la compaction du segment tant
+    qu'un emplacement y fait référence, ce qui permet de terminer les
+    lectures en cours.
+    """
+
+    def __init__(self, path: str, number: int) -> None:
+        self.path = path
+        self.number = number
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT | _O_BINARY, 0o644)
+        # Le segment vient peut-être d'être créé: son entrée dans le
+        # dossier doit aussi être écrite sur le disque
+        self._directory_synced = False
+
+    def __del__(self) -> None:
+        fd = getattr(self, "_fd", -1)
+        if fd >= 0:
+            os.close(fd)
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def size(self) -> int:
+        return os.fstat(self._fd).st_size
+
+    def writable(self, max_size: int) -> bool:
+        """
+        Vrai si on peut encore ajouter au segment: il n'a pas été retiré
+        du dossier (ex.: compaction) et fait moins de `max_size` octets.
+        """
+        stat = os.fstat(self._fd)
+        return stat.st_nlink > 0 and stat.st_size < max_size
+
+    def read(self, offset: int, size: int) -> bytes:
+        return _pread(self._fd, size, offset)
+
+    def append(self, data: bytes) -> int:
+        """Écrit à la fin du segment et retourne la position des données."""
+        offset = self.size()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        return offset
+
+    def truncate(self, size: int) -> None:
+        os.ftruncate(self._fd, size)
+
+    def sync(self) -> None:
+        """Force l'écriture du segment, et de son entrée dans le dossier au premier appel."""
+        os.fsync(self._fd)
+        if not self._directory_synced:
+            _fsync_directory(os.path.dirname(self.path))
+            self._directory_synced = True
+
+
+class RecordLocation(NamedTuple):
+    """Emplacement d'un enregistrement: segment, position et taille totale."""
+    segment: Segment
+    offset: int
+    size: int
+
+    @property
+    def body_offset(self) -> int:
+        """Position du courriel en JSON dans le segment."""
+        return self.offset + _RECORD_HEADER.size + _EMAIL_ID.size
+
+    @property
+    def body_size(self) -> int:
+        return self.size - _RECORD_HEADER.size - _EMAIL_ID.size
+
+
+class StoredEmail(NamedTuple):
+    """Courriel lu dans le stockage, avec son emplacement et son identifiant."""
+    location: RecordLocation
+    email_id: int
+    email: gloutils.EmailContentPayload
+
+
+class MailboxCounters(NamedTuple):
+    """
+    Compteurs d'une boîte: nombre de courriels, octets qu'ils occupent
+    dans les segments et octets supprimés (récupérés par la compaction).
+    """
+    count: int
+    size: int
+    dead_size: int
+    next_id: int
+
+
+class _Record(NamedTuple):
+    kind: int
+    location: RecordLocation
+    body: bytes
+
+
+class _Mailbox:
+    """État en mémoire du stockage d'un utilisateur."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.lock_fd: Optional[int] = None
+        self.counters_fd: Optional[int] = None
+        self.segments: dict[int, Segment] = {}
+        self.active: Optional[Segment] = None
+        # Fin de la partie déjà lue de chaque segment
+        self.positions: dict[int, int] = {}
+        self.dir_mtime: Optional[int] = None
+        self.loaded = False
+        # Enregistrements corrompus ignorés au milieu des segments
+        self.corrupt: list[str] = []
+
+    def close_files(self, shared: bool) -> None:
+        """
+        Ferme le verrou et les compteurs et oublie les segments (fermés
+        quand plus aucun emplacement n'y fait référence). Doit être appelée
+        avec `lock`. Avec `shared`, les positions lues sont perdues: la
+        boîte doit être relue avec `load`.
+        """
+        for fd in (self.lock_fd, self.counters_fd):
+            if fd is not None:
+                os.close(fd)
+        self.lock_fd = self.counters_fd = None
+        self.segments = {}
+        self.active = None
+        if shared:
+            self.positions = {}
+            self.loaded = False
+
+
+def _encode_record(kind: int, body: bytes) -> bytes:
+    return _RECORD_HEADER.pack(kind, len(body), zlib.crc32(body)) + body
+
+
+def _encode_email(email: gloutils.EmailContentPayload) -> bytes:
+    return json.dumps(email, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+
+class MailboxStore:
+    """
+    Stockage en ajout seul des courriels de chaque utilisateur de `data_dir`.
+
+    Avec `shared`, d'autres processus écrivent dans les mêmes dossiers et
+    `poll` relit le disque pour y trouver leurs ajouts. Si `executor` est
+    fourni, les boîtes contenant beaucoup de courriels supprimés y sont
+    compactées en arrière-plan.
+    """
+
+    def __init__(self, data_dir: str = gloutils.SERVER_DATA_DIR,
+                 segment_size: int = SEGMENT_SIZE, shared: bool = False,
+                 executor: Optional[concurrent.futures.Executor] = None,
+                 max_open_mailboxes: int = MAX_OPEN_MAILBOXES) -> None:
+        self._data_dir = data_dir
+        self._segment_size = segment_size
+        self._shared = shared
+        self._executor = executor
+        self._max_open_mailboxes = max_open_mailboxes
+        self._mailboxes: dict[str, _Mailbox] = {}
+        # Boîtes aux fichiers ouverts, de la moins à la plus récemment utilisée
+        self._open_mailboxes: dict[_Mailbox, None] = {}
+        self._mailboxes_lock = threading.Lock()
+
+    def append(self, username: str, email: gloutils.EmailContentPayload,
+               quota: Optional[int] = None) -> StoredEmail:
+        """
+        Ajoute un courriel à la fin du segment actif de l'utilisateur, avec
+        le prochain identifiant de la boîte.
+
+        Lève une exception QuotaExceededError si les courriels de la boîte
+        occuperaient alors plus de `quota` octets.
+        """
+        return self.append_many(username, [email], quota)[0]
+
+    def append_many(self, username: str, emails: list[gloutils.EmailContentPayload],
+                    quota: Optional[int] = None) -> list[StoredEmail]:
+        """
+        Ajoute les courriels dans l'ordre, comme `append`, mais avec un seul
+        verrouillage, une seule mise à jour des compteurs et une écriture
+        par segment rempli.
+
+        Aucun courriel n'est ajouté si le quota serait dépassé.
+        """
+        if not emails:
+            return []
+        bodies = [_encode_email(email) for email in emails]
+        mailbox = self._get_mailbox(username)
+        with self._locked(mailbox):
+            counters = self._read_counters(mailbox)
+            records = [_encode_record(RECORD_EMAIL, _EMAIL_ID.pack(counters.next_id + i) + body)
+                       for i, body in enumerate(bodies)]
+            size = sum(len(record) for record in records)
+            if quota is not None and counters.size + size > quota:
+                raise QuotaExceededError(f"{username} would exceed its quota")
+            # Compteurs écrits en premier: après un arrêt brutal, ils sont en
+            # avance (corrigés par load) et l'identifiant n'est pas réutilisé
+            self._write_counters(mailbox, MailboxCounters(
+                count=counters.count + len(records), size=counters.size + size,
+                dead_size=counters.dead_size, next_id=counters.next_id + len(records)))
+
+            stored: list[StoredEmail] = []
+            while len(stored) < len(records):
+                segment = self._active_segment(mailbox)
+                # Au moins un courriel, puis ceux qui tiennent dans le segment
+                first = last = len(stored)
+                room = self._segment_size - segment.size() - len(records[first])
+                last += 1
+                while last < len(records) and len(records[last]) <= room:
+                    room -= len(records[last])
+                    last += 1
+                offset = segment.append(b"".join(records[first:last]))
+                for i in range(first, last):
+                    stored.append(StoredEmail(RecordLocation(segment, offset, len(records[i])),
+                                              counters.next_id + i, emails[i]))
+                    offset += len(records[i])
+        return stored
+
+    def read(self, location: RecordLocation) -> gloutils.EmailContentPayload:
+        """Lit le courriel à l'emplacement donné."""
+        data = location.segment.read(location.offset, location.size)
+        if len(data) != location.size:
+            raise StoreError(f"Truncated record in {location.segment.path}")
+        kind, length, crc = _RECORD_HEADER.unpack_from(data)
+        body = data[_RECORD_HEADER.size:]
+        if kind != RECORD_EMAIL or length != len(body) or zlib.crc32(body) != crc:
+            raise StoreError(f"Invalid record in {location.segment.path}")
+        return json.loads(body[_EMAIL_ID.size:])
+
+    def delete(self, username: str, location: RecordLocation) -> None:
+        """
+        Supprime le courriel à l'emplacement donné en ajoutant une pierre
+        tombale, puis lance une compaction si la boîte le justifie.
+
+        Lève une exception StoreError si le segment de l'emplacement a été
+        compacté depuis: la boîte doit alors être relue avec `load`.
+        """
+        record = _encode_record(RECORD_TOMBSTONE, _TOMBSTONE.pack(
+            location.segment.number, location.offset))
+        mailbox = self._get_mailbox(username)
+        with self._locked(mailbox):
+            if not location.segment.writable(float("inf")):
+                raise StoreError(f"{location.segment.path} was compacted")
+            counters = self._read_counters(mailbox)
+            self._active_segment(mailbox).append(record)
+            counters = counters._replace(
+                count=counters.count - 1,
+                size=counters.size - location.size,
+                dead_size=counters.dead_size + location.size + len(record))
+            self._write_counters(mailbox, counters)
+            should_compact = (
+                counters.dead_size >= COMPACTION_MIN_BYTES
+                and counters.dead_size >= COMPACTION_RATIO
+                * (counters.size + counters.dead_size))
+        if should_compact and self._executor is not None:
+            self._executor.submit(self.compact, username)
+
+    def load(self, username: str) -> list[StoredEmail]:
+        """
+        Lit tous les segments de l'utilisateur et retourne ses courriels,
+        dans l'ordre d'ajout. Un enregistrement incomplet à la fin du
+        dernier segment (écriture interrompue) est retiré et les compteurs
+        sont corrigés s'ils ne correspondent pas aux segments.
+        """
+        mailbox = self._get_mailbox(username)
+        with self._locked(mailbox):
+            mailbox.dir_mtime = os.stat(mailbox.path).st_mtime_ns
+            emails, counters = self._read_segments(mailbox, repair=True)
+            # Les identifiants des courriels supprimés et compactés ne sont
+            # plus dans les segments, mais ne doivent pas être réutilisés
+            stored = self._read_counters(mailbox)
+            counters = counters._replace(next_id=max(counters.next_id, stored.next_id))
+            if stored != counters:
+                print(f"Fixing counters of {username}: {counters}", file=sys.stderr)
+                self._write_counters(mailbox, counters)
+            mailbox.loaded = True
+            return list(emails.values())
+
+    def counters(self, username: str) -> MailboxCounters:
+        """Retourne les compteurs de la boîte, sans lire ses segments."""
+        mailbox = self._get_mailbox(username)
+        with self._locked(mailbox):
+            return self._read_counters(mailbox)
+
+    def poll(self, username: str
+             ) -> Optional[tuple[list[StoredEmail], list[RecordLocation]]]:
+        """
+        Retourne les courriels ajoutés et les emplacements supprimés par
+        les autres processus depuis le dernier appel à `load` ou `poll`.
+
+        Retourne None si la boîte doit être relue avec `load` (première
+        consultation ou compaction). Sans `shared`, le disque n'est pas
+        relu: seuls les ajouts de ce processus sont possibles.
+        """
+        mailbox = self._get_mailbox(username)
+        with mailbox.lock:
+            if not mailbox.loaded:
+                return None
+            if not self._shared:
+                return [], []
+
+            # stat avant la lecture du dossier: un nouveau segment créé
+            # pendant la lecture changera la date et sera vu au prochain appel
+            mtime = os.stat(mailbox.path).st_mtime_ns
+            if mtime != mailbox.dir_mtime:
+                numbers = self._list_segments(mailbox)
+                if not set(mailbox.segments) <= set(numbers):
+                    return None # compaction par un autre processus
+                for number in numbers:
+                    if number not in mailbox.segments:
+                        mailbox.segments[number] = Segment(
+                            self._segment_path(mailbox, number), number)
+                mailbox.dir_mtime = mtime
+
+            records: list[_Record] = []
+            for number in sorted(mailbox.segments):
+                segment = mailbox.segments[number]
+                if segment.size() > mailbox.positions.get(number, len(_SEGMENT_MAGIC)):
+                    records.extend(self._scan(mailbox, segment, repair=False))
+            emails, deleted = self._apply(mailbox, records)
+        self._close_idle_mailboxes(mailbox)
+        return list(emails.values()), deleted
+
+    def compact(self, username: str) -> None:
+        """
+        Réécrit les courriels encore présents de l'utilisateur dans un
+        nouveau segment, puis retire les anciens segments.
+        """
+        mailbox = self._get_mailbox(username)
+        with self._locked(mailbox):
+            # Relecture complète, indépendante des positions déjà lues
+            scratch = _Mailbox(mailbox.path)
+            scratch.segments = dict(mailbox.segments)
+            emails, counters = self._read_segments(scratch, repair=True)
+            segments = list(scratch.segments.values())
+            if not segments:
+                return
+
+            number = max(scratch.segments) + 1
+            final_path = self._segment_path(mailbox, number)
+            temp_path = final_path + ".tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(_SEGMENT_MAGIC)
+                for stored in emails.values():
+                    file.write(stored.location.segment.read(
+                        stored.location.offset, stored.location.size))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, final_path)
+            for segment in segments:
+                os.unlink(segment.path)
+
+            new_segment = Segment(final_path, number)
+            mailbox.segments = {number: new_segment}
+            mailbox.active = new_segment
+            mailbox.positions = {number: new_segment.size()}
+            self._write_counters(mailbox, counters._replace(
+                dead_size=0,
+                next_id=max(counters.next_id, self._read_counters(mailbox).next_id)))
+            # Les emplacements en mémoire ne sont plus valides
+            mailbox.loaded = False
+
+    def check(self, username: str, repair: bool = False) -> list[str]:
+        """
+        Vérifie les segments et les compteurs de la boîte et retourne les
+        incohérences trouvées. Avec `repair`, un enregistrement incomplet à
+        la fin du dernier segment est retiré et les compteurs sont corrigés.
+        """
+        mailbox = self._get_mailbox(username)
+        problems: list[str] = []
+        with self._locked(mailbox):
+            for pattern in ("*.json", "*" + _SEGMENT_SUFFIX + ".tmp"):
+                for path in sorted(glob.glob(os.path.join(mailbox.path, pattern))):
+                    problems.append(f"{path}: fichier non converti en segment")
+            scratch = _Mailbox(mailbox.path)
+            try:
+                _, counters = self._read_segments(scratch, repair=False)
+            except StoreError as ex:
+                return problems + [str(ex)]
+            problems.extend(scratch.corrupt)
+            numbers = sorted(scratch.segments)
+            for number in numbers:
+                segment = scratch.segments[number]
+                end = scratch.positions.get(number, 0)
+                if end < segment.size():
+                    problems.append(f"{segment.path}: {segment.size() - end} octets"
+                                    f" illisibles à partir de l'octet {end}")
+                    if repair and number == numbers[-1]:
+                        segment.truncate(end)
+
+            path = os.path.join(mailbox.path, _COUNTERS_FILENAME)
+            stored = None
+            if os.path.exists(path):
+                data = _pread(self._counters_fd(mailbox), _COUNTERS.size, 0)
+                if len(data) == _COUNTERS.size:
+                    stored = MailboxCounters(*_COUNTERS.unpack(data))
+            if stored is not None:
+                counters = counters._replace(next_id=max(counters.next_id, stored.next_id))
+            if stored is None and numbers or stored not in (None, counters):
+                problems.append(f"{path}: {stored} au lieu de {counters}")
+                if repair:
+                    self._write_counters(mailbox, counters)
+        return problems
+
+    def sync(self, username: str) -> None:
+        """
+        Force l'écriture sur le disque de tous les segments de la boîte, de
+        ses compteurs et de son dossier.
+        """
+        mailbox = self._get_mailbox(username)
+        with self._locked(mailbox):
+            for number in self._list_segments(mailbox):
+                segment = (mailbox.segments.get(number)
+                           or Segment(self._segment_path(mailbox, number), number))
+                segment.sync()
+            os.fsync(self._counters_fd(mailbox))
+            _fsync_directory(mailbox.path)
+
+    def disk_usage(self, username: str) -> int:
+        """Octets occupés par les segments de l'utilisateur."""
+        mailbox = self._get_mailbox(username)
+        return sum(os.path.getsize(self._segment_path(mailbox, number))
+                   for number in self._list_segments(mailbox))
+
+    def _get_mailbox(self, username: str) -> _Mailbox:
+        mailbox = self._mailboxes.get(username)
+        if mailbox is None:
+            with self._mailboxes_lock:
+                mailbox = self._mailboxes.setdefault(
+                    username, _Mailbox(os.path.join(self._data_dir, username)))
+        return mailbox
+
+    def _read_counters(self, mailbox: _Mailbox) -> MailboxCounters:
+        """
+        Lit les compteurs de la boîte verrouillée. S'ils n'existent pas
+        encore, ils sont calculés à partir des segments.
+        """
+        data = _pread(self._counters_fd(mailbox), _COUNTERS.size, 0)
+        if len(data) == _COUNTERS.size:
+            return MailboxCounters(*_COUNTERS.unpack(data))
+        scratch = _Mailbox(mailbox.path)
+        scratch.segments = dict(mailbox.segments)
+        _, counters = self._read_segments(scratch, repair=False)
+        self._write_counters(mailbox, counters)
+        return counters
+
+    def _write_counters(self, mailbox: _Mailbox, counters: MailboxCounters) -> None:
+        _pwrite(self._counters_fd(mailbox), _COUNTERS.pack(*counters), 0)
+
+    def _counters_fd(self, mailbox: _Mailbox) -> int:
+        if mailbox.counters_fd is None:
+            mailbox.counters_fd = os.open(os.path.join(mailbox.path, _COUNTERS_FILENAME),
+                                          os.O_RDWR | os.O_CREAT | _O_BINARY, 0o644)
+        return mailbox.counters_fd
+
+    def _read_segments(self, mailbox: _Mailbox, repair: bool
+                       ) -> tuple[dict[tuple[int, int], StoredEmail], MailboxCounters]:
+        """
+        Relit tous les segments présents dans le dossier de la boîte
+        verrouillée et retourne ses courriels et les compteurs calculés.
+        """
+        numbers = self._list_segments(mailbox)
+        mailbox.segments = {number: mailbox.segments.get(number)
+                            or Segment(self._segment_path(mailbox, number), number)
+                            for number in numbers}
+        mailbox.positions = {}
+        mailbox.corrupt = []
+        records: list[_Record] = []
+        for number in numbers:
+            records.extend(self._scan(mailbox, mailbox.segments[number],
+                                      repair=repair and number == numbers[-1]))
+        emails, _ = self._apply(mailbox, records)
+        size = sum(stored.location.size for stored in emails.values())
+        last_id = max((_EMAIL_ID.unpack_from(record.body)[0] for record in records
+                       if record.kind == RECORD_EMAIL), default=-1)
+        return emails, MailboxCounters(
+            count=len(emails), size=size,
+            dead_size=sum(record.location.size for record in records) - size,
+            next_id=last_id + 1)
+
+    @contextlib.contextmanager
+    def _locked(self, mailbox: _Mailbox) -> Iterator[None]:
+        """
+        Verrouille la boîte pour les fils de ce processus, puis pour les
+        autres processus avec flock sur le fichier `store.lock`.
+        """
+        try:
+            with mailbox.lock:
+                if fcntl is None:
+                    yield
+                    return
+                if mailbox.lock_fd is None:
+                    mailbox.lock_fd = os.open(os.path.join(mailbox.path, _LOCK_FILENAME),
+                                              os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(mailbox.lock_fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(mailbox.lock_fd, fcntl.LOCK_UN)
+        finally:
+            self._close_idle_mailboxes(mailbox)
+
+    def _close_idle_mailboxes(self, mailbox: _Mailbox) -> None:
+        """
+        Note l'utilisation de la boîte, puis ferme les fichiers des boîtes
+        les moins récemment utilisées au-delà de `max_open_mailboxes`.
+        Une boîte en cours d'utilisation par un autre fil est laissée
+        ouverte.
+        """
+        with self._mailboxes_lock:
+            self._open_mailboxes.pop(mailbox, None)
+            self._open_mailboxes[mailbox] = None
+            excess = len(self._open_mailboxes) - self._max_open_mailboxes
+            if excess <= 0:
+                return
+            idle = [other for other in self._open_mailboxes if other is not mailbox][:excess]
+        for other in idle:
+            if not other.lock.acquire(blocking=False):
+                continue
+            try:
+                other.close_files(self._shared)
+                with self._mailboxes_lock:
+                    self._open_mailboxes.pop(other, None)
+            finally:
+                other.lock.release()
+
+    def _segment_path(self, mailbox: _Mailbox, number: int) -> str:
+        return os.path.join(mailbox.path, f"{number:08d}{_SEGMENT_SUFFIX}")
+
+    def _list_segments(self, mailbox: _Mailbox) -> list[int]:
+        """Numéros des segments présents dans le dossier, triés."""
+        paths = glob.glob(os.path.join(mailbox.path, "*" + _SEGMENT_SUFFIX))
+        return sorted(int(os.path.basename(path)[:-len(_SEGMENT_SUFFIX)])
+                      for path in paths)
+
+    def _active_segment(self, mailbox: _Mailbox) -> Segment:
+        """
+        Retourne le segment où ajouter, en commençant un nouveau segment si
+        l'actuel est plein. Doit être appelée avec la boîte verrouillée.
+        """
+        segment = mailbox.active
+        if segment is None or not segment.writable(self._segment_size):
+            # Un autre processus a peut-être déjà commencé un segment plus récent
+            numbers = self._list_segments(mailbox)
+            number = numbers[-1] if numbers else 1
+            segment = mailbox.segments.get(number)
+            if segment is None or not segment.writable(float("inf")):
+                segment = Segment(self._segment_path(mailbox, number), number)
+            if not segment.writable(self._segment_size):
+                number += 1
+                segment = Segment(self._segment_path(mailbox, number), number)
+            mailbox.segments[number] = segment
+            mailbox.active = segment
+        if segment.size() == 0:
+            segment.append(_SEGMENT_MAGIC)
+        return segment
+
+    def _scan(self, mailbox: _Mailbox, segment: Segment,
+              repair: bool) -> list[_Record]:
+        """
+        Lit les enregistrements complets du segment depuis la dernière
+        position lue. Avec `repair` (boîte verrouillée), un enregistrement
+        incomplet ou corrompu en fin de segment est retiré.
+
+        Un enregistrement corrompu suivi d'un enregistrement valide est
+        ignoré (et noté dans `mailbox.corrupt`) plutôt que de perdre les
+        suivants. Si la suite du segment est illisible, elle est copiée
+        dans un fichier `.corrupt` avant d'être retirée.
+        """
+        start = mailbox.positions.get(segment.number, 0)
+        data = segment.read(start, segment.size() - start)
+        pos = 0
+        if start == 0:
+            if len(data) < len(_SEGMENT_MAGIC) and _SEGMENT_MAGIC.startswith(data):
+                # Segment vide ou en cours de création
+                if repair:
+                    segment.truncate(0)
+                    segment.append(_SEGMENT_MAGIC)
+                    mailbox.positions[segment.number] = len(_SEGMENT_MAGIC)
+                return []
+            if not data.startswith(_SEGMENT_MAGIC):
+                raise StoreError(f"Not a segment file: {segment.path}")
+            pos = len(_SEGMENT_MAGIC)
+
+        records: list[_Record] = []
+        view = memoryview(data)
+        while pos + _RECORD_HEADER.size <= len(data):
+            kind, length, crc = _RECORD_HEADER.unpack_from(data, pos)
+            end = pos + _RECORD_HEADER.size + length
+            if end > len(data):
+                break
+            body = bytes(view[pos + _RECORD_HEADER.size:end])
+            if zlib.crc32(body) != crc:
+                if not _valid_record_at(data, end):
+                    break
+                # Corruption au milieu du segment: les enregistrements
+                # suivants sont intacts
+                message = (f"{segment.path}: enregistrement corrompu de {end - pos}"
+                           f" octets ignoré à l'octet {start + pos}")
+                print(message, file=sys.stderr)
+                mailbox.corrupt.append(message)
+                pos = end
+                continue
+            records.append(_Record(kind, RecordLocation(segment, start + pos, end - pos), body))
+            pos = end
+
+        if pos < len(data) and repair:
+            if _record_end(data, pos) < len(data):
+                # Plus qu'un dernier enregistrement interrompu: conservé
+                # pour une récupération manuelle
+                with open(f"{segment.path}.{start + pos}.corrupt", 'wb') as file:
+                    file.write(view[pos:])
+            print(f"Truncating {len(data) - pos} bytes of incomplete record"
+                  f" in {segment.path}", file=sys.stderr)
+            segment.truncate(start + pos)
+        mailbox.positions[segment.number] = start + pos
+        return records
+
+    def _apply(self, mailbox: _Mailbox, records: list[_Record]
+               ) -> tuple[dict[tuple[int, int], StoredEmail], list[RecordLocation]]:
+        """
+        Applique les enregistrements lus: retourne les courriels ajoutés,
+        sauf ceux visés par une pierre tombale, et les emplacements
+        supprimés qui n'étaient pas parmi les enregistrements (lus lors
+        d'un appel précédent).
+        """
+        emails: dict[tuple[int, int], StoredEmail] = {}
+        deleted: list[RecordLocation] = []
+        for record in records:
+            location = record.location
+            if record.kind == RECORD_EMAIL:
+                emails[(location.segment.number, location.offset)] = StoredEmail(
+                    location, _EMAIL_ID.unpack_from(record.body)[0],
+                    json.loads(record.body[_EMAIL_ID.size:]))
+            elif record.kind == RECORD_TOMBSTONE:
+                key = _TOMBSTONE.unpack(record.body)
+                if emails.pop(key, None) is None:
+                    segment = mailbox.segments.get(key[0])
+                    if segment is not None:
+                        size = _RECORD_HEADER.size + _RECORD_HEADER.unpack(
+                            segment.read(key[1], _RECORD_HEADER.size))[1]
+                        deleted.append(RecordLocation(segment, key[1], size))
+        return emails, deleted
+
+
+def _record_end(data: bytes, pos: int) -> int:
+    """Fin de l'enregistrement à la position `pos` selon son entête (peut-être corrompue)."""
+    if pos + _RECORD_HEADER.size > len(data):
+        return len(data)
+    _, length, _ = _RECORD_HEADER.unpack_from(data, pos)
+    return pos + _RECORD_HEADER.size + length
+
+
+def _valid_record_at(data: bytes, pos: int) -> bool:
+    """Vrai si un enregistrement complet et intact commence à la position `pos`."""
+    if pos + _RECORD_HEADER.size > len(data):
+        return False
+    kind, length, crc = _RECORD_HEADER.unpack_from(data, pos)
+    end = pos + _RECORD_HEADER.size + length
+    return (kind in (RECORD_EMAIL, RECORD_TOMBSTONE) and end <= len(data)
+            and zlib.crc32(data[pos + _RECORD_HEADER.size:end]) == crc)
+
+
+class GroupCommit:
+    """
+    Rend durables les ajouts de plusieurs fils par lots (« group commit »).
+
+    `submit` note les segments écrits et retourne une future. Un fil
+    d'arrière-plan fait un fsync par segment noté pour tout le lot en
+    attente, au plus `sync_threads` à la fois, puis termine les futures
+    du lot. Les ajouts soumis pendant ces fsync forment le lot suivant:
+    plus les fsync sont lents, plus les lots sont gros. Avec `max_delay`,
+    le fil attend jusqu'à ce délai (secondes) avant chaque lot pour en
+    grossir.
+    """
+
+    def __init__(self, max_delay: float = 0.0, sync_threads: int = SYNC_THREADS,
+                 initializer: Optional[Callable[[], None]] = None) -> None:
+        self._max_delay = max_delay
+        self._sync_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sync_threads, initializer=initializer)
+        self._ready = threading.Condition()
+        self._segments: set[Segment] = set()
+        self._futures: list[concurrent.futures.Future] = []
+        self._closed = False
+        # Lots et ajouts rendus durables, pour les métriques
+        self.batches = 0
+        self.commits = 0
+        self._writer = threading.Thread(target=self._run, args=(initializer,), daemon=True)
+        self._writer.start()
+
+    def submit(self, segments: Iterable[Segment]) -> concurrent.futures.Future:
+        """
+        Retourne une future terminée une fois les segments écrits sur le
+        disque, ou en erreur (StoreError) si leur fsync a échoué.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._ready:
+            if self._closed:
+                raise StoreError("Group commit is closed")
+            self._segments.update(segments)
+            self._futures.append(future)
+            self._ready.notify()
+        return future
+
+    def close(self) -> None:
+        """Rend durables les ajouts déjà soumis, puis arrête le fil."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._writer.join()
+        self._sync_executor.shutdown()
+
+    def _run(self, initializer: Optional[Callable[[], None]]) -> None:
+        if initializer is not None:
+            initializer()
+        while True:
+            with self._ready:
+                while not self._futures and not self._closed:
+                    self._ready.wait()
+                if not self._futures:
+                    return
+            if self._max_delay and not self._closed:
+                time.sleep(self._max_delay)
+            with self._ready:
+                segments, self._segments = self._segments, set()
+                futures, self._futures = self._futures, []
+            try:
+                if len(segments) == 1:
+                    segments.pop().sync()
+                else:
+                    # fsync libère le GIL
+                    list(self._sync_executor.map(Segment.sync, segments))
+            except OSError as ex:
+                for future in futures:
+                    future.set_exception(StoreError(f"Cannot sync segments: {ex}"))
+                continue
+            self.batches += 1
+            self.commits += len(futures)
+            for future in futures:
+                future.set_result(None)
+
+
+def migrate(data_dir: str = gloutils.SERVER_DATA_DIR) -> None:
+    """
+    Convertit les courriels de l'ancien format (un fichier JSON par
+    courriel) en segments, puis retire les fichiers JSON.
+
+    Le serveur doit être arrêté pendant la migration.
+    """
+    store = MailboxStore(data_dir)
+    for user_path in sorted(glob.glob(os.path.join(data_dir, "*"))):
+        if not os.path.isdir(user_path):
+            continue
+        username = os.path.basename(user_path)
+        json_list = sorted(glob.glob(os.path.join(user_path, "*.json")))
+        if not json_list:
+            continue
+        before = sum(os.stat(path).st_blocks * 512 for path in json_list)
+        for email_file in json_list:
+            with open(email_file, 'r') as file:
+                store.append(username, json.load(file))
+        # Tous les segments, les compteurs et le dossier sont sur le disque
+        # avant de retirer les originaux
+        store.sync(username)
+        for email_file in json_list:
+            os.remove(email_file)
+        after = sum(os.stat(path).st_blocks * 512 for path in glob.glob(
+            os.path.join(user_path, "*" + _SEGMENT_SUFFIX)))
+        print(f"{username}: {len(json_list)} courriels, {before} -> {after} octets sur disque")
+
+
+def compact_all(data_dir: str = gloutils.SERVER_DATA_DIR) -> None:
+    """Compacte la boîte de chaque utilisateur."""
+    store = MailboxStore(data_dir, shared=True)
+    for user_path in sorted(glob.glob(os.path.join(data_dir, "*"))):
+        if os.path.isdir(user_path):
+            username = os.path.basename(user_path)
+            before = store.disk_usage(username)
+            store.compact(username)
+            print(f"{username}: {before} -> {store.disk_usage(username)} octets")
+
+
+def check_all(data_dir: str = gloutils.SERVER_DATA_DIR, repair: bool = False) -> bool:
+    """
+    Vérifie la boîte de chaque utilisateur et affiche les incohérences.
+    Retourne True si aucune n'a été trouvée.
+    """
+    store = MailboxStore(data_dir, shared=True)
+    consistent = True
+    for user_path in sorted(glob.glob(os.path.join(data_dir, "*"))):
+        if os.path.isdir(user_path):
+            for problem in store.check(os.path.basename(user_path), repair):
+                print(problem)
+                consistent = False
+    return consistent
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("migrate", "compact", "check"),
+                        help="migrate: convertit les fichiers *.json en segments; "
+                             "compact: retire les courriels supprimés des segments; "
+                             "check: vérifie les segments et les compteurs.")
+    parser.add_argument("--data-dir", action="store", dest="data_dir",
+                        default=gloutils.SERVER_DATA_DIR,
+                        help="Dossier de données du serveur.")
+    parser.add_argument("--repair", action="store_true",
+                        help="Avec check, corrige les compteurs et retire les "
+                             "enregistrements incomplets en fin de segment.")
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == "migrate":
+        migrate(args.data_dir)
+    elif args.command == "compact":
+        compact_all(args.data_dir)
+    elif not check_all(args.data_dir, args.repair):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -24,6 +24,13 @@ CLIENT_USE_CHOICE = """Menu principal
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
 
+# Nombre maximal de courriels par page de la liste des courriels
+MAX_PAGE_SIZE = 1000
+# Nombre de courriels par page affichée par le client
+CLIENT_PAGE_SIZE = 20
+# Champs pouvant être demandés pour chaque courriel de la liste
+EMAIL_SUMMARY_FIELDS = frozenset({"number", "id", "sender", "subject", "date", "size"})
+
 EMAIL_DISPLAY = """De : {sender}
 À : {to}
 Sujet : {subject}
@@ -55,6 +62,30 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    HELLO = enum.auto()
+
+    INBOX_READING_BATCH_CHOICE = enum.auto()
+    EMAIL_BATCH_SENDING = enum.auto()
+
+    INBOX_READING_ID = enum.auto()
+
+    METRICS_REQUEST = enum.auto()
+    PROFILING_REQUEST = enum.auto()
+
+    SEARCH = enum.auto()
+
+    SUBSCRIBE = enum.auto()
+    NEW_EMAIL = enum.auto()
+
+
+class DeliveryStatus(enum.IntEnum):
+    """
+    Résultat de la livraison d'un courriel à un destinataire
+    """
+    DELIVERED = enum.auto()
+    LOST = enum.auto()
+    FAILED = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -76,35 +107,234 @@ class EmailContentPayload(TypedDict, total=True):
     content: str
 
 
+class EmailBatchPayload(TypedDict, total=True):
+    """Payload pour l'envoi d'un courriel à plusieurs destinataires."""
+    sender: str
+    destinations: list[str]
+    subject: str
+    date: str
+    content: str
+
+
+class DeliveryResult(TypedDict, total=True):
+    """Résultat de la livraison pour un destinataire d'un envoi groupé."""
+    destination: str
+    status: DeliveryStatus
+    error_message: str
+
+
+class BatchDeliveryPayload(TypedDict, total=True):
+    """Payload de réponse à un envoi groupé."""
+    results: list[DeliveryResult]
+
+
 class EmailListPayload(TypedDict, total=True):
     """Payload pour les consulation de courriel."""
     email_list: list[str]
 
 
+class EmailListRequestPayload(TypedDict, total=False):
+    """
+    Payload optionnel pour demander une page de la liste des courriels.
+
+    `cursor` est le curseur opaque retourné avec la page précédente,
+    `fields` les champs de EMAIL_SUMMARY_FIELDS à retourner à la place
+    des lignes SUBJECT_DISPLAY.
+    """
+    limit: int
+    cursor: str
+    fields: list[str]
+
+
+class EmailSummary(TypedDict, total=False):
+    """
+    Champs d'un courriel de la liste, selon ceux demandés.
+
+    `number` est la position du courriel dans la liste, `id` son
+    identifiant, qui ne change pas quand d'autres courriels arrivent.
+    """
+    number: int
+    id: int
+    sender: str
+    subject: str
+    date: str
+    size: int
+
+
+class SearchPayload(TypedDict, total=False):
+    """
+    Payload pour une recherche dans les courriels (SEARCH).
+
+    Tous les mots de `sender`, `subject` et `body` doivent se trouver dans
+    l'expéditeur, le sujet et le corps du courriel, sans égard aux
+    majuscules et aux accents. `since` et `until` limitent sa date
+    (incluses, au format de `get_current_utc_time`). Au moins un critère
+    est requis. `limit`, `cursor` et `fields` sont ceux de
+    EmailListRequestPayload: la réponse est une page de la liste des
+    courriels (EmailPagePayload), numérotés selon leur position dans
+    celle-ci.
+    """
+    sender: str
+    subject: str
+    body: str
+    since: str
+    until: str
+    limit: int
+    cursor: str
+    fields: list[str]
+
+
+class SubscribePayload(TypedDict, total=True):
+    """
+    Payload pour s'abonner aux nouveaux courriels (SUBSCRIBE) ou pour se
+    désabonner. L'abonnement prend fin à la déconnexion du compte ou à
+    la connexion à un autre compte.
+    """
+    enabled: bool
+
+
+class NewEmailPayload(TypedDict, total=True):
+    """
+    Payload de la notification NEW_EMAIL, envoyée par le serveur aux
+    clients abonnés sans qu'ils l'aient demandée: les courriels arrivés
+    (`id`, `sender`, `subject`, `date` et `size`).
+    """
+    emails: list[EmailSummary]
+
+
+class EmailPagePayload(TypedDict, total=False):
+    """
+    Payload pour une page de la liste des courriels.
+
+    Contient `email_list` ou, si des champs ont été demandés, `emails`.
+    `next_cursor` est absent sur la dernière page.
+    """
+    email_list: list[str]
+    emails: list[EmailSummary]
+    next_cursor: str
+
+
 class EmailChoicePayload(TypedDict, total=True):
     """Payload pour le choix du courriel à consulter."""
     choice: int
 
 
+class EmailIdPayload(TypedDict, total=True):
+    """Payload pour consulter un courriel par son identifiant."""
+    id: int
+
+
+class EmailBatchChoicePayload(TypedDict, total=True):
+    """Payload pour le choix de plusieurs courriels à consulter."""
+    choices: list[int]
+
+
+class EmailBatchContentPayload(TypedDict, total=True):
+    """Payload pour le transfert de plusieurs courriels."""
+    emails: list[EmailContentPayload]
+
+
 class StatsPayload(TypedDict, total=True):
     """Payload pour les statistiques."""
     count: int
     size: int
 
 
+class RequestMetricsPayload(TypedDict, total=True):
+    """
+    Métriques des requêtes d'un entête. `latency_counts` compte les
+    latences (secondes) inférieures ou égales à chaque borne de
+    `latency_buckets`, puis celles au-delà de la dernière.
+    """
+    requests: int
+    errors: int
+    bytes_in: int
+    bytes_out: int
+    latency_buckets: list[float]
+    latency_counts: list[int]
+    latency_sum: float
+
+
+class MetricsPayload(TypedDict, total=True):
+    """
+    Payload pour les métriques du serveur (réservées aux administrateurs):
+    celles de chaque entête reçu, par nom d'entête, et les jauges.
+    """
+    uptime: float
+    requests: dict[str, RequestMetricsPayload]
+    gauges: dict[str, float]
+
+
+class ProfilingPayload(TypedDict, total=False):
+    """
+    Payload pour démarrer ou arrêter le profilage des requêtes du serveur
+    (PROFILING_REQUEST, réservé aux administrateurs).
+
+    Avec `enabled`, le profilage démarre: `mode` ("cprofile" ou "sample"),
+    `percent` (pourcentage des requêtes profilées) et `headers` (noms des
+    entêtes visés) remplacent les options par défaut du serveur. Sinon, il
+    s'arrête et la réponse donne les fichiers écrits (`files`).
+    """
+    enabled: bool
+    mode: str
+    percent: float
+    headers: list[str]
+    files: list[str]
+
+
+class HelloPayload(TypedDict, total=False):
+    """
+    Payload pour la négociation des options de la connexion (HELLO).
+
+    Le client propose les options voulues, le serveur répond avec
+    celles qu'il a acceptées.
+
+    Le client propose ses codecs par ordre de préférence (`codecs`) et le
+    serveur répond avec celui qu'il a retenu (`codec`), utilisé par les
+    deux pairs pour les messages qui suivent la réponse. Les compressions
+    (`compressions`, `compression`) sont négociées de la même façon;
+    sans compression retenue, les messages ne sont pas compressés.
+    """
+    out_of_order: bool
+    codecs: list[str]
+    codec: str
+    compressions: list[str]
+    compression: str
+
+
 class GloMessage(TypedDict, total=False):
     """
     Classe à utiliser pour générer des messages.
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    `request_id` est optionnel: s'il est fourni dans une requête, le
+    serveur le recopie dans la réponse, ce qui permet d'envoyer plusieurs
+    requêtes sans attendre chaque réponse. Les notifications NEW_EMAIL
+    n'en ont pas: elles peuvent arriver entre deux réponses.
     """
     header: Headers
     payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+                   EmailListPayload, EmailChoicePayload, StatsPayload,
+                   HelloPayload, EmailBatchPayload, BatchDeliveryPayload,
+                   EmailBatchChoicePayload, EmailBatchContentPayload,
+                   EmailListRequestPayload, EmailPagePayload, EmailIdPayload,
+                   MetricsPayload, ProfilingPayload, SearchPayload,
+                   SubscribePayload, NewEmailPayload]
+    request_id: int
 
 
 def get_current_utc_time() -> str:
     """Récupère l'heure courante au fuseau UTC et la formatte en string."""
-    current_time = datetime.datetime.now(datetime.timezone.utc)
-    return current_time.strftime("%a, %d %b %Y %H:%M:%S %z")
+    return format_utc_time(datetime.datetime.now(datetime.timezone.utc))
+
+
+def format_utc_time(time: datetime.datetime) -> str:
+    """
+    Formatte l'heure au fuseau UTC comme `get_current_utc_time`. Une heure
+    sans fuseau est considérée comme étant déjà en UTC.
+    """
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return time.astimezone(datetime.timezone.utc).strftime("%a, %d %b %Y %H:%M:%S %z")
@@ -0,0 +1,165 @@
+"""Tests du client asynchrone avec un serveur qui tourne dans un fil d'exécution."""
+import asyncio
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import TP4_server
+import gloclient
+import gloutils
+
+PASSWORD = "MotDePasse123"  # nosec:B105
+
+
+class _ServerStopped(Exception):
+    pass
+
+
+class _StoppableSelector(selectors.DefaultSelector):
+    """Sélecteur dont le prochain réveil arrête la boucle du serveur."""
+
+    stopped = False
+
+    def select(self, timeout=None):
+        if self.stopped:
+            raise _ServerStopped
+        return super().select(timeout)
+
+
+class ClientTestCase(unittest.IsolatedAsyncioTestCase):
+    """Serveur dans un dossier temporaire, sur un port libre."""
+
+    def setUp(self) -> None:
+        self._cwd = os.getcwd()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._temp_dir.name)
+        with mock.patch.object(gloutils, "APP_PORT", 0):
+            self.server = TP4_server.Server(selector_factory=_StoppableSelector)
+        self.port = self.server._server_socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._run_server)
+        self._thread.start()
+
+    def tearDown(self) -> None:
+        self.server._selector.stopped = True
+        self.server._wake_main_loop()
+        self._thread.join()
+        self.server.cleanup()
+        os.chdir(self._cwd)
+        self._temp_dir.cleanup()
+
+    def _run_server(self) -> None:
+        try:
+            self.server.run()
+        except _ServerStopped:
+            pass
+
+    def client(self, **options) -> gloclient.GloClient:
+        return gloclient.GloClient(port=self.port, **options)
+
+    async def registered(self, username: str) -> gloclient.GloClient:
+        """Client connecté au nouveau compte `username`."""
+        client = self.client()
+        await client.connect()
+        self.addAsyncCleanup(client.close)
+        await client.register(username, PASSWORD)
+        return client
+
+
+class GloClientTest(ClientTestCase):
+
+    async def test_operations(self) -> None:
+        alice = await self.registered("alice")
+        bob = await self.registered("bob")
+        await alice.send("bob@glo2000.ca", "Sujet", "Bonjour!")
+        results = await alice.send_batch(["bob@glo2000.ca", "carol@glo2000.ca"],
+                                         "Lot", "Bonjour à tous")
+        self.assertEqual([result["status"] for result in results],
+                         [gloutils.DeliveryStatus.DELIVERED, gloutils.DeliveryStatus.LOST])
+
+        page = await bob.list(limit=1)
+        self.assertEqual(len(page.emails), 1)
+        self.assertIsNotNone(page.next_cursor)
+        emails = [email async for email in bob.iter_emails(page_size=1)]
+        self.assertEqual({email["subject"] for email in emails}, {"Sujet", "Lot"})
+        email = await bob.fetch(emails[0]["id"])
+        self.assertEqual(email["sender"], "alice@glo2000.ca")
+        self.assertEqual((await bob.stats())["count"], 2)
+        self.assertEqual([email["subject"] for email in (await bob.search(subject="lot")).emails],
+                         ["Lot"])
+
+    async def test_server_errors(self) -> None:
+        await self.registered("alice")
+        client = self.client()
+        self.addAsyncCleanup(client.close)
+        with self.assertRaises(gloclient.ServerError) as context:
+            await client.login("alice", "Mauvais123456")
+        self.assertEqual(context.exception.error_message, "Mot de passe invalide.")
+        self.assertIsNone(client.username)
+        with self.assertRaises(gloclient.ServerError):
+            await client.register("alice", PASSWORD)
+        with self.assertRaises(gloclient.GLOClientError):
+            await client.send("bob@glo2000.ca", "Sujet", "Bonjour!")
+
+    async def test_reconnect(self) -> None:
+        alice = await self.registered("alice")
+        alice._connection.writer.transport.abort()
+        await asyncio.sleep(0)
+        # Connexion rouverte et utilisateur reconnecté
+        self.assertEqual((await alice.stats())["count"], 0)
+        self.assertEqual(alice.username, "alice")
+
+    async def test_no_reconnect(self) -> None:
+        client = self.client(reconnect=False)
+        await client.connect()
+        self.addAsyncCleanup(client.close)
+        client._connection.writer.transport.abort()
+        await asyncio.sleep(0)
+        with self.assertRaises(gloclient.GLOClientError):
+            await client.stats()
+
+    async def test_timeout(self) -> None:
+        # Serveur qui accepte la connexion mais ne répond jamais
+        with socket.create_server(("127.0.0.1", 0)) as silent:
+            client = gloclient.GloClient(port=silent.getsockname()[1], timeout=0.2)
+            with self.assertRaises(gloclient.GLOClientError):
+                await client.connect()
+            await client.close()
+
+    async def test_notifications(self) -> None:
+        bob = await self.registered("bob")
+        alice = await self.registered("alice")
+        await bob.subscribe()
+        await alice.send("bob@glo2000.ca", "Premier", "Bonjour!")
+        # Les réponses de bob arrivent avant ou après la notification
+        self.assertEqual((await bob.stats())["count"], 1)
+        await alice.send("bob@glo2000.ca", "Deuxième", "Bonjour!")
+        notifications = bob.notifications()
+        emails = [await asyncio.wait_for(anext(notifications), 5) for _ in range(2)]
+        self.assertEqual([email["subject"] for email in emails], ["Premier", "Deuxième"])
+        self.assertEqual(emails[0]["sender"], "alice@glo2000.ca")
+
+        await bob.unsubscribe()
+        await alice.send("bob@glo2000.ca", "Troisième", "Bonjour!")
+        self.assertEqual((await bob.stats())["count"], 3)
+        # L'itérateur se termine avec l'abonnement
+        self.assertEqual([email async for email in bob.notifications()], [])
+        self.assertTrue(bob._notifications.empty())
+
+    async def test_pool(self) -> None:
+        await self.registered("bob")
+        await self.registered("alice")
+        async with gloclient.GloClientPool("alice", PASSWORD, size=3,
+                                           port=self.port) as pool:
+            await asyncio.gather(*(pool.send("bob@glo2000.ca", f"Sujet {i}", "Bonjour")
+                                   for i in range(20)))
+            self.assertEqual(sum(client.pending for client in pool._clients), 0)
+            self.assertTrue(all(client.username == "alice" for client in pool._clients))
+        self.assertEqual(self.server._store.counters("bob").count, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Tests des métriques du serveur et de leur export au format Prometheus."""
+import os
+import socket
+import tempfile
+import unittest
+import urllib.request
+
+import glometrics
+import gloutils
+
+
+class ServerMetricsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.metrics = glometrics.ServerMetrics({"connected_clients": ("Clients.", lambda: 3)})
+
+    def test_record(self) -> None:
+        self.metrics.record(gloutils.Headers.STATS_REQUEST, 0.0002, False, 10, 20)
+        self.metrics.record(gloutils.Headers.STATS_REQUEST, 20.0, True, 10, 30)
+        # Entêtes inconnus ou de réponse
+        self.metrics.record(999, 0.001, False, 1, 1)
+        self.metrics.record(gloutils.Headers.OK, 0.001, False, 1, 1)
+
+        payload = self.metrics.to_payload()
+        self.assertEqual(list(payload["requests"]), ["STATS_REQUEST"])
+        stats = payload["requests"]["STATS_REQUEST"]
+        self.assertEqual((stats["requests"], stats["errors"], stats["bytes_in"],
+                          stats["bytes_out"]), (2, 1, 20, 50))
+        self.assertEqual(stats["latency_counts"][1], 1)
+        # Au-delà de la dernière borne
+        self.assertEqual(stats["latency_counts"][-1], 1)
+        self.assertAlmostEqual(stats["latency_sum"], 20.0002)
+        self.assertEqual(payload["gauges"], {"connected_clients": 3})
+
+    def test_prometheus(self) -> None:
+        self.metrics.record(gloutils.Headers.AUTH_LOGIN, 0.0002, False, 10, 20)
+        self.metrics.record(gloutils.Headers.AUTH_LOGIN, 0.003, True, 10, 20)
+        lines = self.metrics.to_prometheus().splitlines()
+        self.assertIn('glo_requests_total{header="AUTH_LOGIN"} 2', lines)
+        self.assertIn('glo_request_errors_total{header="AUTH_LOGIN"} 1', lines)
+        self.assertIn('glo_sent_bytes_total{header="AUTH_LOGIN"} 40', lines)
+        # Classes cumulatives
+        self.assertIn('glo_request_duration_seconds_bucket{header="AUTH_LOGIN",le="0.00025"} 1',
+                      lines)
+        self.assertIn('glo_request_duration_seconds_bucket{header="AUTH_LOGIN",le="+Inf"} 2',
+                      lines)
+        self.assertIn('glo_request_duration_seconds_count{header="AUTH_LOGIN"} 2', lines)
+        self.assertIn("glo_connected_clients 3", lines)
+        self.assertFalse(any("STATS_REQUEST" in line for line in lines))
+
+    def test_write_file(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.prom")
+            self.metrics.write_file(path)
+            self.assertEqual(os.listdir(directory), ["metrics.prom"])
+            with open(path, 'r', encoding='utf-8') as file:
+                self.assertEqual(file.read(), self.metrics.to_prometheus())
+
+    def test_http_exporter(self) -> None:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        self.metrics.start_exporter(None, port, 10.0)
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            self.assertIn("glo_connected_clients 3", response.read().decode('utf-8'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Tests de l'index de recherche."""
+import os
+import tempfile
+import unittest
+
+import glosearch
+import gloutils
+
+
+def _email(subject: str, content: str = "Bonjour") -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca",
+        destination="bob@glo2000.ca",
+        subject=subject,
+        date="Mon, 01 Jan 2024 12:00:00 +0000",
+        content=content,
+    )
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.index = glosearch.SearchIndex()
+        self.index.add(1, _email("Rapport annuel", "Les résultats sont bons"))
+        self.index.add(2, _email("Vacances", "Résultats de la loterie"))
+
+    def test_search(self) -> None:
+        self.assertEqual(self.index.search({"content": "resultats"}), {1, 2})
+        self.assertEqual(self.index.search({"content": "résultats", "subject": "rapport"}), {1})
+
+    def test_missing_term(self) -> None:
+        self.assertEqual(self.index.search({"subject": "rapport inconnu"}), set())
+
+    def test_no_terms(self) -> None:
+        self.assertIsNone(self.index.search({"content": "!!!"}))
+
+
+
+class SaveLoadTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, glosearch.INDEX_FILENAME)
+        self.index = glosearch.SearchIndex()
+        # Identifiants dans le désordre, comme des livraisons concurrentes
+        for email_id in (3, 1, 2, 1000000):
+            self.index.add(email_id, _email(f"Sujet {email_id % 2}", "Contenu é"))
+
+    def test_round_trip(self) -> None:
+        self.index.save(self.path)
+        self.assertEqual(self.index.unsaved, 0)
+        loaded = glosearch.SearchIndex.load(self.path)
+        self.assertEqual(loaded.ids(), {1, 2, 3, 1000000})
+        for query in ({"subject": "sujet 1"}, {"subject": "0"}, {"content": "contenu e"},
+                      {"sender": "alice"}, {"subject": "inconnu"}):
+            with self.subTest(query=query):
+                self.assertEqual(loaded.search(query), self.index.search(query))
+        # L'index relu accepte de nouveaux courriels
+        loaded.add(4, _email("Sujet 0"))
+        self.assertEqual(loaded.search({"subject": "sujet 0"}), {2, 4, 1000000})
+
+    def test_empty(self) -> None:
+        glosearch.SearchIndex().save(self.path)
+        self.assertEqual(len(glosearch.SearchIndex.load(self.path)), 0)
+
+    def test_invalid_file(self) -> None:
+        self.index.save(self.path)
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        for bad in (b"", b"autre chose", data[:-1], data[:len(data) // 2], data + b"\0"):
+            with self.subTest(size=len(bad)):
+                with open(self.path, 'wb') as file:
+                    file.write(bad)
+                with self.assertRaises(ValueError):
+                    glosearch.SearchIndex.load(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,302 @@
+"""Tests des trames, des codecs et de la compression de glosocket."""
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import types
+import typing
+import unittest
+import zlib
+from unittest import mock
+
+import glosocket
+import gloutils
+
+
+def _message() -> gloutils.GloMessage:
+    return gloutils.GloMessage(
+        header=gloutils.Headers.EMAIL_SENDING,
+        payload=gloutils.EmailContentPayload(
+            sender="alice@glo2000.ca",
+            destination="bob@glo2000.ca",
+            subject="Sujet é",
+            date="Mon, 01 Jan 2024 12:00:00 +0000",
+            content="Bonjour " * 500,
+        ),
+        request_id=7,
+    )
+
+
+def _frame_bytes(message, compression=None) -> bytes:
+    return b"".join(bytes(part) for part in glosocket.encode_frame(message, compression))
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self) -> None:
+        for codec in glosocket.CODECS:
+            with self.subTest(codec=codec):
+                data = glosocket.encode_message(_message(), codec)
+                self.assertEqual(glosocket.decode_message(data), _message())
+
+    def test_round_trip_unknown_field(self) -> None:
+        message = gloutils.GloMessage(header=gloutils.Headers.OK,
+                                      payload={"inconnu": [1, "deux", None]})
+        for codec in glosocket.CODECS:
+            with self.subTest(codec=codec):
+                data = glosocket.encode_message(message, codec)
+                self.assertEqual(glosocket.decode_message(data), message)
+
+    def test_hello_fields_have_ids(self) -> None:
+        message = gloutils.GloMessage(
+            header=gloutils.Headers.HELLO,
+            payload=gloutils.HelloPayload(compressions=[glosocket.COMPRESSION_ZLIB],
+                                 compression=glosocket.COMPRESSION_ZLIB))
+        data = glosocket.encode_message(message, glosocket.CODEC_BINARY)
+        self.assertNotIn(b"compression", data)
+        self.assertEqual(glosocket.decode_message(data), message)
+
+    def test_search_fields_have_ids(self) -> None:
+        message = gloutils.GloMessage(
+            header=gloutils.Headers.SEARCH,
+            payload=gloutils.SearchPayload(body="bonjour",
+                                           since="Mon, 01 Jan 2024 00:00:00 +0000",
+                                           until="Tue, 02 Jan 2024 00:00:00 +0000"))
+        data = glosocket.encode_message(message, glosocket.CODEC_BINARY)
+        for field in (b"body", b"since", b"until"):
+            self.assertNotIn(field, data)
+        self.assertEqual(glosocket.decode_message(data), message)
+
+    def test_subscribe_field_has_id(self) -> None:
+        message = gloutils.GloMessage(header=gloutils.Headers.SUBSCRIBE,
+                                      payload=gloutils.SubscribePayload(enabled=True))
+        data = glosocket.encode_message(message, glosocket.CODEC_BINARY)
+        self.assertNotIn(b"enabled", data)
+        self.assertEqual(glosocket.decode_message(data), message)
+
+    def test_every_payload_field_has_id(self) -> None:
+        for name, value in vars(gloutils).items():
+            if not typing.is_typeddict(value):
+                continue
+            for field in value.__annotations__:
+                with self.subTest(payload=name, field=field):
+                    self.assertIn(field, glosocket._FIELD_NAMES)
+
+    def test_encode_message_around(self) -> None:
+        email = json.dumps(_message()["payload"]).encode('utf-8')
+        for codec in glosocket.CODECS:
+            with self.subTest(codec=codec):
+                prefix, suffix = glosocket.encode_message_around(
+                    gloutils.GloMessage(header=gloutils.Headers.OK, request_id=3),
+                    "payload", len(email), codec)
+                self.assertEqual(glosocket.decode_message(prefix + email + suffix),
+                                 {"header": gloutils.Headers.OK, "request_id": 3,
+                                  "payload": _message()["payload"]})
+
+    def test_malformed_json(self) -> None:
+        for data in (b"", b"{", b"[1]", b"5", b"null", b'"x"', b'{"x": 1}',
+                     b'{"header": "1"}', b'{"header": true}',
+                     b'{"header": 1, "request_id": "a"}', b"\xff\xfe"):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    glosocket.decode_message(data)
+
+    def test_malformed_binary(self) -> None:
+        data = glosocket.encode_message(_message(), glosocket.CODEC_BINARY)
+        for bad in (data[:2], data[:-1], data + b"\0", data[:1]):
+            with self.subTest(data=bad[:8]):
+                with self.assertRaises(ValueError):
+                    glosocket.decode_message(bad)
+
+    def test_deep_nesting(self) -> None:
+        # Une liste d'un élément par niveau
+        binary = (bytes([glosocket._BINARY_MAGIC, 1]) + b"\x0a\x00\x00\x00\x01\x01"
+                  + b"\x09\x00\x00\x00\x01" * 5000 + b"\x00")
+        for data in (binary, b"[" * 100000, b'{"header": 1, "payload": ' + b"[" * 100000,
+                     b'{"header": 1, "payload": ' + b"[" * 5000 + b"]" * 5000 + b"}"):
+            with self.subTest(data=data[:8]):
+                with self.assertRaises(ValueError):
+                    glosocket.decode_message(data)
+
+    def test_nesting_within_limit(self) -> None:
+        payload = {"x": 1}
+        for _ in range(glosocket.MAX_NESTING_DEPTH - 1):
+            payload = [payload]
+        message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=payload)
+        for codec in glosocket.CODECS:
+            with self.subTest(codec=codec):
+                data = glosocket.encode_message(message, codec)
+                self.assertEqual(glosocket.decode_message(data), message)
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_byte_by_byte(self) -> None:
+        data = _frame_bytes("premier") + _frame_bytes("deuxième")
+        decoder = glosocket.FrameDecoder()
+        frames = []
+        for i in range(len(data)):
+            frames.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual([bytes(frame).decode('utf-8') for frame in frames],
+                         ["premier", "deuxième"])
+
+    def test_several_frames_in_one_chunk(self) -> None:
+        data = b"".join(_frame_bytes(str(i)) for i in range(10))
+        frames = glosocket.FrameDecoder().feed(data)
+        self.assertEqual([bytes(frame) for frame in frames],
+                         [str(i).encode() for i in range(10)])
+
+    def test_empty_message(self) -> None:
+        self.assertEqual(glosocket.FrameDecoder().feed(_frame_bytes("")), [b""])
+
+    def test_too_large(self) -> None:
+        decoder = glosocket.FrameDecoder(max_frame_size=100)
+        with self.assertRaises(glosocket.GLOSocketError):
+            decoder.feed(struct.pack("!I", 101))
+
+    def test_compressed(self) -> None:
+        for compression in glosocket.COMPRESSIONS:
+            with self.subTest(compression=compression):
+                message = "x" * 100000
+                data = _frame_bytes(message, compression)
+                self.assertLess(len(data), len(message))
+                frames = glosocket.FrameDecoder().feed(data)
+                self.assertEqual(bytes(frames[0]).decode('utf-8'), message)
+
+    def test_small_message_not_compressed(self) -> None:
+        data = _frame_bytes("court", glosocket.COMPRESSION_ZLIB)
+        self.assertEqual(data, _frame_bytes("court"))
+
+    def test_decompression_bomb(self) -> None:
+        # 10 Mio de zéros compressés en quelques Kio
+        body = zlib.compress(b"\0" * (10 * 1024 * 1024))
+        data = struct.pack("!I", 1 << 30 | len(body)) + body
+        decoder = glosocket.FrameDecoder(max_frame_size=1024 * 1024)
+        with self.assertRaises(glosocket.GLOSocketError):
+            decoder.feed(data)
+
+    def test_invalid_compressed_data(self) -> None:
+        data = struct.pack("!I", 1 << 30 | 4) + b"abcd"
+        with self.assertRaises(glosocket.GLOSocketError):
+            glosocket.FrameDecoder().feed(data)
+
+    def test_unknown_compression(self) -> None:
+        data = struct.pack("!I", 3 << 30 | 4) + b"abcd"
+        with self.assertRaises(glosocket.GLOSocketError):
+            glosocket.FrameDecoder().feed(data)
+
+
+class BlockingSocketTest(unittest.TestCase):
+    """snd_mesg et recv_mesg sur des sockets bloquants."""
+
+    def setUp(self) -> None:
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self) -> None:
+        self.left.close()
+        self.right.close()
+
+    def test_round_trip(self) -> None:
+        for message in ["", "petit é", "c" * 200000]:
+            with self.subTest(size=len(message)):
+                thread = threading.Thread(target=glosocket.snd_mesg,
+                                          args=(self.left, message))
+                thread.start()
+                self.assertEqual(glosocket.recv_mesg(self.right, chunk_size=4096), message)
+                thread.join()
+
+    def test_small_message_in_pieces(self) -> None:
+        frame = _frame_bytes("petit message")
+
+        def send() -> None:
+            for index in range(len(frame)):
+                self.left.sendall(frame[index:index + 1])
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.assertEqual(glosocket.recv_mesg(self.right), "petit message")
+        thread.join()
+
+    def test_closed(self) -> None:
+        self.left.sendall(_frame_bytes("petit message")[:6])
+        self.left.close()
+        with self.assertRaises(glosocket.GLOSocketError):
+            glosocket.recv_mesg(self.right)
+
+
+class SocketTest(unittest.TestCase):
+    """FrameDecoder.read_from et FrameWriter.write_to sur des sockets non bloquants."""
+
+    def setUp(self) -> None:
+        self.left, self.right = socket.socketpair()
+        self.left.setblocking(False)
+        self.right.setblocking(False)
+
+    def tearDown(self) -> None:
+        self.left.close()
+        self.right.close()
+
+    def test_partial_writes_and_reads(self) -> None:
+        writer = glosocket.FrameWriter()
+        messages = ["a" * 3000000, "petit", "b" * 100000]
+        for message in messages:
+            writer.append(message)
+        decoder = glosocket.FrameDecoder(chunk_size=4096)
+        frames = []
+        # Le tampon du socket est plus petit que les messages: les envois
+        # et les réceptions sont partiels
+        while writer.pending or len(frames) < len(messages):
+            writer.write_to(self.left)
+            frames.extend(decoder.read_from(self.right))
+        self.assertEqual([bytes(frame).decode('utf-8') for frame in frames], messages)
+        self.assertFalse(decoder.eof)
+
+    def test_file_region(self) -> None:
+        with tempfile.TemporaryFile() as file:
+            file.write(b"0123456789" * 10000)
+            file.flush()
+            writer = glosocket.FrameWriter()
+            writer.append_frame(glosocket.encode_frame_parts([
+                b"<", glosocket.FileRegion(file, 5, 50000), b">"]))
+            decoder = glosocket.FrameDecoder()
+            frames = []
+            while writer.pending or not frames:
+                writer.write_to(self.left)
+                frames.extend(decoder.read_from(self.right))
+        expected = b"<" + (b"0123456789" * 10000)[5:50005] + b">"
+        self.assertEqual(bytes(frames[0]), expected)
+
+    def test_file_region_without_sendfile(self) -> None:
+        # Ex.: Windows, sans os.sendfile ni os.pread
+        without_sendfile = types.SimpleNamespace(**{
+            name: getattr(os, name) for name in dir(os) if name not in ("sendfile", "pread")})
+        with tempfile.TemporaryFile() as file, \
+                mock.patch.object(glosocket, "os", without_sendfile):
+            file.write(b"0123456789" * 10000)
+            file.flush()
+            writer = glosocket.FrameWriter()
+            for count in (10, 50000):
+                writer.append_frame(glosocket.encode_frame_parts([
+                    b"<", glosocket.FileRegion(file, 5, count), b">"]))
+            decoder = glosocket.FrameDecoder()
+            frames = []
+            while writer.pending or len(frames) < 2:
+                writer.write_to(self.left)
+                frames.extend(decoder.read_from(self.right))
+        self.assertEqual([bytes(frame) for frame in frames],
+                         [b"<" + (b"0123456789" * 10000)[5:5 + count] + b">"
+                          for count in (10, 50000)])
+
+    def test_eof(self) -> None:
+        self.left.close()
+        decoder = glosocket.FrameDecoder()
+        self.assertEqual(decoder.read_from(self.right), [])
+        self.assertTrue(decoder.eof)
+
+
+if __name__ == "__main__":
+    unittest.main()
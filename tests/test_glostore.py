@@ -0,0 +1,315 @@
+"""Tests du stockage des courriels en segments."""
+import contextlib
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+import glostore
+import gloutils
+
+
+def _email(subject: str) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca",
+        destination="bob@glo2000.ca",
+        subject=subject,
+        date="Mon, 01 Jan 2024 12:00:00 +0000",
+        content="Bonjour " * 50,
+    )
+
+
+class StoreTestCase(unittest.TestCase):
+    """Stockage dans un dossier temporaire, avec la boîte de bob."""
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._temp_dir.cleanup)
+        self.data_dir = self._temp_dir.name
+        self.user_path = os.path.join(self.data_dir, "bob")
+        os.makedirs(self.user_path)
+
+
+    def segments(self) -> list[str]:
+        return sorted(os.path.join(self.user_path, name) for name in os.listdir(self.user_path)
+                      if name.endswith(glostore._SEGMENT_SUFFIX))
+
+
+class MailboxStoreTest(StoreTestCase):
+
+    def test_append_and_load(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        appended = [store.append("bob", _email(str(i))) for i in range(3)]
+        self.assertEqual([stored.email_id for stored in appended], [0, 1, 2])
+        self.assertEqual(store.read(appended[1].location), _email("1"))
+        # Relu par un autre processus
+        loaded = glostore.MailboxStore(self.data_dir).load("bob")
+        self.assertEqual([(stored.email_id, stored.email) for stored in loaded],
+                         [(stored.email_id, stored.email) for stored in appended])
+        self.assertEqual(store.counters("bob").count, 3)
+        self.assertEqual(store.check("bob"), [])
+
+    def test_segments(self) -> None:
+        store = glostore.MailboxStore(self.data_dir, segment_size=1024)
+        for i in range(10):
+            store.append("bob", _email(str(i)))
+        self.assertGreater(len(self.segments()), 1)
+        loaded = glostore.MailboxStore(self.data_dir).load("bob")
+        self.assertEqual([stored.email["subject"] for stored in loaded],
+                         [str(i) for i in range(10)])
+
+    def test_delete_and_compact(self) -> None:
+        store = glostore.MailboxStore(self.data_dir, segment_size=1024)
+        appended = [store.append("bob", _email(str(i))) for i in range(6)]
+        store.delete("bob", appended[2].location)
+        self.assertGreater(store.counters("bob").dead_size, 0)
+        store.compact("bob")
+        self.assertEqual(len(self.segments()), 1)
+        counters = store.counters("bob")
+        self.assertEqual((counters.count, counters.dead_size), (5, 0))
+        self.assertEqual([stored.email_id for stored in store.load("bob")], [0, 1, 3, 4, 5])
+        # Les identifiants ne sont pas réutilisés après la compaction
+        self.assertEqual(store.append("bob", _email("6")).email_id, 6)
+        self.assertEqual(store.check("bob"), [])
+
+    def test_truncated_segment(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        for i in range(2):
+            store.append("bob", _email(str(i)))
+        # Écriture du dernier courriel interrompue par un arrêt brutal
+        path = self.segments()[-1]
+        os.truncate(path, os.path.getsize(path) - 5)
+
+        problems = glostore.MailboxStore(self.data_dir).check("bob")
+        self.assertEqual(len(problems), 2)
+        with contextlib.redirect_stderr(io.StringIO()):
+            loaded = glostore.MailboxStore(self.data_dir).load("bob")
+        self.assertEqual([stored.email["subject"] for stored in loaded], ["0"])
+        store = glostore.MailboxStore(self.data_dir)
+        self.assertEqual(store.check("bob"), [])
+        self.assertEqual(store.counters("bob").count, 1)
+        # Le prochain ajout suit le dernier courriel complet
+        store.append("bob", _email("2"))
+        loaded = glostore.MailboxStore(self.data_dir).load("bob")
+        self.assertEqual([stored.email["subject"] for stored in loaded], ["0", "2"])
+
+    def test_check_repair(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        store.append("bob", _email("0"))
+        with open(self.segments()[-1], 'ab') as file:
+            file.write(b"\x01\x00")
+        with open(os.path.join(self.user_path, glostore._COUNTERS_FILENAME), 'r+b') as file:
+            file.write(glostore._COUNTERS.pack(5, 0, 0, 5))
+
+        store = glostore.MailboxStore(self.data_dir)
+        self.assertEqual(len(store.check("bob", repair=True)), 2)
+        self.assertEqual(store.check("bob"), [])
+        self.assertEqual(store.counters("bob").count, 1)
+
+    def test_check_all(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        store.append("bob", _email("0"))
+        with open(os.path.join(self.user_path, glostore._COUNTERS_FILENAME), 'r+b') as file:
+            file.write(glostore._COUNTERS.pack(5, 0, 0, 5))
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertFalse(glostore.check_all(self.data_dir))
+            self.assertFalse(glostore.check_all(self.data_dir, repair=True))
+        self.assertIn("bob", output.getvalue())
+        self.assertTrue(glostore.check_all(self.data_dir))
+        self.assertEqual(glostore.MailboxStore(self.data_dir).counters("bob").count, 1)
+
+    def test_corrupted_record(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        stored = store.append("bob", _email("0"))
+        with open(self.segments()[-1], 'r+b') as file:
+            file.seek(stored.location.body_offset)
+            file.write(b"X")
+        with self.assertRaises(glostore.StoreError):
+            store.read(stored.location)
+
+
+    def test_corrupted_record_in_the_middle(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        appended = [store.append("bob", _email(str(i))) for i in range(3)]
+        with open(self.segments()[-1], 'r+b') as file:
+            file.seek(appended[1].location.body_offset)
+            file.write(b"X")
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            store = glostore.MailboxStore(self.data_dir)
+            self.assertEqual(len(store.check("bob")), 2)
+            # Les courriels qui suivent l'enregistrement corrompu sont conservés
+            self.assertEqual([stored.email_id for stored in store.load("bob")], [0, 2])
+            self.assertEqual([stored.email_id for stored in
+                              glostore.MailboxStore(self.data_dir).load("bob")], [0, 2])
+            self.assertEqual(len(store.check("bob")), 1)
+            store.compact("bob")
+        self.assertEqual(store.check("bob"), [])
+        self.assertEqual(store.append("bob", _email("3")).email_id, 3)
+
+    def test_unreadable_rest_quarantined(self) -> None:
+        store = glostore.MailboxStore(self.data_dir)
+        appended = [store.append("bob", _email(str(i))) for i in range(3)]
+        # Longueur corrompue: les enregistrements suivants sont introuvables
+        with open(self.segments()[-1], 'r+b') as file:
+            file.seek(appended[1].location.offset + 1)
+            file.write(struct.pack("!I", 3))
+        size = os.path.getsize(self.segments()[-1])
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            loaded = glostore.MailboxStore(self.data_dir).load("bob")
+        self.assertEqual([stored.email_id for stored in loaded], [0])
+        quarantine = f"{self.segments()[-1]}.{appended[1].location.offset}.corrupt"
+        self.assertEqual(os.path.getsize(quarantine), size - appended[1].location.offset)
+
+    def test_without_pread(self) -> None:
+        # Ex.: Windows, sans os.pread ni os.pwrite
+        without_pread = types.SimpleNamespace(**{
+            name: getattr(os, name) for name in dir(os) if name not in ("pread", "pwrite")})
+        with mock.patch.object(glostore, "os", without_pread):
+            store = glostore.MailboxStore(self.data_dir)
+            appended = [store.append("bob", _email(str(i))) for i in range(3)]
+            self.assertEqual(store.read(appended[1].location), _email("1"))
+            self.assertEqual(len(store.load("bob")), 3)
+            self.assertEqual(store.counters("bob").count, 3)
+            self.assertEqual(store.check("bob"), [])
+
+
+class OpenFilesTest(StoreTestCase):
+
+    def open_files(self) -> int:
+        return len(os.listdir("/proc/self/fd"))
+
+    def test_idle_mailboxes_closed(self) -> None:
+        store = glostore.MailboxStore(self.data_dir, max_open_mailboxes=4)
+        users = [f"user{i}" for i in range(100)]
+        for username in users:
+            os.makedirs(os.path.join(self.data_dir, username))
+        before = self.open_files()
+        for username in users:
+            store.append(username, _email(username))
+        # Verrou, compteurs et segment actif des 4 dernières boîtes
+        self.assertLessEqual(self.open_files() - before, 4 * 3)
+        # Les boîtes fermées sont rouvertes à leur prochaine opération
+        for username in users[:10]:
+            self.assertEqual(store.append(username, _email("deuxième")).email_id, 1)
+            self.assertEqual([stored.email["subject"] for stored in store.load(username)],
+                             [username, "deuxième"])
+            self.assertEqual(store.check(username), [])
+        self.assertLessEqual(self.open_files() - before, 4 * 3)
+
+    def test_shared_mailbox_reloaded(self) -> None:
+        store = glostore.MailboxStore(self.data_dir, shared=True, max_open_mailboxes=1)
+        os.makedirs(os.path.join(self.data_dir, "alice"))
+        store.append("bob", _email("0"))
+        store.load("bob")
+        self.assertEqual(store.poll("bob"), ([], []))
+        store.append("alice", _email("1"))
+        # Positions de bob oubliées: il doit être relu
+        self.assertIsNone(store.poll("bob"))
+        self.assertEqual(len(store.load("bob")), 1)
+
+
+class GroupCommitTest(StoreTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        os.makedirs(os.path.join(self.data_dir, "alice"))
+        store = glostore.MailboxStore(self.data_dir)
+        self.bob = store.append("bob", _email("bob")).location.segment
+        self.alice = store.append("alice", _email("alice")).location.segment
+        self.group_commit = glostore.GroupCommit()
+        self.addCleanup(self.group_commit.close)
+
+    def test_submits_batched_while_syncing(self) -> None:
+        syncing = threading.Event()
+        release = threading.Event()
+        synced = []
+
+        def sync(segment: glostore.Segment) -> None:
+            syncing.set()
+            release.wait(5)
+            synced.append(segment)
+
+        with mock.patch.object(glostore.Segment, "sync", autospec=True, side_effect=sync):
+            first = self.group_commit.submit([self.bob])
+            self.assertTrue(syncing.wait(5))
+            # Soumis pendant le fsync du premier lot: un seul lot suivant
+            others = [self.group_commit.submit([self.bob]),
+                      self.group_commit.submit([self.alice]),
+                      self.group_commit.submit([self.bob, self.alice])]
+            self.assertFalse(any(future.done() for future in [first] + others))
+            release.set()
+            for future in [first] + others:
+                self.assertIsNone(future.result(5))
+        self.assertEqual((self.group_commit.batches, self.group_commit.commits), (2, 4))
+        self.assertEqual(synced[0], self.bob)
+        self.assertCountEqual(synced[1:], [self.bob, self.alice])
+
+    def test_failed_sync(self) -> None:
+        with mock.patch.object(glostore.Segment, "sync", side_effect=OSError("disque")):
+            future = self.group_commit.submit([self.bob])
+            self.assertIsInstance(future.exception(5), glostore.StoreError)
+        self.assertEqual(self.group_commit.commits, 0)
+
+    def test_close(self) -> None:
+        with mock.patch.object(glostore.Segment, "sync") as sync:
+            future = self.group_commit.submit([self.bob])
+            self.group_commit.close()
+        self.assertTrue(future.done())
+        sync.assert_called_once()
+        with self.assertRaises(glostore.StoreError):
+            self.group_commit.submit([self.bob])
+
+
+class MigrateTest(StoreTestCase):
+
+    def test_migrate(self) -> None:
+        for i in range(3):
+            with open(os.path.join(self.user_path, f"{i}.json"), 'w') as file:
+                json.dump(_email(str(i)), file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            glostore.migrate(self.data_dir)
+        self.assertEqual([name for name in os.listdir(self.user_path)
+                          if name.endswith(".json")], [])
+        store = glostore.MailboxStore(self.data_dir)
+        self.assertEqual(sorted(stored.email["subject"] for stored in store.load("bob")),
+                         ["0", "1", "2"])
+
+    def test_sync_before_remove(self) -> None:
+        for i in range(20):
+            with open(os.path.join(self.user_path, f"{i:02}.json"), 'w') as file:
+                json.dump(_email(str(i)), file)
+        synced = []
+        fsync = os.fsync
+
+        def record(fd: int) -> None:
+            path = os.path.realpath(f"/proc/self/fd/{fd}")
+            # Rien n'est retiré avant que tout soit sur le disque
+            self.assertEqual(len([name for name in os.listdir(self.user_path)
+                                  if name.endswith(".json")]), 20)
+            synced.append(path)
+            fsync(fd)
+
+        # Petits segments: la migration en remplit plusieurs
+        with mock.patch.object(glostore.MailboxStore.__init__, "__defaults__",
+                               (self.data_dir, 2048, False, None,
+                                glostore.MAX_OPEN_MAILBOXES)), \
+                mock.patch.object(glostore.os, "fsync", record), \
+                contextlib.redirect_stdout(io.StringIO()):
+            glostore.migrate(self.data_dir)
+        user_path = os.path.realpath(self.user_path)
+        segments = [os.path.realpath(path) for path in self.segments()]
+        self.assertGreater(len(segments), 1)
+        for path in segments + [os.path.join(user_path, glostore._COUNTERS_FILENAME),
+                                user_path]:
+            self.assertIn(path, synced)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+"""Tests de l'importation des fichiers mbox et des dossiers Maildir."""
+import contextlib
+import datetime
+import io
+import os
+import tempfile
+import unittest
+
+import TP4_import
+import glosearch
+import glostore
+import gloutils
+
+_SERVER_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
+
+
+def _raw_email(date: str) -> bytes:
+    return (f"From: Alice <alice@example.com>\nSubject: Bonjour\nDate: {date}\n\n"
+            "Contenu\n").encode()
+
+
+class NormalizeDateTest(unittest.TestCase):
+
+    def date(self, value: str) -> str:
+        return TP4_import.to_payload(_raw_email(value), "bob")["date"]
+
+    def test_converted_to_utc(self) -> None:
+        self.assertEqual(self.date("Tue, 02 Jan 2024 01:30:00 +0200"),
+                         "Mon, 01 Jan 2024 23:30:00 +0000")
+
+    def test_out_of_range_years(self) -> None:
+        # Années que le serveur ne sait pas lire, ou hors de datetime en UTC
+        for value in ("Tue, 01 Jan 999 00:00:00 +0000", "Fri, 31 Dec 9999 23:00:00 -0500",
+                      "Mon, 01 Jan 1000 00:30:00 +0100", "pas une date", ""):
+            with self.subTest(value=value):
+                before = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+                date = datetime.datetime.strptime(self.date(value), _SERVER_DATE_FORMAT)
+                self.assertGreaterEqual(date, before)
+
+    def test_readable_by_server(self) -> None:
+        for value in ("Wed, 01 Jan 1000 12:00:00 +0000", "Fri, 31 Dec 9999 23:00:00 +0100",
+                      "01 Jan 2024 12:00:00 -0000"):
+            with self.subTest(value=value):
+                datetime.datetime.strptime(self.date(value), _SERVER_DATE_FORMAT)
+
+
+_MBOX = b"""\
+From alice@example.com Mon Jan  1 12:00:00 2024
+From: Alice <alice@example.com>
+Subject: =?utf-8?q?Premi=C3=A8re?=
+Date: Mon, 01 Jan 2024 12:00:00 +0000
+
+>From le corps
+Fin
+
+From alice@example.com Tue Jan  2 12:00:00 2024
+From: alice@example.com
+Subject: Deuxieme
+Date: Tue, 02 Jan 2024 12:00:00 +0000
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="x"
+
+--x
+Content-Type: text/html; charset=utf-8
+
+<p>HTML</p>
+--x
+Content-Type: text/plain; charset=utf-8
+
+Texte
+--x--
+"""
+
+
+class ReadTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._temp_dir.cleanup)
+        self.path = self._temp_dir.name
+
+    def test_mbox(self) -> None:
+        path = os.path.join(self.path, "alice.mbox")
+        with open(path, 'wb') as file:
+            file.write(_MBOX)
+        payloads = [TP4_import.to_payload(data, "bob") for data in TP4_import.read_mbox(path)]
+        self.assertEqual([payload["subject"] for payload in payloads], ["Première", "Deuxieme"])
+        self.assertEqual([payload["sender"] for payload in payloads],
+                         ["alice@example.com"] * 2)
+        self.assertEqual(payloads[0]["content"], "From le corps\nFin\n")
+        # La partie text/plain est préférée à text/html
+        self.assertEqual(payloads[1]["content"], "Texte")
+        self.assertEqual(payloads[1]["destination"], "bob@glo2000.ca")
+
+    def test_maildir(self) -> None:
+        maildir = os.path.join(self.path, "bob")
+        for subdir, name, date in (("new", "2", "Tue, 02 Jan 2024 12:00:00 +0000"),
+                                   ("cur", "1", "Mon, 01 Jan 2024 12:00:00 +0000"),
+                                   ("cur", ".cache", "pas un courriel")):
+            os.makedirs(os.path.join(maildir, subdir), exist_ok=True)
+            with open(os.path.join(maildir, subdir, name), 'wb') as file:
+                file.write(_raw_email(date))
+        self.assertTrue(TP4_import.is_maildir(maildir))
+        dates = [TP4_import.to_payload(data, "bob")["date"]
+                 for data in TP4_import.read_maildir(maildir)]
+        self.assertEqual(dates, ["Mon, 01 Jan 2024 12:00:00 +0000",
+                                 "Tue, 02 Jan 2024 12:00:00 +0000"])
+
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._temp_dir.cleanup)
+        self.data_dir = os.path.join(self._temp_dir.name, "data")
+        self.sources_dir = os.path.join(self._temp_dir.name, "sources")
+        os.makedirs(self.sources_dir)
+        for username in ("alice", "bob"):
+            os.makedirs(os.path.join(self.data_dir, username))
+            with open(os.path.join(self.data_dir, username,
+                                   gloutils.PASSWORD_FILENAME), 'w') as file:
+                file.write("empreinte")
+        for username in ("alice", "carol"):
+            with open(os.path.join(self.sources_dir, f"{username}.mbox"), 'wb') as file:
+                file.write(_MBOX)
+        os.makedirs(os.path.join(self.sources_dir, "Bob", "cur"))
+        os.makedirs(os.path.join(self.sources_dir, "Bob", "new"))
+        for i in range(5):
+            with open(os.path.join(self.sources_dir, "Bob", "new", str(i)), 'wb') as file:
+                file.write(_raw_email("Mon, 01 Jan 2024 12:00:00 +0000"))
+
+    def test_find_sources(self) -> None:
+        sources = TP4_import.find_sources([self.sources_dir, "dave=ailleurs.mbox"])
+        self.assertEqual([source.username for source in sources],
+                         ["bob", "alice", "carol", "dave"])
+
+    def test_run(self) -> None:
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()) as errors:
+            results = TP4_import.run(self.data_dir, TP4_import.find_sources([self.sources_dir]),
+                                     processes=2, batch_size=2)
+        self.assertIn("carol", errors.getvalue())
+        self.assertEqual(sorted((result.source.username, result.imported, result.skipped)
+                                for result in results),
+                         [("alice", 2, 0), ("bob", 5, 0)])
+
+        store = glostore.MailboxStore(self.data_dir)
+        self.assertEqual([stored.email["subject"] for stored in store.load("alice")],
+                         ["Première", "Deuxieme"])
+        self.assertEqual(store.counters("bob").count, 5)
+        for username in ("alice", "bob"):
+            self.assertEqual(store.check(username), [])
+            self.assertTrue(os.path.exists(glosearch.index_path(self.data_dir, username)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,930 @@
+"""
+Tests du serveur: ses méthodes sont appelées directement, sans boucle
+principale, avec de vrais sockets clients au besoin.
+"""
+import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import select
+import socket
+import tempfile
+import threading
+import unittest
+from typing import Optional
+from unittest import mock
+
+import TP4_server
+import glosocket
+import glostore
+import gloutils
+
+
+PASSWORD = "MotDePasse123"  # nosec:B105
+
+
+def _email(subject: str, date: str = "Mon, 01 Jan 2024 12:00:00 +0000"
+           ) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca",
+        destination="bob@glo2000.ca",
+        subject=subject,
+        date=date,
+        content="Bonjour",
+    )
+
+
+class ServerTestCase(unittest.TestCase):
+    """Serveur dans un dossier temporaire, sur un port libre."""
+
+    # Arguments de TP4_server.Server
+    server_options: dict = {}
+
+    def setUp(self) -> None:
+        self._cwd = os.getcwd()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._temp_dir.name)
+        self.server = self.make_server()
+        # Boîte de l'utilisateur, comme à la création de son compte
+        os.makedirs(os.path.join(gloutils.SERVER_DATA_DIR, "bob"))
+
+    def tearDown(self) -> None:
+        self.server.cleanup()
+        os.chdir(self._cwd)
+        self._temp_dir.cleanup()
+
+    def make_server(self) -> TP4_server.Server:
+        with mock.patch.object(gloutils, "APP_PORT", 0):
+            return TP4_server.Server(**self.server_options)
+
+    def add_account(self, username: str, password: str = PASSWORD) -> None:
+        """Crée le compte sur le disque, comme _create_account."""
+        user_path = os.path.join(gloutils.SERVER_DATA_DIR, username)
+        os.makedirs(user_path, exist_ok=True)
+        with open(os.path.join(user_path, gloutils.PASSWORD_FILENAME), 'w') as file:
+            file.write(hashlib.sha3_512(password.encode('utf-8')).hexdigest())
+
+    def connect(self) -> tuple[socket.socket, socket.socket]:
+        """Connecte un client; retourne son socket et celui du serveur."""
+        client = socket.create_connection(self.server._server_socket.getsockname())
+        self.addCleanup(client.close)
+        self.server._accept_client()
+        return client, self.server._client_socs[-1]
+
+    def request(self, client: socket.socket, server_soc: socket.socket,
+                data: bytes) -> None:
+        """Envoie une trame au serveur et la lui fait lire."""
+        client.sendall(b"".join(glosocket.encode_frame(data)))
+        select.select([server_soc], [], [], 5)
+        self.server._process_client(server_soc)
+
+    def reply(self, client: socket.socket) -> gloutils.GloMessage:
+        """Attend la prochaine réponse du serveur au client."""
+        client.settimeout(5)
+        return glosocket.decode_message(glosocket.recv_bytes(client))
+
+    def wait_completions(self, server_soc: socket.socket) -> None:
+        """Transmet les réponses du bassin aux requêtes du client."""
+        while server_soc in self.server._inflight:
+            if not select.select([self.server._wakeup_reader], [], [], 5)[0]:
+                self.fail("Requête toujours en cours dans le bassin")
+            self.server._process_completions()
+
+    def call(self, client: socket.socket, server_soc: socket.socket,
+             message: dict) -> gloutils.GloMessage:
+        """Envoie une requête JSON au serveur et retourne sa réponse."""
+        self.request(client, server_soc, json.dumps(message).encode())
+        self.wait_completions(server_soc)
+        return self.reply(client)
+
+
+class MailboxIndexTest(ServerTestCase):
+
+    def test_index_email_after_build(self) -> None:
+        self.server._build_mailbox_index("bob")
+        stored = self.server._store.append("bob", _email("premier"))
+        self.server._index_email("bob", stored)
+        index = self.server._get_mailbox_index("bob")
+        self.assertEqual([entry["id"] for entry in index], [stored.email_id])
+
+    def test_index_built_between_append_and_index_email(self) -> None:
+        # Fil B: ajout au stockage; fil A: construction de l'index, qui lit
+        # déjà le courriel; fil B: ajout à l'index
+        stored = self.server._store.append("bob", _email("premier"))
+        with self.server._get_mailbox_lock("bob"):
+            self.server._build_mailbox_index("bob")
+        self.server._index_email("bob", stored)
+        index = self.server._get_mailbox_index("bob")
+        self.assertEqual([entry["id"] for entry in index], [stored.email_id])
+        self.assertEqual(list(self.server._mailbox_ids["bob"]), [stored.email_id])
+
+    def test_index_sorted_by_date(self) -> None:
+        self.server._build_mailbox_index("bob")
+        for subject, date in (("b", "Tue, 02 Jan 2024 12:00:00 +0000"),
+                              ("a", "Mon, 01 Jan 2024 12:00:00 +0000"),
+                              ("c", "Wed, 03 Jan 2024 12:00:00 +0000")):
+            self.server._index_email("bob", self.server._store.append("bob", _email(subject, date)))
+        index = self.server._get_mailbox_index("bob")
+        self.assertEqual([entry["subject"] for entry in index], ["a", "b", "c"])
+
+
+class WorkersTest(ServerTestCase):
+    """Deux processus serveurs (--workers) qui partagent SERVER_DATA_DIR."""
+
+    server_options = {"reuse_port": True}
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("bob")
+        self.other = self.make_server()
+        self.addCleanup(self.other.cleanup)
+        for server in (self.server, self.other):
+            server._request_state.segments = set()
+            server._request_state.notifications = []
+
+    def test_account_created_by_other_worker(self) -> None:
+        reply = self.other._create_account(None, gloutils.AuthPayload(
+            username="Carol", password=PASSWORD))
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        client, server_soc = self.connect()
+        reply = self.server._login(server_soc, gloutils.AuthPayload(
+            username="carol", password=PASSWORD))
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual(self.server._logged_users[server_soc], "carol")
+
+    def test_same_name_created_once(self) -> None:
+        # Les deux processus vérifient le nom avant que l'un d'eux crée le compte
+        replies = []
+        for server in (self.server, self.other):
+            with mock.patch.object(server, "_find_user", return_value=None):
+                replies.append(server._create_account(None, gloutils.AuthPayload(
+                    username="carol", password=PASSWORD)))
+        self.assertEqual([reply["header"] for reply in replies],
+                         [gloutils.Headers.OK, gloutils.Headers.ERROR])
+
+    def test_delivery_seen_by_other_worker(self) -> None:
+        self.assertEqual(self.server._get_mailbox_index("bob"), [])
+        self.other._send_email(None, _email("premier"))
+        self.server._send_email(None, _email("deuxième"))
+        self.other._send_email(None, _email("troisième"))
+        for server in (self.server, self.other):
+            with self.subTest(server=server):
+                index = server._get_mailbox_index("bob")
+                self.assertEqual([entry["subject"] for entry in index],
+                                 ["premier", "deuxième", "troisième"])
+                self.assertEqual(len({entry["id"] for entry in index}), 3)
+        self.assertEqual(self.server._store.counters("bob").count, 3)
+
+
+class PoolTest(ServerTestCase):
+    """Requêtes traitées par le bassin, hors de la boucle principale."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("bob")
+        self.slow, self.slow_soc = self.connect()
+        self.server._logged_users[self.slow_soc] = "bob"
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        get_stats = self.server._get_stats
+
+        def slow_get_stats(client_soc):
+            self.release.wait(5)
+            return get_stats(client_soc)
+
+        patcher = mock.patch.object(self.server, "_get_stats", slow_get_stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_slow_request_does_not_block_others(self) -> None:
+        self.request(self.slow, self.slow_soc, json.dumps(
+            {"header": gloutils.Headers.STATS_REQUEST}).encode())
+        client, server_soc = self.connect()
+        reply = self.call(client, server_soc, {
+            "header": gloutils.Headers.AUTH_LOGIN,
+            "payload": {"username": "bob", "password": PASSWORD}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertIn(self.slow_soc, self.server._inflight)
+
+        self.release.set()
+        self.wait_completions(self.slow_soc)
+        self.assertEqual(self.reply(self.slow)["payload"]["count"], 0)
+
+    def test_replies_in_request_order(self) -> None:
+        self.server._store.append("bob", _email("premier"))
+        data = b"".join(b"".join(glosocket.encode_frame(json.dumps(message)))
+                        for message in ({"header": gloutils.Headers.STATS_REQUEST},
+                                        {"header": gloutils.Headers.INBOX_READING_REQUEST}))
+        self.slow.sendall(data)
+        select.select([self.slow_soc], [], [], 5)
+        self.server._process_client(self.slow_soc)
+        # La liste attend la fin des statistiques
+        self.assertEqual(len(self.server._pending_requests[self.slow_soc]), 1)
+
+        self.release.set()
+        self.wait_completions(self.slow_soc)
+        self.assertEqual(self.reply(self.slow)["payload"], {"count": 1, "size": mock.ANY})
+        self.assertEqual(len(self.reply(self.slow)["payload"]["email_list"]), 1)
+
+
+class AccountTest(ServerTestCase):
+
+    def register(self, username: str) -> gloutils.GloMessage:
+        client, server_soc = self.connect()
+        return self.server._create_account(server_soc, gloutils.AuthPayload(
+            username=username, password="MotDePasse123"))
+
+    def auth(self, header: gloutils.Headers, username: str,
+             password: str = PASSWORD) -> gloutils.GloMessage:
+        client, server_soc = self.connect()
+        return self.call(client, server_soc, {
+            "header": header, "payload": {"username": username, "password": password}})
+
+    def test_register_then_login(self) -> None:
+        reply = self.auth(gloutils.Headers.AUTH_REGISTER, "Carol")
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertIn("carol", self.server._users)
+        self.assertEqual(self.auth(gloutils.Headers.AUTH_REGISTER, "CAROL")["header"],
+                         gloutils.Headers.ERROR)
+        self.assertEqual(self.auth(gloutils.Headers.AUTH_LOGIN, "cArOl")["header"],
+                         gloutils.Headers.OK)
+        reply = self.auth(gloutils.Headers.AUTH_LOGIN, "carol", "Mauvais123456")
+        self.assertEqual(reply["payload"]["error_message"], "Mot de passe invalide.")
+
+    def test_login_from_registry(self) -> None:
+        self.add_account("carol")
+        self.server.cleanup()
+        self.server = self.make_server()
+        # Connexion sans lire le disque
+        with mock.patch("builtins.open", side_effect=AssertionError("fichier lu")), \
+                mock.patch.object(os, "scandir", side_effect=AssertionError("dossier lu")):
+            self.assertEqual(self.auth(gloutils.Headers.AUTH_LOGIN, "Carol")["header"],
+                             gloutils.Headers.OK)
+
+    def test_unknown_user(self) -> None:
+        reply = self.auth(gloutils.Headers.AUTH_LOGIN, "inconnu")
+        self.assertEqual(reply["payload"]["error_message"],
+                         "Il n'y a pas de compte associé à ce nom d'utilisateur.")
+        self.assertNotIn("inconnu", self.server._users)
+
+    def test_lost_reserved(self) -> None:
+        for username in ("lost", "LOST", "Lost"):
+            with self.subTest(username=username):
+                self.assertEqual(self.register(username)["header"], gloutils.Headers.ERROR)
+        self.assertIsNone(self.server._find_user("lost"))
+
+
+class EmailChoiceTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.client, self.server_soc = self.connect()
+        self.server._logged_users[self.server_soc] = "bob"
+        for subject in ("premier", "deuxième"):
+            self.server._store.append("bob", _email(subject))
+
+    def test_choice(self) -> None:
+        reply = self.server._get_email(self.server_soc, {"choice": 2})
+        self.assertEqual(reply["payload"]["subject"], "deuxième")
+
+    def test_invalid_choice(self) -> None:
+        for choice in (0, -1, 3, "1", True):
+            with self.subTest(choice=choice):
+                # Chemin habituel, puis chemin avec sendfile
+                reply = self.server._get_email(self.server_soc, {"choice": choice})
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+                self.assertEqual(reply["payload"]["error_message"],
+                                 "Choix de courriel invalide.")
+                header, _ = self.server._run_request(self.server_soc, gloutils.GloMessage(
+                    header=gloutils.Headers.INBOX_READING_CHOICE, payload={"choice": choice}))
+                self.assertEqual(header, gloutils.Headers.ERROR)
+
+
+class SendfileTest(ServerTestCase):
+    """Courriels transmis depuis leur segment, sans être lus par le serveur."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.email = _email("gros courriel")
+        # Plus grand qu'un petit message, qui serait lu puis envoyé d'un bloc
+        self.email["content"] = "é" * 100000
+        self.stored = self.server._store.append("bob", self.email)
+
+    def fetch(self, codec: str, message: dict,
+              compression: Optional[str] = None) -> gloutils.GloMessage:
+        client, server_soc = self.connect()
+        hello = {"codecs": [codec]}
+        if compression is not None:
+            hello["compressions"] = [compression]
+        self.call(client, server_soc, {"header": gloutils.Headers.HELLO, "payload": hello})
+        self.server._logged_users[server_soc] = "bob"
+        self.request(client, server_soc,
+                     glosocket.encode_message(message, codec))
+        self.wait_completions(server_soc)
+        # La réponse dépasse les tampons des sockets: elle est lue pendant
+        # que le serveur l'envoie
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            reply = executor.submit(self.reply, client)
+            writer = self.server._writers[server_soc]
+            while writer.pending:
+                select.select([], [server_soc], [], 5)
+                self.server._flush_client(server_soc)
+            return reply.result()
+
+    def test_fetch_without_reading(self) -> None:
+        messages = ({"header": gloutils.Headers.INBOX_READING_CHOICE, "payload": {"choice": 1}},
+                    {"header": gloutils.Headers.INBOX_READING_ID,
+                     "payload": {"id": self.stored.email_id}})
+        with mock.patch.object(self.server._store, "read",
+                               side_effect=AssertionError("courriel lu")):
+            for codec in glosocket.CODECS:
+                for message in messages:
+                    with self.subTest(codec=codec, header=message["header"]):
+                        reply = self.fetch(codec, dict(message, request_id=3))
+                        self.assertEqual(reply, {"header": gloutils.Headers.OK,
+                                                 "payload": self.email, "request_id": 3})
+
+    def test_compressed_fetch_reads_email(self) -> None:
+        with mock.patch.object(self.server._store, "read",
+                               wraps=self.server._store.read) as read:
+            reply = self.fetch(glosocket.CODEC_JSON, {
+                "header": gloutils.Headers.INBOX_READING_CHOICE, "payload": {"choice": 1}},
+                glosocket.COMPRESSION_ZLIB)
+        self.assertEqual(reply["payload"], self.email)
+        read.assert_called_once()
+
+
+class EmailIdTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("bob")
+        self.client, self.server_soc = self.connect()
+        self.server._logged_users[self.server_soc] = "bob"
+        self.server._store.append("bob", _email("premier", "Tue, 02 Jan 2024 12:00:00 +0000"))
+
+    def fetch(self, email_id: object) -> gloutils.GloMessage:
+        return self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.INBOX_READING_ID, "payload": {"id": email_id}})
+
+    def test_id_stable_when_mail_arrives(self) -> None:
+        reply = self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.INBOX_READING_REQUEST,
+            "payload": {"fields": ["number", "id", "subject"]}})
+        email_id = reply["payload"]["emails"][0]["id"]
+        # Courriel plus ancien: les positions changent
+        self.server._request_state.segments = set()
+        self.server._request_state.notifications = []
+        self.server._send_email(None, _email("ancien", "Mon, 01 Jan 2024 12:00:00 +0000"))
+
+        with mock.patch.object(self.server, "_get_mailbox_index",
+                               side_effect=AssertionError("liste parcourue")):
+            self.assertEqual(self.fetch(email_id)["payload"]["subject"], "premier")
+        # La position désigne maintenant l'autre courriel
+        reply = self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.INBOX_READING_CHOICE, "payload": {"choice": 1}})
+        self.assertEqual(reply["payload"]["subject"], "ancien")
+
+    def test_unknown_id(self) -> None:
+        for email_id in (12345, -1):
+            with self.subTest(email_id=email_id):
+                reply = self.fetch(email_id)
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+                self.assertEqual(reply["payload"]["error_message"], "Courriel introuvable.")
+                reply = self.server._get_email_by_id(self.server_soc, {"id": email_id})
+                self.assertEqual(reply["payload"]["error_message"], "Courriel introuvable.")
+
+
+class EmailDateTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("bob")
+        self.server._request_state.segments = set()
+        self.server._request_state.notifications = []
+
+    def test_invalid_date_refused(self) -> None:
+        for date in ("pas une date", "", 5, "Mon, 31 Feb 2024 12:00:00 +0000"):
+            with self.subTest(date=date):
+                email = _email("premier")
+                email["date"] = date
+                reply = self.server._send_email(None, email)
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+        self.assertEqual(self.server._store.counters("bob").count, 0)
+
+    def test_index_tolerates_stored_invalid_date(self) -> None:
+        # Courriel stocké par une version qui ne validait pas les dates
+        email = _email("ancien")
+        email["date"] = "pas une date"
+        self.server._store.append("bob", email)
+        self.server._store.append("bob", _email("récent", "Mon, 01 Jan 2024 12:00:00 +0000"))
+        self.server._build_mailbox_index("bob")
+        index = self.server._get_mailbox_index("bob")
+        self.assertEqual([entry["subject"] for entry in index], ["récent", "ancien"])
+
+
+class StatsTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("bob")
+        self.client, self.server_soc = self.connect()
+        self.server._logged_users[self.server_soc] = "bob"
+
+    def send(self, subject: str) -> gloutils.GloMessage:
+        return self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.EMAIL_SENDING, "payload": _email(subject)})
+
+    def test_stats_without_reading_mailbox(self) -> None:
+        for subject in ("premier", "deuxième"):
+            self.assertEqual(self.send(subject)["header"], gloutils.Headers.OK)
+        error = AssertionError("boîte parcourue")
+        with mock.patch.object(os, "walk", side_effect=error), \
+                mock.patch.object(self.server._store, "load", side_effect=error):
+            reply = self.call(self.client, self.server_soc,
+                              {"header": gloutils.Headers.STATS_REQUEST})
+        password_path = os.path.join(gloutils.SERVER_DATA_DIR, "bob",
+                                     gloutils.PASSWORD_FILENAME)
+        self.assertEqual(reply["payload"], {
+            "count": 2,
+            "size": os.path.getsize(password_path) + self.server._store.counters("bob").size})
+
+    def test_quota(self) -> None:
+        self.send("premier")
+        self.server._quota = self.server._store.counters("bob").size + 10
+        reply = self.send("deuxième")
+        self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+        self.assertEqual(reply["payload"]["error_message"],
+                         "La boîte courriel du destinataire est pleine.")
+        self.assertEqual(self.server._store.counters("bob").count, 1)
+
+
+class CursorTest(ServerTestCase):
+
+    def test_round_trip(self) -> None:
+        for offset in (0, 1, 50, 123456789):
+            with self.subTest(offset=offset):
+                cursor = self.server._encode_cursor(offset)
+                self.assertEqual(self.server._decode_cursor(cursor), offset)
+        self.assertEqual(self.server._decode_cursor(None), 0)
+
+    def test_invalid(self) -> None:
+        for cursor in ("", "!!!", self.server._encode_cursor(1)[:-2],
+                       base64.urlsafe_b64encode(b"p:1").decode(),
+                       base64.urlsafe_b64encode(b"o:-1").decode(),
+                       base64.urlsafe_b64encode(b"o:1:2").decode(),
+                       base64.urlsafe_b64encode(b"o:\xff").decode(), 5, ["o:1"]):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    self.server._decode_cursor(cursor)
+
+    def test_invalid_cursor_reply(self) -> None:
+        client, server_soc = self.connect()
+        self.server._logged_users[server_soc] = "bob"
+        for cursor in ("!!!", 5):
+            with self.subTest(cursor=cursor):
+                reply = self.server._get_email_list(server_soc, {"cursor": cursor})
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+
+
+class PaginationTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.client, self.server_soc = self.connect()
+        self.server._logged_users[self.server_soc] = "bob"
+        for day in range(1, 6):
+            self.server._store.append(
+                "bob", _email(f"jour {day}", f"Mon, {day:02} Jan 2024 12:00:00 +0000"))
+
+    def list_page(self, payload: dict) -> gloutils.GloMessage:
+        return self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.INBOX_READING_REQUEST, "payload": payload})
+
+    def test_pages_cover_full_list(self) -> None:
+        full = self.call(self.client, self.server_soc,
+                         {"header": gloutils.Headers.INBOX_READING_REQUEST})
+        lines, payload = [], {"limit": 2}
+        while True:
+            page = self.list_page(payload)["payload"]
+            self.assertLessEqual(len(page["email_list"]), 2)
+            lines.extend(page["email_list"])
+            if "next_cursor" not in page:
+                break
+            payload = {"limit": 2, "cursor": page["next_cursor"]}
+        self.assertEqual(lines, full["payload"]["email_list"])
+        self.assertEqual(len(lines), 5)
+
+    def test_projection(self) -> None:
+        reply = self.list_page({"limit": 3, "fields": ["number", "id", "subject"]})
+        self.assertNotIn("email_list", reply["payload"])
+        emails = reply["payload"]["emails"]
+        self.assertEqual([set(email) for email in emails], [{"number", "id", "subject"}] * 3)
+        self.assertEqual([email["number"] for email in emails], [1, 2, 3])
+        page = self.list_page({"limit": 3, "cursor": reply["payload"]["next_cursor"],
+                               "fields": ["number"]})
+        self.assertEqual(page["payload"], {"emails": [{"number": 4}, {"number": 5}]})
+
+    def test_invalid_page(self) -> None:
+        for payload in ({"limit": 0}, {"limit": gloutils.MAX_PAGE_SIZE + 1},
+                        {"fields": ["content"]}):
+            with self.subTest(payload=payload):
+                reply = self.list_page(payload)
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+                self.assertEqual(reply["payload"]["error_message"],
+                                 "Requête de liste de courriels invalide.")
+
+
+class SearchTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.client, self.server_soc = self.connect()
+        self.server._logged_users[self.server_soc] = "bob"
+        for subject in ("rapport annuel", "vacances"):
+            self.server._store.append("bob", _email(subject))
+
+    def search(self, payload: dict) -> gloutils.GloMessage:
+        return self.server._search(self.server_soc, payload)
+
+    def test_search(self) -> None:
+        reply = self.search({"subject": "Rapport", "fields": ["subject"]})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual([email["subject"] for email in reply["payload"]["emails"]],
+                         ["rapport annuel"])
+        reply = self.search({"subject": "inconnu", "fields": ["subject"]})
+        self.assertEqual(reply["payload"]["emails"], [])
+
+    def test_invalid_criteria(self) -> None:
+        # Sans mot cherchable, la recherche retournerait toute la boîte
+        for payload in ({"body": "!!!"}, {"subject": "rapport", "body": "?"},
+                        {"subject": ["rapport"]}, {"sender": 5},
+                        {"body": "!!!", "since": "Mon, 01 Jan 2024 00:00:00 +0000"}):
+            with self.subTest(payload=payload):
+                reply = self.search(payload)
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+                self.assertEqual(reply["payload"]["error_message"],
+                                 "Requête de recherche invalide.")
+
+
+class ManyRecipientsTest(ServerTestCase):
+
+    def test_batch_keeps_few_files_open(self) -> None:
+        destinations = []
+        for i in range(50):
+            self.add_account(f"user{i}")
+            destinations.append(f"user{i}@glo2000.ca")
+        self.server._request_state.segments = set()
+        self.server._request_state.notifications = []
+        before = len(os.listdir("/proc/self/fd"))
+        with mock.patch.object(glostore, "MAX_OPEN_MAILBOXES", 8), \
+                mock.patch.object(self.server._store, "_max_open_mailboxes", 8):
+            reply = self.server._send_batch_email(None, gloutils.EmailBatchPayload(
+                sender="alice@glo2000.ca", destinations=destinations, subject="Sujet",
+                date="Mon, 01 Jan 2024 12:00:00 +0000", content="Bonjour"))
+        self.assertEqual({result["status"] for result in reply["payload"]["results"]},
+                         {gloutils.DeliveryStatus.DELIVERED})
+        # Segments en attente du lot, plus verrou et compteurs des boîtes ouvertes
+        self.assertLess(len(self.server._request_state.segments), 8)
+        self.assertLessEqual(len(os.listdir("/proc/self/fd")) - before, 8 + 8 * 3)
+
+
+    def test_batch_reports_failed_recipient(self) -> None:
+        for username in ("alice", "bob", "carol"):
+            self.add_account(username)
+        self.server._request_state.segments = set()
+        self.server._request_state.notifications = []
+        append = self.server._store.append
+
+        def fail_for_bob(username, email, quota=None):
+            if username == "bob":
+                raise OSError(24, "Too many open files")
+            return append(username, email, quota)
+
+        with mock.patch.object(self.server._store, "append", fail_for_bob):
+            reply = self.server._send_batch_email(None, gloutils.EmailBatchPayload(
+                sender="alice@glo2000.ca",
+                destinations=["alice@glo2000.ca", "bob@glo2000.ca", "carol@glo2000.ca"],
+                subject="Sujet", date="Mon, 01 Jan 2024 12:00:00 +0000", content="Bonjour"))
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual([result["status"] for result in reply["payload"]["results"]],
+                         [gloutils.DeliveryStatus.DELIVERED, gloutils.DeliveryStatus.FAILED,
+                          gloutils.DeliveryStatus.DELIVERED])
+        self.assertEqual(len(self.server._store.load("carol")), 1)
+
+
+class BatchTest(ServerTestCase):
+    """Envoi à plusieurs destinataires et consultation de plusieurs courriels."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("alice")
+        self.add_account("bob")
+        self.client, self.server_soc = self.connect()
+
+    def call_as(self, username: str, message: dict) -> gloutils.GloMessage:
+        self.server._logged_users[self.server_soc] = username
+        return self.call(self.client, self.server_soc, message)
+
+    def test_batch_send(self) -> None:
+        reply = self.call_as("alice", {
+            "header": gloutils.Headers.EMAIL_BATCH_SENDING,
+            "payload": {"sender": "alice@glo2000.ca",
+                        "destinations": ["bob@glo2000.ca", "BOB@glo2000.ca",
+                                         "inconnu@glo2000.ca", "carol@ailleurs.com"],
+                        "subject": "Sujet", "date": "Mon, 01 Jan 2024 12:00:00 +0000",
+                        "content": "Bonjour"}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        # Le doublon est ignoré
+        self.assertEqual([(result["destination"], result["status"])
+                          for result in reply["payload"]["results"]],
+                         [("bob@glo2000.ca", gloutils.DeliveryStatus.DELIVERED),
+                          ("inconnu@glo2000.ca", gloutils.DeliveryStatus.LOST),
+                          ("carol@ailleurs.com", gloutils.DeliveryStatus.FAILED)])
+        self.assertEqual(self.server._store.counters("bob").count, 1)
+        self.assertEqual(self.server._store.counters(gloutils.SERVER_LOST_DIR).count, 1)
+
+    def test_batch_fetch(self) -> None:
+        for subject in ("premier", "deuxième", "troisième"):
+            self.server._store.append("bob", _email(subject))
+        reply = self.call_as("bob", {"header": gloutils.Headers.INBOX_READING_BATCH_CHOICE,
+                                     "payload": {"choices": [3, 1, 3]}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual([email["subject"] for email in reply["payload"]["emails"]],
+                         ["troisième", "premier", "troisième"])
+        reply = self.call_as("bob", {"header": gloutils.Headers.INBOX_READING_BATCH_CHOICE,
+                                     "payload": {"choices": [1, 4]}})
+        self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+
+
+class DurabilityTest(ServerTestCase):
+    """Courriels livrés écrits sur le disque avant la réponse à l'envoi."""
+
+    def send_with_durability(self, durability: str, **sync_options) -> tuple[
+            gloutils.GloMessage, mock.Mock]:
+        """Envoie un courriel à bob et retourne la réponse et le fsync simulé."""
+        self.server.cleanup()
+        self.server_options = {"durability": durability}
+        self.server = self.make_server()
+        self.add_account("bob")
+        self.client, server_soc = self.connect()
+        self.server._logged_users[server_soc] = "alice"
+        with mock.patch.object(glostore.Segment, "sync", **sync_options) as sync:
+            reply = self.call(self.client, server_soc, {
+                "header": gloutils.Headers.EMAIL_SENDING,
+                "payload": {"sender": "alice@glo2000.ca", "destination": "bob@glo2000.ca",
+                            "subject": "Sujet", "date": "Mon, 01 Jan 2024 12:00:00 +0000",
+                            "content": "Bonjour"}})
+        return reply, sync
+
+    def test_message(self) -> None:
+        reply, sync = self.send_with_durability(glostore.DURABILITY_MESSAGE)
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        sync.assert_called_once()
+        self.assertIsNone(self.server._group_commit)
+
+    def test_none(self) -> None:
+        reply, sync = self.send_with_durability(glostore.DURABILITY_NONE)
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        sync.assert_not_called()
+
+    def test_batched_reply_after_sync(self) -> None:
+        def sync() -> None:
+            # Pas encore de réponse au client pendant le fsync
+            self.assertEqual(select.select([self.client], [], [], 0)[0], [])
+
+        reply, sync_mock = self.send_with_durability(glostore.DURABILITY_BATCHED,
+                                                     side_effect=sync)
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        sync_mock.assert_called_once()
+        gauges = self.server._metrics.to_payload()["gauges"]
+        self.assertEqual((gauges["commit_batches"], gauges["committed_requests"]), (1, 1))
+
+    def test_batched_failed_sync(self) -> None:
+        reply, _ = self.send_with_durability(glostore.DURABILITY_BATCHED,
+                                             side_effect=OSError("disque"))
+        self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+        self.assertEqual(reply["payload"]["error_message"],
+                         "La requête n'a pas pu être traitée.")
+
+
+class NotificationTest(ServerTestCase):
+    """Notifications NEW_EMAIL des nouveaux courriels aux clients abonnés."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.add_account("alice")
+        self.add_account("bob")
+        self.bob, self.bob_soc = self.connect()
+        self.server._logged_users[self.bob_soc] = "bob"
+        self.alice, self.alice_soc = self.connect()
+        self.server._logged_users[self.alice_soc] = "alice"
+
+    def subscribe(self, enabled: bool = True) -> gloutils.GloMessage:
+        return self.call(self.bob, self.bob_soc, {"header": gloutils.Headers.SUBSCRIBE,
+                                                  "payload": {"enabled": enabled}})
+
+    def send_to_bob(self, subject: str) -> None:
+        reply = self.call(self.alice, self.alice_soc, {
+            "header": gloutils.Headers.EMAIL_SENDING,
+            "payload": {"sender": "alice@glo2000.ca", "destination": "bob@glo2000.ca",
+                        "subject": subject, "date": "Mon, 01 Jan 2024 12:00:00 +0000",
+                        "content": "Bonjour"}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+
+    def assertNothingPushed(self) -> None:
+        self.assertEqual(select.select([self.bob], [], [], 0.05)[0], [])
+
+    def test_subscribed_client_notified(self) -> None:
+        self.assertEqual(self.subscribe()["header"], gloutils.Headers.OK)
+        self.send_to_bob("Sujet")
+        notification = self.reply(self.bob)
+        self.assertEqual(notification["header"], gloutils.Headers.NEW_EMAIL)
+        self.assertNotIn("request_id", notification)
+        email, = notification["payload"]["emails"]
+        self.assertEqual((email["sender"], email["subject"]), ("alice@glo2000.ca", "Sujet"))
+        self.assertEqual(email["id"], self.server._store.load("bob")[0].email_id)
+
+    def test_not_subscribed(self) -> None:
+        self.send_to_bob("Sujet")
+        self.assertNothingPushed()
+
+    def test_unsubscribed(self) -> None:
+        self.subscribe()
+        self.assertEqual(self.subscribe(enabled=False)["header"], gloutils.Headers.OK)
+        self.send_to_bob("Sujet")
+        self.assertNothingPushed()
+        self.assertNotIn("bob", self.server._subscribers)
+
+    def test_login_ends_subscription(self) -> None:
+        self.subscribe()
+        reply = self.call(self.bob, self.bob_soc, {
+            "header": gloutils.Headers.AUTH_LOGIN,
+            "payload": {"username": "alice", "password": PASSWORD}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.send_to_bob("Sujet")
+        self.assertNothingPushed()
+
+    def test_requires_login(self) -> None:
+        del self.server._logged_users[self.bob_soc]
+        self.assertEqual(self.subscribe()["header"], gloutils.Headers.ERROR)
+
+
+class EventLogTest(ServerTestCase):
+
+    def test_email_sent_has_connection(self) -> None:
+        client, server_soc = self.connect()
+        self.server._logged_users[server_soc] = "alice"
+        # État préparé par _execute_request dans le bassin
+        self.server._request_state.segments = set()
+        self.server._request_state.notifications = []
+        with mock.patch.object(self.server._log, "info") as info:
+            self.server._send_email(server_soc, _email("premier"))
+            self.server._send_batch_email(server_soc, gloutils.EmailBatchPayload(
+                sender="alice@glo2000.ca", destinations=["bob@glo2000.ca"],
+                subject="deuxième", date="Mon, 01 Jan 2024 12:00:00 +0000",
+                content="Bonjour"))
+        events = [call for call in info.call_args_list if call.args == ("email_sent",)]
+        self.assertEqual(len(events), 2)
+        for call in events:
+            self.assertEqual(call.kwargs["conn"], self.server._connection_ids[server_soc])
+
+
+class MalformedRequestTest(ServerTestCase):
+
+    def test_malformed_frames_disconnect_client(self) -> None:
+        for data in (b"[1]", b"5", b'{"x": 1}', b'{"header": "1"}', b"{",
+                     b'{"header": 1, "request_id": [1]}'):
+            with self.subTest(data=data):
+                client, server_soc = self.connect()
+                self.request(client, server_soc, data)
+                self.assertNotIn(server_soc, self.server._client_socs)
+
+    def test_other_clients_still_served(self) -> None:
+        bad, bad_soc = self.connect()
+        good, good_soc = self.connect()
+        self.request(bad, bad_soc, b"[1]")
+        self.request(good, good_soc, json.dumps({"header": gloutils.Headers.HELLO,
+                                                 "payload": {}}).encode())
+        self.assertEqual(self.reply(good)["header"], gloutils.Headers.OK)
+
+
+class HelloTest(ServerTestCase):
+
+    def hello(self, message: dict) -> gloutils.GloMessage:
+        client, server_soc = self.connect()
+        self.request(client, server_soc, json.dumps(message).encode())
+        self.assertIn(server_soc, self.server._client_socs)
+        return self.reply(client)
+
+    def test_negotiate(self) -> None:
+        reply = self.hello({"header": gloutils.Headers.HELLO, "payload": {
+            "out_of_order": True, "codecs": ["inconnu", "binary"], "compressions": ["zlib"]}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual(reply["payload"], {"out_of_order": True, "codec": "binary",
+                                            "compression": "zlib"})
+
+    def test_without_payload(self) -> None:
+        reply = self.hello({"header": gloutils.Headers.HELLO})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual(reply["payload"], {"codec": "json"})
+
+    def test_invalid_payload(self) -> None:
+        for payload in ("x", [], {"codecs": 5}, {"codecs": [1]}, {"compressions": "zlib"}):
+            with self.subTest(payload=payload):
+                reply = self.hello({"header": gloutils.Headers.HELLO, "payload": payload})
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+
+
+
+class MetricsTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.server._admins = {"admin"}
+        self.client, self.server_soc = self.connect()
+
+    def metrics(self) -> gloutils.GloMessage:
+        return self.call(self.client, self.server_soc,
+                         {"header": gloutils.Headers.METRICS_REQUEST})
+
+    def test_admin_only(self) -> None:
+        self.server._logged_users[self.server_soc] = "bob"
+        reply = self.metrics()
+        self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+        self.assertEqual(reply["payload"]["error_message"],
+                         "Les métriques sont réservées aux administrateurs.")
+
+    def test_requests_and_gauges(self) -> None:
+        self.add_account("admin")
+        self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.AUTH_LOGIN,
+            "payload": {"username": "admin", "password": "Mauvais123456"}})
+        reply = self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.AUTH_LOGIN,
+            "payload": {"username": "admin", "password": PASSWORD}})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+
+        payload = self.metrics()["payload"]
+        login = payload["requests"]["AUTH_LOGIN"]
+        self.assertEqual((login["requests"], login["errors"]), (2, 1))
+        self.assertGreater(login["bytes_in"], 0)
+        self.assertGreater(login["bytes_out"], 0)
+        self.assertEqual(sum(login["latency_counts"]), 2)
+        self.assertEqual(payload["gauges"]["connected_clients"], 1)
+        self.assertEqual(payload["gauges"]["logged_users"], 1)
+        self.assertEqual(payload["gauges"]["lost_mailbox_bytes"], 0)
+        # La requête des métriques est comptée après sa réponse
+        self.assertEqual(
+            self.metrics()["payload"]["requests"]["METRICS_REQUEST"]["requests"], 1)
+
+
+class ProfilingTest(ServerTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.server._admins = {"bob"}
+        self.client, self.server_soc = self.connect()
+        self.server._logged_users[self.server_soc] = "bob"
+
+    def profiling(self, payload: object) -> gloutils.GloMessage:
+        return self.call(self.client, self.server_soc, {
+            "header": gloutils.Headers.PROFILING_REQUEST, "payload": payload})
+
+    def test_start_and_stop(self) -> None:
+        reply = self.profiling({"enabled": True, "mode": "cprofile", "percent": 50,
+                                "headers": ["AUTH_LOGIN"]})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertIsNotNone(self.server._profiler)
+        reply = self.profiling({"enabled": False})
+        self.assertEqual(reply["header"], gloutils.Headers.OK)
+        self.assertEqual(reply["payload"], {"enabled": False, "files": []})
+        self.assertIsNone(self.server._profiler)
+
+    def test_stop_written_by_pool(self) -> None:
+        self.profiling({"enabled": True})
+        with mock.patch.object(self.server._executor, "submit",
+                               wraps=self.server._executor.submit) as submit:
+            self.assertEqual(self.profiling({"enabled": False})["header"],
+                             gloutils.Headers.OK)
+        self.assertEqual(submit.call_args.args[0], self.server._execute_profiling_stop)
+
+    def test_invalid_options(self) -> None:
+        for payload in ("x", [], {"enabled": True, "mode": ["sample"]},
+                        {"enabled": True, "mode": "inconnu"},
+                        {"enabled": True, "percent": "50"},
+                        {"enabled": True, "percent": True},
+                        {"enabled": True, "percent": 0},
+                        {"enabled": True, "headers": "AUTH_LOGIN"},
+                        {"enabled": True, "headers": [1]},
+                        {"enabled": True, "headers": ["INCONNU"]}):
+            with self.subTest(payload=payload):
+                reply = self.profiling(payload)
+                self.assertEqual(reply["header"], gloutils.Headers.ERROR)
+                self.assertIn(self.server_soc, self.server._client_socs)
+                self.assertIsNone(self.server._profiler)
+
+
+if __name__ == "__main__":
+    unittest.main()